@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+#
+# generate.py <output DIR> [--flows <N>] [--rows <N>] [--diversity <N>] [--seed <N>]
+#
+# E.g., python3 generate.py /tmp/bench --flows 1000 --rows 50000 --diversity 50
+#
+# Deterministic synthetic inputs for the benchmarks (run.py), without scapy or tshark:
+#   capture.pcap        TCP flows with a TLS handshake (ClientHello, ServerHello, Certificate chain),
+#                       SYN/SYN-ACK options and some application data, interleaved in time
+#   extracted.csv       ClientHello/ServerHello rows in the tshark format read by ja4.py
+#   ja4.csv, ja4x.csv, ja4ts.csv   inputs of join.py, with mostly the same 4-tuples in another order
+#   sessions/capture/   one pcap per TCP session of capture.pcap (like sessions.sh), for MalDIST
+# --diversity is the number of distinct ClientHello, ServerHello, certificate chain and TCP option
+# templates: few templates mean many repeated fingerprints (cache hits), many mean few.
+# The same arguments always give the same files.
+#
+
+import os
+import sys
+import csv
+import heapq
+import random
+import struct
+import argparse
+from types import SimpleNamespace
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, os.path.join(ROOT, "tools"))
+sys.path.insert(0, os.path.join(ROOT, "tools", "ja4"))
+sys.path.insert(0, os.path.join(ROOT, "tools", "maldist"))
+from pcapio import pcap_header, pcap_record, LINKTYPE_ETHERNET
+from pcap_ja4 import hello_row, EXTRACTED_HEADER
+from ja4x import JA4X_HEADER
+from ja4ts import JA4TS_HEADER
+
+START = 1700000000          # capture time of the first packet
+RESOLUTION = 1000000
+
+CIPHERS = [0x1301, 0x1302, 0x1303, 0xc02b, 0xc02f, 0xc02c, 0xc030, 0xcca9, 0xcca8, 0xc013, 0xc014, 0x009c, 0x009d, 0x002f, 0x0035, 0x000a]
+EXTENSIONS = [23, 65281, 35, 5, 18, 51, 45, 27, 17513, 21, 28, 22, 49, 41]
+GROUPS = [0x001d, 0x0017, 0x0018, 0x0019, 0x0100, 0x0101]
+SIGNATURES = [0x0403, 0x0804, 0x0401, 0x0503, 0x0805, 0x0501, 0x0806, 0x0601, 0x0201]
+ALPNS = [[], ["h2", "http/1.1"], ["http/1.1"], ["h2"], ["spdy/3", "http/1.1"]]
+GREASE = [0x0a0a, 0x1a1a, 0x2a2a, 0x3a3a, 0x4a4a]
+ATTRIBUTES = ["2.5.4.6", "2.5.4.8", "2.5.4.7", "2.5.4.11"]     # besides O and CN, which ja4x.py needs
+CERT_EXTENSIONS = ["2.5.29.15", "2.5.29.37", "2.5.29.19", "2.5.29.14", "2.5.29.35", "1.3.6.1.5.5.7.1.1", "2.5.29.17",
+                   "2.5.29.32", "2.5.29.31", "1.3.6.1.4.1.11129.2.4.2"]
+TCP_OPTIONS = [b"\x02\x04\x05\xb4", b"\x01", b"\x04\x02", b"\x08\x0a\x00\x00\x00\x01\x00\x00\x00\x00", b"\x03\x03\x07"]
+
+
+def u16(v):
+    return struct.pack(">H", v)
+
+
+def u24(v):
+    return v.to_bytes(3, "big")
+
+
+# --- TLS -------------------------------------------------------------------------------------
+
+def client_template(rng):
+    """Fields of a ClientHello, as returned by pcap_ja4.parse_hello."""
+    grease = rng.random() < 0.5
+    ciphers = rng.sample(CIPHERS, rng.randint(4, len(CIPHERS)))
+    extensions = [0, 10, 11, 13, 16, 43] + rng.sample(EXTENSIONS, rng.randint(2, len(EXTENSIONS)))
+    rng.shuffle(extensions)
+    return {'version': 0x0303, 'ciphers': ([rng.choice(GREASE)] if grease else []) + ciphers, 'extensions': extensions,
+            'groups': rng.sample(GROUPS, rng.randint(2, len(GROUPS))), 'ec': [0], 'alpn': rng.choice(ALPNS),
+            'sig': rng.sample(SIGNATURES, rng.randint(3, len(SIGNATURES))), 'versions': [0x0304, 0x0303] if rng.random() < 0.8 else [0x0303]}
+
+
+def server_template(rng):
+    version = rng.choice([0x0304, 0x0303])
+    extensions = [65281, 11, 23] + ([43, 51] if version == 0x0304 else []) + ([16] if rng.random() < 0.5 else [])
+    rng.shuffle(extensions)
+    return {'version': 0x0303, 'ciphers': [rng.choice(CIPHERS[:11])], 'extensions': extensions, 'groups': [], 'ec': [0],
+            'alpn': ["h2"] if 16 in extensions else [], 'sig': [], 'versions': [version] if 43 in extensions else []}
+
+
+def hello_body(mtype, h, sni):
+    """Handshake message (type, length, body) of a ClientHello (1) or ServerHello (2)."""
+    exts = b""
+    for ext in h['extensions']:
+        if ext == 0 and sni:
+            name = sni.encode()
+            data = u16(len(name) + 3) + b"\x00" + u16(len(name)) + name
+        elif ext == 10:
+            data = u16(2 * len(h['groups'])) + b"".join(u16(g) for g in h['groups'])
+        elif ext == 11:
+            data = bytes([len(h['ec'])] + h['ec'])
+        elif ext == 13:
+            data = u16(2 * len(h['sig'])) + b"".join(u16(s) for s in h['sig'])
+        elif ext == 16:
+            names = b"".join(bytes([len(a)]) + a.encode() for a in h['alpn'])
+            data = u16(len(names)) + names
+        elif ext == 43:
+            if mtype == 1:
+                data = bytes([2 * len(h['versions'])]) + b"".join(u16(v) for v in h['versions'])
+            else:
+                data = u16(h['versions'][0])
+        elif ext == 51 and mtype == 2:
+            data = u16(0x001d) + u16(32) + bytes(32)
+        else:
+            data = b"\x00" if ext == 65281 else b""
+        exts += u16(ext) + u16(len(data)) + data
+    if mtype == 1:
+        cs = b"".join(u16(c) for c in h['ciphers'])
+        body = u16(h['version']) + bytes(32) + b"\x20" + bytes(32) + u16(len(cs)) + cs + b"\x01\x00" + u16(len(exts)) + exts
+    else:
+        body = u16(h['version']) + bytes(32) + b"\x00" + u16(h['ciphers'][0]) + b"\x00" + u16(len(exts)) + exts
+    return bytes([mtype]) + u24(len(body)) + body
+
+
+def tls_record(messages, version=0x0303):
+    return b"\x16" + u16(version) + u16(len(messages)) + messages
+
+
+# --- X.509 (only the structure read by pcap_ja4.parse_certificates, the signatures are zeros) ---
+
+def tlv(tag, content):
+    n = len(content)
+    if n < 0x80:
+        return bytes([tag, n]) + content
+    length = n.to_bytes((n.bit_length() + 7) // 8, "big")
+    return bytes([tag, 0x80 | len(length)]) + length + content
+
+
+def seq(*items):
+    return tlv(0x30, b"".join(items))
+
+
+def oid(dotted):
+    arcs = [int(a) for a in dotted.split(".")]
+    out = bytes([40 * arcs[0] + arcs[1]])
+    for arc in arcs[2:]:
+        chunk = [arc & 0x7f]
+        arc >>= 7
+        while arc:
+            chunk.append(0x80 | (arc & 0x7f))
+            arc >>= 7
+        out += bytes(reversed(chunk))
+    return tlv(0x06, out)
+
+
+def x509_name(attributes):
+    return seq(*(tlv(0x31, seq(oid(attr), tlv(0x13, value.encode()))) for attr, value in attributes))
+
+
+def certificate(issuer, subject, extensions, serial):
+    algorithm = seq(oid("1.2.840.113549.1.1.11"), tlv(0x05, b""))
+    validity = seq(tlv(0x17, b"230101000000Z"), tlv(0x17, b"300101000000Z"))
+    spki = seq(seq(oid("1.2.840.113549.1.1.1"), tlv(0x05, b"")), tlv(0x03, b"\x00" + seq(tlv(0x02, b"\x00" + bytes(64)), tlv(0x02, b"\x01\x00\x01"))))
+    exts = tlv(0xa3, seq(*(seq(oid(e), tlv(0x04, b"\x30\x00")) for e in extensions)))
+    tbs = seq(tlv(0xa0, tlv(0x02, b"\x02")), tlv(0x02, serial.to_bytes(8, "big")), algorithm, x509_name(issuer), validity,
+              x509_name(subject), spki, exts)
+    return seq(tbs, algorithm, tlv(0x03, b"\x00" + bytes(64)))
+
+
+def chain_template(rng, n):
+    """Certificate message of a server chain (leaf and intermediate)."""
+    def name(cn):
+        attrs = rng.sample(ATTRIBUTES, rng.randint(0, len(ATTRIBUTES)))
+        return [(a, f"{a.split('.')[-1]}-{n}") for a in sorted(attrs)] + [("2.5.4.10", f"Example Org {n}"), ("2.5.4.3", cn)]
+    root, intermediate, leaf = name(f"Root CA {n}"), name(f"Intermediate CA {n}"), name(f"server{n}.example.com")
+    certs = [certificate(intermediate, leaf, rng.sample(CERT_EXTENSIONS, rng.randint(3, 8)), 2 * n + 1),
+             certificate(root, intermediate, rng.sample(CERT_EXTENSIONS, rng.randint(2, 5)), 2 * n + 2)]
+    body = b"".join(u24(len(c)) + c for c in certs)
+    body = u24(len(body)) + body
+    return b"\x0b" + u24(len(body)) + body
+
+
+# --- packets -----------------------------------------------------------------------------------
+
+def ip_bytes(ip):
+    return bytes(int(x) for x in ip.split("."))
+
+
+def frame(src, dst, sport, dport, flags, seq_no, ack_no, payload=b"", window=64240, options=b""):
+    """Ethernet/IPv4/TCP frame (checksums are not computed)."""
+    options += b"\x00" * (-len(options) % 4)
+    tcp = struct.pack(">HHIIBBHHH", sport, dport, seq_no & 0xffffffff, ack_no & 0xffffffff, (5 + len(options) // 4) << 4,
+                      flags, window, 0, 0) + options
+    ip = struct.pack(">BBHHHBBH4s4s", 0x45, 0, 20 + len(tcp) + len(payload), 0, 0x4000, 64, 6, 0, ip_bytes(src), ip_bytes(dst))
+    return b"\x66\x77\x88\x99\xaa\xbb\x00\x11\x22\x33\x44\x55\x08\x00" + ip + tcp + payload
+
+
+def flow_packets(rng, n, start, client_hello, server_flight, syn_options, synack_options):
+    """(time in us, frame) of one TLS flow."""
+    c, s = f"10.{n // 65536 % 256}.{n // 256 % 256}.{n % 256 or 1}", f"93.184.{n % 50}.{n % 200 + 1}"
+    sp = 1024 + n % 60000
+    cseq, sseq = rng.getrandbits(32), rng.getrandbits(32)
+    t = start
+    packets = []
+
+    def send(*args, **kwargs):
+        nonlocal t
+        t += rng.randint(50, 20000)
+        packets.append((t, frame(*args, **kwargs)))
+
+    send(c, s, sp, 443, 0x02, cseq, 0, options=syn_options)
+    send(s, c, 443, sp, 0x12, sseq, cseq + 1, window=65160, options=synack_options)
+    send(c, s, sp, 443, 0x10, cseq + 1, sseq + 1)
+    cseq, sseq = cseq + 1, sseq + 1
+    ch = tls_record(client_hello, 0x0301)
+    cut = rng.randint(1, len(ch) - 1) if rng.random() < 0.2 else len(ch)     # some hellos in two segments
+    for part in (ch[:cut], ch[cut:]):
+        if part:
+            send(c, s, sp, 443, 0x18, cseq, sseq, part)
+            cseq += len(part)
+    flight = tls_record(server_flight)
+    for i in range(0, len(flight), 1400):
+        send(s, c, 443, sp, 0x18, sseq, cseq, flight[i:i + 1400])
+        sseq += len(flight[i:i + 1400])
+    send(c, s, sp, 443, 0x18, cseq, sseq, b"\x14\x03\x03\x00\x01\x01")
+    cseq += 6
+    for _ in range(rng.randint(0, 40)):         # application data
+        size = rng.randint(20, 1400)
+        if rng.random() < 0.4:
+            send(c, s, sp, 443, 0x18, cseq, sseq, b"\x17\x03\x03" + u16(size) + bytes(size), window=rng.randint(500, 64240))
+            cseq += size + 5
+        else:
+            send(s, c, 443, sp, 0x18, sseq, cseq, b"\x17\x03\x03" + u16(size) + bytes(size), window=rng.randint(500, 65160))
+            sseq += size + 5
+    send(c, s, sp, 443, 0x11, cseq, sseq)
+    send(s, c, 443, sp, 0x11, sseq, cseq + 1)
+    return packets
+
+
+def templates(rng, diversity):
+    return {"client": [client_template(rng) for _ in range(diversity)],
+            "server": [server_template(rng) for _ in range(diversity)],
+            "chain": [chain_template(rng, n) for n in range(diversity)],
+            "syn": [b"".join(rng.sample(TCP_OPTIONS, rng.randint(1, len(TCP_OPTIONS)))) for _ in range(diversity)]}
+
+
+def write_capture(path, flows, diversity, seed=0):
+    """Writes a pcap with `flows` interleaved TLS flows; returns the number of packets."""
+    rng = random.Random(seed)
+    tpl = templates(rng, diversity)
+    streams = []
+    for n in range(flows):
+        k = rng.randrange(diversity)
+        client_hello = hello_body(1, tpl["client"][k], f"host{n % 997}.example{k}.com" if rng.random() < 0.9 else "")
+        server_flight = hello_body(2, tpl["server"][k], None) + tpl["chain"][rng.randrange(diversity)] + b"\x0e\x00\x00\x00"
+        start = START * RESOLUTION + n * 2000        # a new flow every 2 ms, flows overlap
+        streams.append(flow_packets(rng, n, start, client_hello, server_flight, tpl["syn"][k], tpl["syn"][rng.randrange(diversity)]))
+    count = 0
+    with open(path, "wb") as f:
+        f.write(pcap_header(LINKTYPE_ETHERNET, RESOLUTION))
+        for t, data in heapq.merge(*streams, key=lambda p: p[0]):
+            f.write(pcap_record(t, RESOLUTION, data))
+            count += 1
+    return count
+
+
+def write_extracted(path, rows, diversity, seed=0):
+    """Writes an extracted CSV with rows/2 ClientHello/ServerHello pairs (pcap_ja4.hello_row)."""
+    rng = random.Random(seed)
+    tpl = templates(rng, diversity)
+    with open(path, "w") as f:
+        f.write(EXTRACTED_HEADER + "\n")
+        for n in range(rows // 2):
+            k = rng.randrange(diversity)
+            client = dict(tpl["client"][k], sni=[f"host{n % 997}.example{k}.com"] if rng.random() < 0.9 else [])
+            server = dict(tpl["server"][k], sni=[])
+            ticks = (START + n // 100) * RESOLUTION + n % 100 * 10000
+            c, s, sp = f"10.{n // 65536 % 256}.{n // 256 % 256}.{n % 256}", f"93.184.{n % 50}.{n % 200 + 1}", 1024 + n % 60000
+            pkt = SimpleNamespace(src=c, dst=s, sport=sp, dport=443, ticks=ticks, resolution=RESOLUTION)
+            f.write(";".join(hello_row(pkt, ["1"], [client])) + "\n")
+            pkt = SimpleNamespace(src=s, dst=c, sport=443, dport=sp, ticks=ticks + 5000, resolution=RESOLUTION)
+            f.write(";".join(hello_row(pkt, ["2"], [server])) + "\n")
+
+
+def write_join_inputs(outdir, rows, seed=0, overlap=0.9):
+    """Writes ja4.csv, ja4x.csv and ja4ts.csv with `rows` flows each, shuffled, overlap of them in all three."""
+    rng = random.Random(seed)
+    flows = [(f"10.{n // 65536 % 256}.{n // 256 % 256}.{n % 256}", f"93.184.{n % 50}.{n % 200 + 1}", str(1024 + n % 60000), "443")
+             for n in range(int(rows / overlap))]
+    header = ["SrcIP", "DstIP", "SrcPort", "DstPort", "SNI", "OrgName", "JA3hash", "JA4hash", "AppName", "Type", "JA3Shash",
+              "JA4Shash", "Filename", "Version"]
+    for name, columns, values in (
+            ("ja4.csv", header, lambda r: [f"host{r.randrange(997)}.example.com", "", f"{r.getrandbits(128):032x}",
+                                           f"t13d{r.randrange(99):02d}12h2_{r.getrandbits(48):012x}_{r.getrandbits(48):012x}",
+                                           "Unknown", "0", f"{r.getrandbits(128):032x}", f"t1302h2_1301_{r.getrandbits(48):012x}",
+                                           "capture", "771"]),
+            ("ja4x.csv", JA4X_HEADER, lambda r: [f"{r.getrandbits(48):012x}_{r.getrandbits(48):012x}_{r.getrandbits(48):012x}",
+                                                 "Example CA", "server.example.com"]),
+            ("ja4ts.csv", JA4TS_HEADER, lambda r: [f"65160-2-4-8-1-3-{r.choice([1400, 1460])}-{r.randrange(15)}"])):
+        chosen = rng.sample(flows, rows)
+        with open(os.path.join(outdir, name), "w", newline="") as f:
+            writer = csv.writer(f, delimiter=';')
+            writer.writerow(columns)
+            for flow in chosen:
+                writer.writerow(list(flow) + values(rng))
+
+
+def generate(outdir, flows, rows, diversity, seed=0):
+    """Writes all the inputs into outdir (existing files are kept: same arguments, same files)."""
+    from split_sessions import split_pcap
+    os.makedirs(outdir, exist_ok=True)
+    capture = os.path.join(outdir, "capture.pcap")
+    if not os.path.exists(capture):
+        write_capture(capture + ".tmp", flows, diversity, seed)
+        os.replace(capture + ".tmp", capture)
+    extracted = os.path.join(outdir, "extracted.csv")
+    if not os.path.exists(extracted):
+        write_extracted(extracted + ".tmp", rows, diversity, seed)
+        os.replace(extracted + ".tmp", extracted)
+    if not os.path.exists(os.path.join(outdir, "ja4ts.csv")):
+        write_join_inputs(outdir, rows, seed)
+    sessions = os.path.join(outdir, "sessions", "capture")
+    if not os.path.isdir(sessions):
+        os.makedirs(sessions + ".tmp", exist_ok=True)
+        split_pcap(capture, sessions + ".tmp")
+        os.replace(sessions + ".tmp", sessions)
+    return outdir
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generates deterministic synthetic captures and CSV files for the benchmarks.")
+    parser.add_argument("outdir", help="Output directory")
+    parser.add_argument("--flows", type=int, default=1000, help="TLS flows in capture.pcap")
+    parser.add_argument("--rows", type=int, default=50000, help="Rows of extracted.csv and of each join input")
+    parser.add_argument("--diversity", type=int, default=50, help="Number of distinct hello, certificate and TCP option templates")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    generate(args.outdir, args.flows, args.rows, args.diversity, args.seed)
+    print(f"Inputs saved into {args.outdir}/")
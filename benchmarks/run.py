@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+#
+# run.py [--sizes small medium large] [--diversity low high] [--stages <name> ...] [-r <repeat>]
+#        [--min-time <seconds>] [--save-baseline] [--baseline <JSON>] [--threshold <ratio>] [--rss-threshold <ratio>]
+#
+# E.g., python3 run.py                               (small inputs, compared with baseline.json)
+#       python3 run.py --sizes small medium --save-baseline
+#       python3 run.py --stages ja4_batch ja4_stream -r 9 --threshold 0.1
+#
+# Reproducible benchmarks of the pipeline stages on synthetic inputs (generate.py, written once into
+# --data and reused). Every stage runs in its own Python process, so the peak RSS of one stage is not
+# hidden by another one; the process runs the stage once as warm-up and then --repeat times, or more
+# times until the timed runs add up to --min-time, so sub-second stages get enough samples. The
+# caches of the stage (fingerprint LRU caches, ja4x caches, lru_cache of ja4ts) are emptied before
+# every run, so each run is the cost of processing the input once.
+#
+# --save-baseline writes the results into --baseline. Otherwise, if the baseline exists, each result is
+# compared with it: the run fails (exit status 1) if a stage is more than --threshold slower (0.25: 25%),
+# or if the memory of the stage grows more than --rss-threshold (and RSS_SLACK_MB) over the baseline.
+# The speed of a shared or virtual machine drifts by tens of percent from one minute to the next, so
+# a fixed pure-Python workload (reference()) is timed right before every run of a stage, and the
+# time compared is the median run time over the median reference time: a slower machine slows
+# down both. The memory of a stage is the peak RSS of its process minus the RSS after the
+# setup (imports and loading of the inputs), which dominates the peak of the short stages. Times are
+# only comparable on the same machine, the baseline records the machine it was measured on. Only the
+# standard library, NumPy and the repo are needed: no tshark, scapy or network.
+#
+
+import io
+import os
+import sys
+import json
+import time
+import hashlib
+import platform
+import argparse
+import resource
+import statistics
+import subprocess
+from contextlib import redirect_stdout
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, os.pardir)
+for path in ("tools", os.path.join("tools", "ja4"), os.path.join("tools", "maldist")):
+    sys.path.insert(0, os.path.join(ROOT, path))
+
+SIZES = {"small": {"flows": 500, "rows": 20000},
+         "medium": {"flows": 5000, "rows": 200000},
+         "large": {"flows": 50000, "rows": 2000000}}
+DIVERSITY = {"low": 10, "high": 1000}       # distinct hello/certificate/option templates
+MAX_REPEAT = 200
+RSS_SLACK_MB = 2.0          # smaller growths of the stage memory are allocator noise
+
+
+# --- stages: setup(data dir, work dir) returns (run function, number of items, unit) ----------------
+
+def count_packets(pcap):
+    from pcapio import open_capture, iter_records
+    with open_capture(pcap) as f:
+        return sum(1 for _ in iter_records(f))
+
+
+def stage_pcap_ja4(data, work):
+    from pcap_ja4 import process_pcap
+    import ja4x
+    pcap = os.path.join(data, "capture.pcap")
+
+    def run():
+        ja4x.rdn_cache.clear()
+        ja4x.ext_cache.clear()
+        process_pcap(pcap, os.path.join(work, "extracted.csv"), os.path.join(work, "ja4x.csv"), os.path.join(work, "ja4ts.csv"))
+    return run, count_packets(pcap), "packets"
+
+
+def extracted_rows(data):
+    with open(os.path.join(data, "extracted.csv")) as f:
+        return sum(1 for _ in f) - 1
+
+
+def stage_ja4_batch(data, work):
+    import ja4
+    from fpcache import LRUCache
+
+    def run():
+        db = ja4.process_tls_file(os.path.join(data, "extracted.csv"), short=True, cache=LRUCache(65536), db={}, side_files=(None, None, None))
+        with open(os.path.join(work, "ja4.csv"), "w") as out:
+            ja4.write_tls_db(db, True, out)
+    return run, extracted_rows(data), "rows"
+
+
+def stage_ja4_stream(data, work):
+    import ja4
+    from fpcache import LRUCache
+
+    def run():
+        with open(os.path.join(work, "ja4.csv"), "w") as out:
+            ja4.print_header(True, out)
+            ja4.stream_tls_file(os.path.join(data, "extracted.csv"), out, short=True, cache=LRUCache(65536))
+    return run, extracted_rows(data), "rows"
+
+
+def stage_ja4x(data, work):
+    import ja4x
+    from pcapio import read_packets
+    from pcap_ja4 import Ja4Engine
+    engine = Ja4Engine()
+    certs = [entry for pkt in read_packets(os.path.join(data, "capture.pcap")) for kind, entry in engine.packet(pkt) if kind == "cert"]
+
+    def run():
+        ja4x.rdn_cache.clear()
+        ja4x.ext_cache.clear()
+        for entry in certs:         # to_ja4x consumes the lists of the entry, it gets a copy
+            ja4x.ja4x_row(ja4x.to_ja4x({k: list(v) if isinstance(v, list) else v for k, v in entry.items()}))
+    return run, len(certs), "certificates"
+
+
+def stage_ja4ts(data, work):
+    import itertools
+    import ja4ts
+    from pcapio import read_packets
+    from pcap_ja4 import syn_ack_options
+    synacks = [(str(pkt.window), pkt.options) for pkt in read_packets(os.path.join(data, "capture.pcap"))
+               if pkt.proto == 6 and pkt.flags & 0x12 == 0x12]
+    synacks = list(itertools.islice(itertools.cycle(synacks), extracted_rows(data)))     # as many as the CSV rows
+
+    def run():
+        ja4ts.parse_tcp_options_raw.cache_clear()
+        for window, options in synacks:
+            mss, wscale = syn_ack_options(options)
+            ja4ts.ja4ts_fingerprint(window, options.hex(), mss, wscale)
+    return run, len(synacks), "SYN-ACKs"
+
+
+def stage_maldist_extract(data, work):
+    from extract_features import find_sessions, extract
+    sessions = find_sessions(os.path.join(data, "sessions"))
+
+    def run():
+        extract((sessions, 1, 2))
+    return run, len(sessions), "sessions"
+
+
+def stage_maldist_split(data, work):
+    from split_sessions import pcap_features
+    pcap = os.path.join(data, "capture.pcap")
+
+    def run():
+        pcap_features(pcap, os.path.join(work, "features.csv"))
+    return run, count_packets(pcap), "packets"
+
+
+def stage_flow_tracker(data, work):
+    from flow_tracker import track_flows
+    pcap = os.path.join(data, "capture.pcap")
+
+    def run():
+        track_flows(pcap, os.path.join(work, "features.csv"))
+    return run, count_packets(pcap), "packets"
+
+
+def stage_join(data, work):
+    from join import join_files
+    files = [os.path.join(data, name) for name in ("ja4.csv", "ja4x.csv", "ja4ts.csv")]
+
+    def run():
+        join_files(files, os.path.join(work, "joined.csv"))
+    return run, extracted_rows(data), "rows"
+
+
+# name -> (setup, depends on the diversity of the inputs)
+STAGES = {
+    "pcap_ja4": (stage_pcap_ja4, True),
+    "ja4_batch": (stage_ja4_batch, True),
+    "ja4_stream": (stage_ja4_stream, True),
+    "ja4x": (stage_ja4x, True),
+    "ja4ts": (stage_ja4ts, True),
+    "maldist_extract": (stage_maldist_extract, False),
+    "maldist_split": (stage_maldist_split, False),
+    "flow_tracker": (stage_flow_tracker, False),
+    "join": (stage_join, False),
+}
+
+
+# --- child process -----------------------------------------------------------------------------
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024     # bytes on macOS, KiB on Linux
+
+
+def reference():
+    """Fixed work (hashing, string formatting, dicts and sorting, like the stages) that measures the machine speed."""
+    values = {}
+    for i in range(60000):
+        key = f"{i:08x}"
+        values[key] = hashlib.sha256(key.encode()).hexdigest()[:12]
+    return sorted(values.values())
+
+
+def child(stage, data, work, repeat, min_time):
+    """Runs one stage and prints its measurements as JSON."""
+    os.makedirs(work, exist_ok=True)
+    with redirect_stdout(io.StringIO()):
+        run, items, unit = STAGES[stage][0](data, work)
+        setup_rss = peak_rss_mb()
+        start = time.perf_counter()
+        run()                                   # warm-up
+        warmup = time.perf_counter() - start
+        repeat = max(repeat, min(MAX_REPEAT, int(min_time / max(warmup, 1e-6)) + 1))
+        seconds, reference_seconds = [], []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            reference()
+            reference_seconds.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            run()
+            seconds.append(time.perf_counter() - start)
+    print(json.dumps({"seconds": seconds, "reference_seconds": reference_seconds, "items": items, "unit": unit, "setup_rss_mb": round(setup_rss, 1), "peak_rss_mb": round(peak_rss_mb(), 1)}))
+
+
+# --- parent ------------------------------------------------------------------------------------
+
+def machine():
+    cpu = platform.processor()
+    try:
+        with open("/proc/cpuinfo") as f:
+            cpu = next((line.split(":", 1)[1].strip() for line in f if line.startswith("model name")), cpu)
+    except OSError:
+        pass
+    return {"platform": platform.platform(), "python": platform.python_version(), "cpu": cpu, "cpus": os.cpu_count()}
+
+
+def measure(stage, size, diversity, datadir, repeat, min_time, seed=0):
+    from generate import generate
+    name = f"{size}-{diversity}"
+    data = generate(os.path.join(datadir, f"{name}-{seed}"), SIZES[size]["flows"], SIZES[size]["rows"], DIVERSITY[diversity], seed)
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", stage, data, os.path.join(data, "work"), "-r", str(repeat), "--min-time", str(min_time)],
+                          stdout=subprocess.PIPE, check=True, text=True)
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    median = statistics.median(result["seconds"])
+    return {"seconds": round(median, 6), "throughput": round(result["items"] / median, 1), "unit": result["unit"], "items": result["items"],
+            "min_seconds": round(min(result["seconds"]), 6), "runs": len(result["seconds"]),
+            "relative": round(median / statistics.median(result["reference_seconds"]), 4),
+            "setup_rss_mb": result["setup_rss_mb"], "peak_rss_mb": result["peak_rss_mb"]}
+
+
+def stage_rss(result):
+    """Memory of the stage itself: peak RSS minus the RSS after its imports and inputs."""
+    return max(result["peak_rss_mb"] - result["setup_rss_mb"], 0.0)
+
+
+def compare(results, baseline, threshold, rss_threshold):
+    """Prints the results with their change from the baseline; returns the names of the regressions.
+
+    Times are compared relative to the reference workload, memory by the growth of the stage
+    (stage_rss), not the peak RSS of the process.
+    """
+    regressions = []
+    print(f"{'benchmark':<30} {'time (s)':>10} {'throughput':>27} {'stage RSS':>11} {'vs. baseline':>22}")
+    for name, r in results.items():
+        base = baseline.get(name)
+        change = ""
+        if base and "relative" in base:
+            dt = r["relative"] / base["relative"] - 1
+            mb, base_mb = stage_rss(r), stage_rss(base)
+            dm = mb / base_mb - 1 if base_mb else float("inf")
+            change = f"{dt:+7.1%} time {mb - base_mb:+7.1f} MB"
+            if dt > threshold or (mb - base_mb > RSS_SLACK_MB and dm > rss_threshold):
+                regressions.append(name)
+                change += "  REGRESSION"
+        elif base:
+            change = "old baseline format, run --save-baseline"
+        print(f"{name:<30} {r['seconds']:>10.4f} {r['throughput']:>12.0f} {r['unit'] + '/s':<14} {stage_rss(r):>8.1f} MB {change}")
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Runs the benchmarks of the pipeline stages on synthetic inputs and compares them with a baseline.")
+    parser.add_argument("--child", nargs=3, metavar=("STAGE", "DATA", "WORK"), help=argparse.SUPPRESS)
+    parser.add_argument("--sizes", nargs="+", choices=list(SIZES), default=["small"], help="Input sizes (default: small)")
+    parser.add_argument("--diversity", nargs="+", choices=list(DIVERSITY), default=list(DIVERSITY), help="Fingerprint diversity of the inputs")
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES), default=list(STAGES), help="Stages to run (default: all)")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="Min. number of timed runs of each stage")
+    parser.add_argument("--min-time", type=float, default=2.0, help="Min. total time of the timed runs of a stage, in seconds (default: 2)")
+    parser.add_argument("--data", default=os.path.join(HERE, "data"), help="Directory of the generated inputs")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the generated inputs")
+    parser.add_argument("--baseline", default=os.path.join(HERE, "baseline.json"), help="Baseline file (JSON)")
+    parser.add_argument("--save-baseline", action="store_true", help="Save the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.25, help="Max. relative increase of the time (default: 0.25)")
+    parser.add_argument("--rss-threshold", type=float, default=0.2, help="Max. relative increase of the stage memory (default: 0.2)")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.child:
+        child(*args.child, args.repeat, args.min_time)
+        sys.exit(0)
+
+    sys.path.insert(0, HERE)
+    results = {}
+    for size in args.sizes:
+        for diversity in args.diversity:
+            for stage in args.stages:
+                if not STAGES[stage][1] and diversity != args.diversity[0]:
+                    continue        # same input at every diversity level
+                name = f"{stage}[{size}-{diversity}]" if STAGES[stage][1] else f"{stage}[{size}]"
+                print(f"Running {name}...", file=sys.stderr)
+                results[name] = measure(stage, size, diversity, args.data, args.repeat, args.min_time, args.seed)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            saved = json.load(f)
+        baseline = saved["results"]
+        if not args.save_baseline and saved.get("machine") != machine():
+            print(f"Warning: the baseline was measured on another machine ({saved.get('machine')})", file=sys.stderr)
+    regressions = compare(results, {} if args.save_baseline else baseline, args.threshold, args.rss_threshold)
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump({"machine": machine(), "repeat": args.repeat, "min_time": args.min_time, "seed": args.seed, "results": dict(sorted(baseline.items()))}, f, indent=1)
+            f.write("\n")
+        print(f"Baseline saved into {args.baseline}", file=sys.stderr)
+    elif regressions:
+        print(f"{len(regressions)} regressions above the thresholds: {', '.join(regressions)}", file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+#
+# dataset_cache.py [<preset> ...] [--cache-dir <DIR>] [--list] [--rebuild]
+#
+# E.g., python3 dataset_cache.py ja4 maldist-balanced
+#       from dataset_cache import load_preset; ja4 = load_preset("ja4"); ja4.X, ja4.y, ja4.classes
+#
+# The notebooks read the same CSVs on every run, drop the same families, label and concatenate
+# them and hash JA4hash/JA4Shash with FeatureHasher(n_features=1024) again. The builders of this
+# module do that once and keep the result on disk, in <cache DIR>/<key>/:
+#   X.npz       JA4 datasets: hashed fingerprints (scipy.sparse CSR, uncompressed)
+#   X.npy       MalDIST datasets: feature matrix (float64), loaded as a read-only memmap
+#   y.npy       labels, encoded like LabelEncoder (indices into classes)
+#   meta.json   classes, columns, inputs and build parameters
+# The key is the SHA-256 of the build parameters and of the SHA-256 of every input file, so a
+# changed CSV gives another key and the dataset is built again; the entry of the old inputs is
+# removed when a dataset with the same name is rebuilt. The digest of an input is only computed
+# again when its size or mtime change (digests.json), so a hit costs a few stat() calls and the
+# load of the arrays. Inputs may be CSV or Parquet (tools/columnar.py).
+#
+# The presets reproduce the datasets of the notebooks (paths relative to model/):
+#   ja4                ja4_model.ipynb: desktop malware (DM) and apps (DA), 5 families dropped
+#   ja4-hybrid         hybrid.ipynb / inference_times.ipynb: the same with 3 families dropped
+#   maldist            maldist_model.ipynb: MalDIST_Dataset.csv, y = label
+#   maldist-balanced   hybrid.ipynb / inference_times.ipynb: Maldist_balanced1.csv, y = label
+#
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from sklearn.feature_extraction import FeatureHasher
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "tools"))
+from columnar import read_table
+from verdict_cache import file_digest, JA4_FIELDS, N_FEATURES
+
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache")
+FORMAT = 1          # version of the entries, change it when the builders change
+
+Source = namedtuple("Source", "path label drop", defaults=((),))   # drop: AppName values removed from this file
+Dataset = namedtuple("Dataset", "X y classes columns key")
+
+JA4_DIR = "../Datasets/JA4/Dataset2"
+DESKTOP_APPS = [Source(f"{JA4_DIR}/desktop-apps.csv", "DA"), Source("../Datasets/JA4/Dataset1/Benign.csv", "DA"),
+                Source(f"{JA4_DIR}/mydesktop-apps.csv", "DA")]
+PRESETS = {
+    "ja4": ("ja4", [Source(f"{JA4_DIR}/desktop-malware.csv", "DM", ("Sodinokibi", "Hawkeye", "Nanocore", "IceID", "Wannacry"))] + DESKTOP_APPS, {}),
+    "ja4-hybrid": ("ja4", [Source(f"{JA4_DIR}/desktop-malware.csv", "DM", ("Sodinokibi", "Hawkeye", "Nanocore"))] + DESKTOP_APPS, {}),
+    "maldist": ("maldist", ["../Datasets/MalDIST/combined/MalDIST_Dataset.csv"], {"drop": ("label", "family", "file_name")}),
+    "maldist-balanced": ("maldist", ["../Datasets/Maldist_balanced1.csv"], {"drop": ("label",)}),
+}
+
+
+def read_frame(path, delimiter):
+    if path.endswith(".parquet") or os.path.isdir(path):
+        return read_table(path)
+    return pd.read_csv(path, sep=delimiter)
+
+
+class DatasetCache:
+    """Datasets built from CSV files, stored under a key of their inputs and parameters."""
+
+    def __init__(self, cache_dir=CACHE_DIR):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self.digests_path = os.path.join(cache_dir, "digests.json")
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.digests = self.read_json(self.digests_path)
+        self.hits = self.misses = 0
+
+    @staticmethod
+    def read_json(path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    @staticmethod
+    def write_json(path, value):
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(value, f, indent=1)
+        os.replace(tmp, path)
+
+    def digest(self, path):
+        """SHA-256 of an input file (a Parquet directory: of its files), recomputed only when it changes."""
+        path = os.path.abspath(path)
+        files = sorted(os.path.join(d, f) for d, _, fs in os.walk(path) for f in fs) if os.path.isdir(path) else [path]
+        stamp = [[os.path.relpath(f, path), st.st_size, st.st_mtime_ns] for f in files for st in [os.stat(f)]]
+        known = self.digests.get(path)
+        if known and known[0] == stamp:
+            return known[1]
+        h = hashlib.sha256()
+        for f, (name, _, _) in zip(files, stamp):
+            h.update(f"{name}\0{file_digest(f)}\0".encode())
+        self.digests[path] = [stamp, h.hexdigest()]
+        self.write_json(self.digests_path, self.digests)
+        return h.hexdigest()
+
+    def key(self, kind, paths, params):
+        spec = {"format": FORMAT, "kind": kind, "params": params, "inputs": [self.digest(p) for p in paths]}
+        return hashlib.sha256(json.dumps(spec, sort_keys=True).encode()).hexdigest()[:32]
+
+    def entry(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key):
+        """The cached dataset of key or None."""
+        entry = self.entry(key)
+        try:
+            with open(os.path.join(entry, "meta.json")) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return None
+        if os.path.exists(os.path.join(entry, "X.npz")):
+            X = scipy.sparse.load_npz(os.path.join(entry, "X.npz"))
+        else:
+            X = np.load(os.path.join(entry, "X.npy"), mmap_mode="r")
+        y = np.load(os.path.join(entry, "y.npy"))
+        return Dataset(X, y, meta["classes"], meta["columns"], key)
+
+    def put(self, name, key, X, y, classes, columns, meta):
+        """Writes the entry (into a temporary directory renamed at the end) and replaces the previous entry of name."""
+        tmp = os.path.join(self.cache_dir, f".{key}.{os.getpid()}.tmp")
+        os.makedirs(tmp, exist_ok=True)
+        if scipy.sparse.issparse(X):
+            scipy.sparse.save_npz(os.path.join(tmp, "X.npz"), X.tocsr(), compressed=False)
+        else:
+            np.save(os.path.join(tmp, "X.npy"), np.ascontiguousarray(X, dtype=np.float64))
+        np.save(os.path.join(tmp, "y.npy"), y)
+        self.write_json(os.path.join(tmp, "meta.json"), dict(meta, name=name, classes=classes, columns=columns, built=time.time()))
+        try:
+            os.rename(tmp, self.entry(key))
+        except OSError:         # built meanwhile by another process
+            shutil.rmtree(tmp, ignore_errors=True)
+        index = self.read_json(self.index_path)
+        old = index.get(name)
+        index[name] = key
+        self.write_json(self.index_path, index)
+        if old and old != key and old not in index.values():
+            shutil.rmtree(self.entry(old), ignore_errors=True)
+        return self.get(key)
+
+    def cached(self, name, kind, paths, params, build):
+        key = self.key(kind, paths, params)
+        dataset = self.get(key)
+        if dataset is not None:
+            self.hits += 1
+            return dataset
+        self.misses += 1
+        X, y, classes, columns = build()
+        return self.put(name, key, X, y, classes, columns, {"kind": kind, "inputs": [os.path.abspath(p) for p in paths], "params": params})
+
+    def ja4(self, sources, fields=JA4_FIELDS, n_features=N_FEATURES, delimiter=";", name=None):
+        """JA4 dataset of the sources (Source: path, label, AppName values to drop), as in ja4_model.ipynb.
+
+        X is FeatureHasher(n_features, input_type='string') of the fields as strings; y encodes the
+        labels like LabelEncoder (classes sorted), rows in the order of the sources.
+        """
+        sources = [Source(*s) for s in sources]
+        params = {"sources": [[s.label, list(s.drop)] for s in sources], "fields": list(fields), "n_features": n_features}
+
+        def build():
+            frames = []
+            for s in sources:
+                df = read_frame(s.path, delimiter)
+                if s.drop:
+                    df = df[~df["AppName"].isin(s.drop)]
+                # empty cells are "nan", as astype(str) gave in the notebooks (pandas 2) and in verdict_cache.ja4_values
+                frames.append(pd.DataFrame({f: df[f].astype(object).where(df[f].notna(), "nan").astype(str) for f in fields})
+                              .assign(label=s.label))
+            df = pd.concat(frames, ignore_index=True)
+            classes, y = np.unique(df["label"].to_numpy(dtype=str), return_inverse=True)
+            X = FeatureHasher(n_features=n_features, input_type='string').transform(df[list(fields)].values.tolist())
+            return X, y.astype(np.int64), classes.tolist(), list(fields)
+
+        return self.cached(name or "ja4-" + "-".join(os.path.basename(s.path) for s in sources), "ja4", [s.path for s in sources], params, build)
+
+    def maldist(self, paths, target="label", drop=("label", "family", "file_name"), delimiter=",", name=None):
+        """MalDIST dataset of the CSV files concatenated: X the columns not in drop, y the target column encoded."""
+        params = {"target": target, "drop": list(drop)}
+
+        def build():
+            df = pd.concat([read_frame(p, delimiter) for p in paths], ignore_index=True)
+            classes, y = np.unique(df[target].to_numpy(), return_inverse=True)
+            features = df.drop(columns=list(drop))
+            return features.to_numpy(dtype=np.float64), y.astype(np.int64), classes.tolist(), list(features.columns)
+
+        return self.cached(name or "maldist-" + "-".join(os.path.basename(p) for p in paths), "maldist", list(paths), params, build)
+
+
+def load_preset(name, cache_dir=CACHE_DIR):
+    """Dataset of a preset (PRESETS), built on the first call; paths are relative to model/."""
+    kind, inputs, params = PRESETS[name]
+    base = os.path.dirname(os.path.abspath(__file__))
+    cache = DatasetCache(cache_dir)
+    if kind == "ja4":
+        return cache.ja4([Source(os.path.join(base, s.path), s.label, s.drop) for s in inputs], name=name, **params)
+    return cache.maldist([os.path.join(base, p) for p in inputs], name=name, **params)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Builds the datasets of the notebooks once and caches them on disk.")
+    parser.add_argument("presets", nargs="*", help=f"Datasets to build or check: {', '.join(PRESETS)}")
+    parser.add_argument("--cache-dir", default=CACHE_DIR, help="Cache directory")
+    parser.add_argument("--list", action="store_true", help="List the cached datasets")
+    parser.add_argument("--rebuild", action="store_true", help="Remove the cached entries of the presets and build them again")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    for name in args.presets:
+        if args.rebuild:
+            key = DatasetCache.read_json(os.path.join(args.cache_dir, "index.json")).get(name)
+            if key:
+                shutil.rmtree(os.path.join(args.cache_dir, key), ignore_errors=True)
+        start = time.time()
+        dataset = load_preset(name, args.cache_dir)
+        print(f"{name}: X {dataset.X.shape}, classes {dataset.classes}, key {dataset.key} ({time.time() - start:.3f} s)")
+    if args.list:
+        for name, key in DatasetCache.read_json(os.path.join(args.cache_dir, "index.json")).items():
+            entry = os.path.join(args.cache_dir, key)
+            size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry)) if os.path.isdir(entry) else 0
+            print(f"{name}\t{key}\t{size / 1e6:.1f} MB")
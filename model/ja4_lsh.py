@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+#
+# ja4_lsh.py [<JA4 CSV> ...] [-i <index .npz>] [-o <index .npz>] [--query <JA4_raw> [<JA4S_raw>]] [-k <top k>] [--benchmark]
+#
+# E.g., python3 ja4_lsh.py ../Datasets/JA4/Dataset2/desktop-malware-long.csv -o models/ja4-lsh.npz
+#       python3 ja4_lsh.py -i models/ja4-lsh.npz --query t13d1516h2_002f,0035,009c_0005,000a,000b_0403,0804 -k 5
+#
+# The JA4 model only knows exact JA4hash values (FeatureHasher), so a malware build that adds one
+# extension looks new. This index finds the known fingerprints most similar to a new one from the
+# raw fingerprints of ja4.py (long output, JA4_raw and JA4S_raw), seen as the set of their cipher
+# suites, extensions and signature algorithms (server cipher and extensions of JA4S_raw apart).
+#
+# MinHash: the signature of a set is the minimum of --num-perm hash functions over its elements,
+# and the fraction of equal signature values of two sets estimates their Jaccard similarity. LSH:
+# the signature is cut into --bands bands; two fingerprints are candidates if one band is equal.
+# The band hashes of all the entries, tagged with their band, are kept in one sorted array, so a
+# query is one np.searchsorted of its --bands hashes plus the comparison of the signatures of
+# the candidates, whatever the size of the index.
+# Fingerprints added one by one (add) are kept apart and compared linearly until --merge-size of
+# them are merged into the sorted array. An entry is a distinct (JA4_raw, JA4S_raw, family).
+#
+# The index is saved with np.savez (no pickle): signatures, band arrays, fingerprints (UTF-8 blob
+# and offsets) and families.
+#
+
+import os
+import sys
+import zlib
+import time
+import hashlib
+import argparse
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "tools"))
+from columnar import read_table
+
+
+PRIME = (1 << 61) - 1
+FAMILY_COLUMN = "AppName"
+BAND_BITS = 6            # top bits of a band hash: its band, so all the bands fit in one sorted array
+FORMAT = 1
+
+
+def raw_tokens(ja4_raw, ja4s_raw=None):
+    """Elements of the fingerprint: ciphers (c), extensions (e), signature algorithms (s) and server cipher/extensions (C, E)."""
+    tokens = set()
+    if isinstance(ja4_raw, str) and ja4_raw:
+        parts = ja4_raw.split("_")
+        for prefix, part in zip("ces", parts[1:4]):
+            tokens.update(prefix + v for v in part.split(",") if v)
+    if isinstance(ja4s_raw, str) and ja4s_raw:
+        parts = ja4s_raw.split("_")
+        for prefix, part in zip("CE", parts[1:3]):
+            tokens.update(prefix + v for v in part.split(",") if v)
+    return tokens
+
+
+class MinHashIndex:
+    """MinHash LSH index of raw JA4/JA4S fingerprints with their family."""
+
+    def __init__(self, num_perm=64, bands=16, seed=1, merge_size=4096, max_bucket=256):
+        if num_perm % bands:
+            raise ValueError(f"num_perm ({num_perm}) must be a multiple of bands ({bands})")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.seed = seed
+        self.merge_size = merge_size
+        self.max_bucket = max_bucket          # candidates taken from one band bucket
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, 1 << 31, num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, 1 << 31, num_perm, dtype=np.uint64)
+        self.mult = rng.integers(1, 1 << 63, self.rows, dtype=np.uint64) | np.uint64(1)
+        if bands > 1 << BAND_BITS:
+            raise ValueError(f"at most {1 << BAND_BITS} bands")
+        self.band_tags = np.arange(bands, dtype=np.uint64) << np.uint64(64 - BAND_BITS)
+        self.token_hash = {}
+        self.n = 0
+        self.sigs = np.zeros((0, num_perm), dtype=np.uint32)
+        self.band_hashes = np.zeros((0, bands), dtype=np.uint64)
+        self.digests = np.zeros(0, dtype=np.uint64)
+        self.family_codes = np.zeros(0, dtype=np.int32)
+        self.families = []
+        self.family_ids = {}
+        self.keys = []                    # fingerprints added since the index was loaded
+        self.blob, self.offsets = b"", np.zeros(1, dtype=np.int64)    # fingerprints loaded
+        self.sorted_keys = np.zeros(0, dtype=np.uint64)     # band hashes of the merged entries (all bands), sorted
+        self.sorted_ids = np.zeros(0, dtype=np.int64)
+        self.merged = 0                   # entries [0, merged) are in the sorted array
+        self.ids = None                   # digest -> entry, built on the first add
+
+    def __len__(self):
+        return self.n
+
+    def signature(self, tokens):
+        """MinHash signature (uint32, num_perm values) of a set of tokens; None for an empty set."""
+        if not tokens:
+            return None
+        hashes = []
+        for t in tokens:
+            h = self.token_hash.get(t)
+            if h is None:
+                h = self.token_hash[t] = zlib.crc32(t.encode())
+            hashes.append(h)
+        x = np.asarray(hashes, dtype=np.uint64)[:, None]
+        return (((self.a * x + self.b) % PRIME).min(axis=0) & 0xFFFFFFFF).astype(np.uint32)
+
+    def band_hash(self, sigs):
+        """Hash of every band of the signatures (n x bands, uint64), with the band number in the top bits."""
+        h = (sigs.reshape(len(sigs), self.bands, self.rows).astype(np.uint64) * self.mult).sum(axis=2)
+        return (h >> np.uint64(BAND_BITS)) | self.band_tags
+
+    def fingerprint(self, i):
+        """(JA4_raw, JA4S_raw) of entry i."""
+        loaded = len(self.offsets) - 1
+        key = self.blob[self.offsets[i]:self.offsets[i + 1]].decode() if i < loaded else self.keys[i - loaded]
+        ja4_raw, ja4s_raw = key.split(";")
+        return ja4_raw, ja4s_raw
+
+    def family(self, i):
+        return self.families[self.family_codes[i]]
+
+    def grow(self, n):
+        if n <= len(self.sigs):
+            return
+        size = max(n, 2 * len(self.sigs), 1024)
+        for name in ("sigs", "band_hashes", "digests", "family_codes"):
+            old = getattr(self, name)
+            new = np.zeros((size,) + old.shape[1:], dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def add(self, ja4_raw, ja4s_raw=None, family=None):
+        """Adds a fingerprint; returns its entry (the existing one if it was added before) or None if it has no elements."""
+        ja4_raw = ja4_raw if isinstance(ja4_raw, str) else ""
+        ja4s_raw = ja4s_raw if isinstance(ja4s_raw, str) else ""
+        family = "" if family is None or family != family else str(family)
+        key = f"{ja4_raw};{ja4s_raw}"
+        digest = int.from_bytes(hashlib.blake2b(f"{key};{family}".encode(), digest_size=8).digest(), "little")
+        if self.ids is None:
+            self.ids = {int(d): i for i, d in enumerate(self.digests[:self.n])}
+        if digest in self.ids:
+            return self.ids[digest]
+        sig = self.signature(raw_tokens(ja4_raw, ja4s_raw))
+        if sig is None:
+            return None
+        code = self.family_ids.get(family)
+        if code is None:
+            code = self.family_ids[family] = len(self.families)
+            self.families.append(family)
+        i = self.n
+        self.grow(i + 1)
+        self.sigs[i] = sig
+        self.band_hashes[i] = self.band_hash(sig[None])[0]
+        self.digests[i] = digest
+        self.family_codes[i] = code
+        self.keys.append(key)
+        self.ids[digest] = i
+        self.n += 1
+        if self.n - self.merged >= self.merge_size:
+            self.merge()
+        return i
+
+    def add_rows(self, df, family_column=FAMILY_COLUMN):
+        """Adds the distinct fingerprints of a DataFrame with JA4_raw, JA4S_raw and the family column; returns the number added."""
+        n = self.n
+        rows = pd.DataFrame({c: df[c] if c in df.columns else None for c in ["JA4_raw", "JA4S_raw", family_column]}).drop_duplicates()
+        for ja4_raw, ja4s_raw, family in rows.itertuples(index=False):
+            self.add(ja4_raw, ja4s_raw, family)
+        self.merge()
+        return self.n - n
+
+    def merge(self):
+        """Moves the entries added one by one into the sorted band array."""
+        if self.merged == self.n:
+            return
+        new_keys = self.band_hashes[self.merged:self.n].ravel()
+        new_ids = np.arange(self.merged, self.n).repeat(self.bands)
+        if self.n - self.merged > self.merged // 4:      # many: sort everything again
+            new_keys = self.band_hashes[:self.n].ravel()
+            order = np.argsort(new_keys, kind="stable")
+            self.sorted_keys, self.sorted_ids = new_keys[order], np.arange(self.n).repeat(self.bands)[order]
+        else:
+            order = np.argsort(new_keys, kind="stable")
+            pos = np.searchsorted(self.sorted_keys, new_keys[order], side="right")
+            self.sorted_keys = np.insert(self.sorted_keys, pos, new_keys[order])
+            self.sorted_ids = np.insert(self.sorted_ids, pos, new_ids[order])
+        self.merged = self.n
+
+    def candidates(self, band_hashes):
+        """Entries with at least one band equal (at most max_bucket per band)."""
+        lo = np.searchsorted(self.sorted_keys, band_hashes, side="left")
+        hi = np.minimum(np.searchsorted(self.sorted_keys, band_hashes, side="right"), lo + self.max_bucket)
+        lengths = hi - lo
+        total = int(lengths.sum())
+        # positions lo[0]..hi[0], lo[1]..hi[1], ... without a loop
+        found = self.sorted_ids[np.repeat(lo - np.cumsum(lengths) + lengths, lengths) + np.arange(total)] if total else np.zeros(0, dtype=np.int64)
+        if self.merged < self.n:        # entries not merged yet
+            pending = self.band_hashes[self.merged:self.n]
+            found = np.concatenate([found, self.merged + np.flatnonzero((pending == band_hashes).any(axis=1))])
+        return np.unique(found)
+
+    def query(self, ja4_raw, ja4s_raw=None, k=5):
+        """Top k entries by estimated Jaccard similarity: [(similarity, JA4_raw, JA4S_raw, family), ...]."""
+        sig = self.signature(raw_tokens(ja4_raw, ja4s_raw))
+        if sig is None:
+            return []
+        cand = self.candidates(self.band_hash(sig[None])[0])
+        if not len(cand):
+            return []
+        sims = (self.sigs[cand] == sig).mean(axis=1)
+        top = np.argsort(-sims, kind="stable")[:k] if len(cand) <= k else np.argpartition(-sims, k)[:k]
+        top = top[np.argsort(-sims[top], kind="stable")]
+        return [(float(sims[t]), *self.fingerprint(cand[t]), self.family(cand[t])) for t in top]
+
+    def save(self, path):
+        self.merge()
+        added = [key.encode() for key in self.keys]
+        offsets = np.concatenate([self.offsets, self.offsets[-1] + np.cumsum([len(k) for k in added], dtype=np.int64)])
+        blob = np.frombuffer(self.blob + b"".join(added), dtype=np.uint8)
+        params = np.array([FORMAT, self.num_perm, self.bands, self.seed], dtype=np.int64)
+        np.savez(path, params=params, sigs=self.sigs[:self.n], band_hashes=self.band_hashes[:self.n], digests=self.digests[:self.n],
+                 family_codes=self.family_codes[:self.n], families=np.asarray(self.families, dtype=str), blob=blob, offsets=offsets,
+                 sorted_keys=self.sorted_keys, sorted_ids=self.sorted_ids)
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        with np.load(path, allow_pickle=False) as f:
+            version, num_perm, bands, seed = (int(v) for v in f["params"])
+            if version != FORMAT:
+                raise ValueError(f"{path}: index format {version}, expected {FORMAT}")
+            index = cls(num_perm, bands, seed, **kwargs)
+            index.n = index.merged = len(f["sigs"])
+            index.sigs, index.band_hashes, index.digests = f["sigs"], f["band_hashes"], f["digests"]
+            index.family_codes = f["family_codes"]
+            index.families = [str(v) for v in f["families"]]
+            index.family_ids = {v: i for i, v in enumerate(index.families)}
+            index.blob, index.offsets = f["blob"].tobytes(), f["offsets"]
+            index.sorted_keys, index.sorted_ids = f["sorted_keys"], f["sorted_ids"]
+        return index
+
+
+def benchmark(index, queries=1000, seed=0):
+    """Latency of queries for fingerprints of the index with one extension added or removed."""
+    rng = np.random.default_rng(seed)
+    times, found = [], 0
+    for i in rng.integers(0, len(index), min(queries, len(index))):
+        ja4_raw, ja4s_raw = index.fingerprint(int(i))
+        parts = ja4_raw.split("_")
+        if len(parts) > 2:
+            exts = [e for e in parts[2].split(",") if e]
+            exts = exts[1:] if exts and rng.random() < 0.5 else exts + [f"{rng.integers(0x10000):04x}"]
+            parts[2] = ",".join(sorted(exts))
+        start = time.perf_counter()
+        result = index.query("_".join(parts), ja4s_raw, 5)
+        times.append(time.perf_counter() - start)
+        found += any(r[1] == ja4_raw and r[2] == ja4s_raw for r in result)
+    times = np.array(times) * 1000
+    print(f"{len(times)} queries over {len(index)} entries: p50 {np.percentile(times, 50):.3f} ms, p99 {np.percentile(times, 99):.3f} ms, "
+          f"original in the top 5: {found / len(times):.1%}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="MinHash LSH index of raw JA4/JA4S fingerprints to find the most similar known ones.")
+    parser.add_argument("inputs", nargs="*", help="JA4 CSV files (ja4.py long output) or Parquet files to add")
+    parser.add_argument("-i", "--index", help="Index file to load (.npz)")
+    parser.add_argument("-o", "--output", help="Index file to save (.npz)")
+    parser.add_argument("-f", "--family-column", default=FAMILY_COLUMN, help="Column of the family")
+    parser.add_argument("--query", nargs="+", metavar="RAW", help="JA4_raw [JA4S_raw] to look up")
+    parser.add_argument("-k", type=int, default=5, help="Number of results")
+    parser.add_argument("--num-perm", type=int, default=64, help="Hash functions of the signature")
+    parser.add_argument("--bands", type=int, default=16, help="LSH bands (num-perm must be a multiple)")
+    parser.add_argument("--merge-size", type=int, default=4096, help="Entries added one by one before they are merged")
+    parser.add_argument("--benchmark", action="store_true", help="Measure the latency of the queries")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.index:
+        index = MinHashIndex.load(args.index, merge_size=args.merge_size)
+    else:
+        index = MinHashIndex(args.num_perm, args.bands, merge_size=args.merge_size)
+    for path in args.inputs:
+        start = time.time()
+        if path.endswith(".parquet"):
+            df = read_table(path, columns=["JA4_raw", "JA4S_raw", args.family_column])
+        else:
+            df = pd.read_csv(path, sep=";", usecols=lambda c: c in ("JA4_raw", "JA4S_raw", args.family_column))
+        n = index.add_rows(df, args.family_column)
+        print(f"{n} fingerprints of {path} added in {time.time() - start:.1f} s ({len(index)} in the index)", file=sys.stderr)
+    if args.output:
+        index.save(args.output)
+        print(f"Saved into {args.output}", file=sys.stderr)
+    if args.query:
+        for sim, ja4_raw, ja4s_raw, family in index.query(args.query[0], args.query[1] if len(args.query) > 1 else None, args.k):
+            print(f"{sim:.3f};{family};{ja4_raw};{ja4s_raw}")
+    if args.benchmark:
+        benchmark(index)
@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+#
+# scoring_daemon.py [--port <port> | --unix <socket>] [--maldist <joblib>] [--ja4 <joblib>] [--hybrid <keras> --scaler <joblib>]
+#                   [--max-batch <rows>] [--max-wait <ms>] [--verdict-table <file>] [--warm <JA4 CSV> ...]
+#
+# E.g., python3 scoring_daemon.py --port 8500
+#       curl -s localhost:8500/ja4 -d '{"rows": [{"JA4hash": "t13d1516h2_8daaf6152771_e5627efa2ab1", "JA4Shash": "t130200_1301_234ea6891581"}]}'
+#       curl -s localhost:8500/stats
+#
+# Long-running scoring service for the models of the notebooks (see inference_times.ipynb): the
+# models are loaded once and kept warm, and the requests of concurrent clients are scored together
+# in micro-batches of up to --max-batch rows, waiting at most --max-wait ms for more requests.
+#
+# Models (a model whose file does not exist is not served):
+#   maldist  RandomForest of maldist_model.ipynb, rows with the MalDIST features (preprocesing_oneF.COLUMNS)
+#   ja4      RandomForest of ja4_model.ipynb, rows with JA4hash and JA4Shash, hashed with
+#            FeatureHasher(n_features=1024, input_type='string') as in the notebook; the verdicts of the
+#            fingerprint pairs already seen are kept (verdict_cache.py), so only new pairs are scored
+#   hybrid   Keras model of hybrid.ipynb, rows with both; the MalDIST features are standardized with
+#            --scaler (the StandardScaler of the notebook saved with joblib)
+#
+# A row is a JSON object with the CSV column names (other keys, like file_name, are ignored) or a
+# list with the values in the order of the model. Missing values are NaN for MalDIST and "nan" for
+# JA4 (what pandas' astype(str) gives for empty cells).
+#
+# HTTP (--port, localhost):  POST /<model> {"rows": [...]}  ->  {"labels": [...], "probabilities": [...], "batch": N, "latency_ms": T}
+#                            GET /stats (latency of the last requests per model), GET /health
+# Unix socket (--unix):      one JSON request per line, {"model": "<model>", "rows": [...]} or {"stats": true},
+#                            one JSON response per line
+#
+
+import os
+import sys
+import json
+import time
+import queue
+import signal
+import argparse
+import threading
+import warnings
+import socketserver
+from collections import deque
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+import joblib
+from sklearn.feature_extraction import FeatureHasher
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "tools", "maldist"))
+from preprocesing_oneF import COLUMNS
+from flat_forest import FlatForest
+from verdict_cache import VerdictCache, ja4_values, JA4_FIELDS, JA4_CLASSES, N_FEATURES
+
+
+MALDIST_FEATURES = COLUMNS[3:]              # sin file_name, label y family, como en maldist_model.ipynb
+
+# the forests were fitted on DataFrames, rows are scored as arrays in the same column order
+warnings.filterwarnings("ignore", message="X does not have valid feature names")
+
+
+class LatencyStats:
+    """Latencies (ms) of the last requests of a model."""
+
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=window)
+        self.requests = 0
+        self.rows = 0
+        self.batches = 0
+
+    def add(self, latency, rows):
+        with self.lock:
+            self.latencies.append(latency)
+            self.requests += 1
+            self.rows += rows
+
+    def report(self):
+        with self.lock:
+            values = sorted(self.latencies)
+            requests, rows, batches = self.requests, self.rows, self.batches
+        report = {"requests": requests, "rows": rows, "batches": batches}
+        if values:
+            for name, q in (("p50_ms", 0.5), ("p90_ms", 0.9), ("p99_ms", 0.99)):
+                report[name] = round(values[min(len(values) - 1, int(q * len(values)))], 3)
+            report["max_ms"] = round(values[-1], 3)
+            report["mean_ms"] = round(sum(values) / len(values), 3)
+        return report
+
+
+class MicroBatcher:
+    """Scores the rows of concurrent requests together in one thread.
+
+    predict(rows) returns (labels, probabilities) for a list of rows. A batch is closed when it
+    has max_batch rows or max_wait seconds after its first request; a request is never split.
+    """
+
+    def __init__(self, name, predict, max_batch=256, max_wait=0.005):
+        self.name = name
+        self.predict = predict
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.stats = LatencyStats()
+        threading.Thread(target=self.run, name=f"batcher-{name}", daemon=True).start()
+
+    def submit(self, rows):
+        future = Future()
+        self.requests.put((rows, future))
+        return future
+
+    def score(self, rows):
+        """Scores the rows of one request, blocks until its batch is done; returns the response dict."""
+        start = time.perf_counter()
+        labels, probabilities, batch = self.submit(rows).result()
+        latency = (time.perf_counter() - start) * 1000
+        self.stats.add(latency, len(rows))
+        return {"model": self.name, "labels": labels, "probabilities": probabilities, "batch": batch, "latency_ms": round(latency, 3)}
+
+    def run(self):
+        pending = None
+        while True:
+            batch = [pending or self.requests.get()]
+            pending = None
+            size = len(batch[0][0])
+            deadline = time.monotonic() + self.max_wait
+            while size < self.max_batch:
+                try:
+                    item = self.requests.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if size + len(item[0]) > self.max_batch:
+                    pending = item          # first request of the next batch
+                    break
+                batch.append(item)
+                size += len(item[0])
+            self.score_batch(batch, size)
+
+    def score_batch(self, batch, size):
+        rows = [row for request_rows, _ in batch for row in request_rows]
+        try:
+            labels, probabilities = self.predict(rows) if rows else ([], [])
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+                return
+            # a malformed request must not fail the others: each one is scored again on its own
+            for request_rows, future in batch:
+                self.score_batch([(request_rows, future)], len(request_rows))
+            return
+        with self.stats.lock:
+            self.stats.batches += 1
+        pos = 0
+        for request_rows, future in batch:
+            n = len(request_rows)
+            future.set_result((labels[pos:pos + n], probabilities[pos:pos + n], size))
+            pos += n
+
+
+def maldist_matrix(rows, features=MALDIST_FEATURES):
+    """MalDIST feature matrix of the rows (dicts by column name or lists in model order)."""
+    X = np.full((len(rows), len(features)), np.nan)
+    for i, row in enumerate(rows):
+        if isinstance(row, dict):
+            X[i] = [np.nan if row.get(f) in (None, "") else row[f] for f in features]
+        else:
+            if len(row) != len(features):
+                raise ValueError(f"expected {len(features)} MalDIST features, got {len(row)}")
+            X[i] = [np.nan if v in (None, "") else v for v in row]
+    return X
+
+
+def decode(proba, classes):
+    """(labels, probabilities) of a probability matrix."""
+    labels = [classes[i] for i in np.argmax(proba, axis=1)]
+    return labels, np.round(proba, 6).tolist()
+
+
+def as_json(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+
+class Models:
+    """The models loaded once at startup, with their micro-batchers."""
+
+    def __init__(self, maldist=None, ja4=None, hybrid=None, scaler=None, ja4_classes=JA4_CLASSES, max_batch=256, max_wait=0.005,
+                 verdict_cache_size=1 << 20, flat_max_batch=256):
+        self.hasher = FeatureHasher(n_features=N_FEATURES, input_type='string')
+        self.ja4_classes = ja4_classes
+        self.batchers = {}
+
+        if maldist:
+            self.maldist = joblib.load(maldist)
+            self.maldist_features = list(getattr(self.maldist, "feature_names_in_", MALDIST_FEATURES))
+            # small batches: flat arrays (same predictions, without sklearn's fixed cost per call)
+            self.maldist_flat = FlatForest.from_sklearn(self.maldist) if flat_max_batch > 0 and hasattr(self.maldist, "estimators_") else None
+            self.flat_max_batch = flat_max_batch
+            self.batchers["maldist"] = MicroBatcher("maldist", self.predict_maldist, max_batch, max_wait)
+        self.verdicts = None
+        if ja4:
+            if verdict_cache_size > 0:
+                # the forest only sees the fingerprint pair: known pairs are not scored again
+                self.verdicts = VerdictCache(ja4, verdict_cache_size)
+            else:
+                self.ja4 = joblib.load(ja4)
+            self.batchers["ja4"] = MicroBatcher("ja4", self.predict_ja4, max_batch, max_wait)
+        if hybrid:
+            from tensorflow.keras.models import load_model     # only needed for the hybrid model
+            self.hybrid = load_model(hybrid)
+            self.scaler = joblib.load(scaler) if scaler else None
+            if self.scaler is None:
+                print("Warning: no --scaler, the MalDIST features of the hybrid model are not standardized", file=sys.stderr)
+            self.batchers["hybrid"] = MicroBatcher("hybrid", self.predict_hybrid, max_batch, max_wait)
+
+    def predict_maldist(self, rows):
+        X = maldist_matrix(rows, self.maldist_features)
+        if self.maldist_flat is not None and len(rows) <= self.flat_max_batch:
+            proba = self.maldist_flat.predict_proba(X)
+        else:
+            proba = self.maldist.predict_proba(X)
+        return decode(proba, [as_json(c) for c in self.maldist.classes_])
+
+    def predict_ja4(self, rows):
+        if self.verdicts is not None:
+            proba = np.array(self.verdicts.lookup(rows)).reshape(len(rows), -1)
+            classes = self.verdicts.classes
+        else:
+            proba = self.ja4.predict_proba(self.hasher.transform(ja4_values(rows)))
+            classes = self.ja4.classes_
+        return decode(proba, [self.ja4_classes[c] if isinstance(c, (int, np.integer)) and c < len(self.ja4_classes) else as_json(c)
+                              for c in classes])
+
+    def predict_hybrid(self, rows):
+        X_ja4 = self.hasher.transform(ja4_values(rows)).toarray()
+        X_maldist = maldist_matrix(rows)
+        if self.scaler is not None:
+            X_maldist = self.scaler.transform(X_maldist)
+        proba = np.asarray(self.hybrid.predict([X_ja4, X_maldist], verbose=0))
+        return decode(proba, self.ja4_classes)
+
+    def warm_up(self):
+        """Scores one empty row with every model, so the first request does not pay the lazy initializations."""
+        for name, batcher in self.batchers.items():
+            row = dict.fromkeys(MALDIST_FEATURES, 0.0)
+            row.update(dict.fromkeys(JA4_FIELDS, ""))
+            batcher.predict([row])
+
+    def handle(self, request):
+        """Response dict of a request dict ({"model": ..., "rows": [...]} or {"stats": true})."""
+        if request.get("stats"):
+            return self.stats()
+        name = request.get("model")
+        if name not in self.batchers:
+            raise KeyError(f"unknown model {name!r}, served models: {', '.join(self.batchers)}")
+        rows = request.get("rows")
+        if rows is None:
+            rows = [request["row"]] if "row" in request else []
+        if not isinstance(rows, list):
+            raise ValueError("rows must be a list")
+        return self.batchers[name].score(rows)
+
+    def stats(self):
+        stats = {name: batcher.stats.report() for name, batcher in self.batchers.items()}
+        if self.verdicts is not None:
+            stats["ja4"]["verdict_cache"] = dict(self.verdicts.cache.stats(), reloads=self.verdicts.reloads)
+        return stats
+
+
+def http_handler(models, verbose=False):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"      # keep-alive: a client can send many requests on one connection
+
+        def reply(self, code, body):
+            data = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self.reply(200, models.stats())
+            elif self.path == "/health":
+                self.reply(200, {"models": list(models.batchers)})
+            else:
+                self.reply(404, {"error": f"unknown path {self.path}"})
+
+        def do_POST(self):
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length) or b"{}")
+                if not isinstance(request, dict):
+                    request = {"rows": request}
+                request["model"] = self.path.strip("/")
+                self.reply(200, models.handle(request))
+            except KeyError as e:
+                self.reply(404, {"error": str(e.args[0])})
+            except Exception as e:
+                self.reply(400, {"error": f"{type(e).__name__}: {e}"})
+
+        def log_message(self, format, *args):
+            if verbose:
+                super().log_message(format, *args)
+
+    return Handler
+
+
+def unix_handler(models):
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                try:
+                    response = models.handle(json.loads(line))
+                except KeyError as e:
+                    response = {"error": str(e.args[0])}
+                except Exception as e:
+                    response = {"error": f"{type(e).__name__}: {e}"}
+                self.wfile.write(json.dumps(response).encode() + b"\n")
+                self.wfile.flush()
+
+    return Handler
+
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Scoring service that keeps the MalDIST, JA4 and hybrid models loaded and scores requests in micro-batches.")
+    parser.add_argument("--port", type=int, help="Listen on localhost:<port> (HTTP)")
+    parser.add_argument("--host", default="127.0.0.1", help="HTTP address (default: 127.0.0.1)")
+    parser.add_argument("--unix", help="Listen on this Unix socket (JSON lines)")
+    parser.add_argument("--maldist", default="models/maldist.joblib", help="MalDIST RandomForest (joblib)")
+    parser.add_argument("--ja4", default="models/ja4.joblib", help="JA4 RandomForest (joblib)")
+    parser.add_argument("--hybrid", default="models/hybrid_model.keras", help="Hybrid Keras model (needs TensorFlow)")
+    parser.add_argument("--scaler", default=None, help="StandardScaler of the MalDIST input of the hybrid model (joblib)")
+    parser.add_argument("--ja4-classes", default=",".join(JA4_CLASSES), help="Class names of the JA4 and hybrid models, in LabelEncoder order")
+    parser.add_argument("--verdict-cache-size", type=int, default=1 << 20, help="Max. JA4 fingerprint pairs whose verdict is kept (0 disables the cache)")
+    parser.add_argument("--verdict-table", help="Verdict table file (verdict_cache.py) loaded at startup and saved at exit")
+    parser.add_argument("--warm", nargs="*", default=[], help="JA4 CSV files whose fingerprint pairs are scored at startup")
+    parser.add_argument("--flat-max-batch", type=int, default=256, help="MalDIST batches up to this size are scored with flat_forest.py (0: always sklearn)")
+    parser.add_argument("--max-batch", type=int, default=256, help="Max. rows scored together (default: 256)")
+    parser.add_argument("--max-wait", type=float, default=5.0, help="Max. ms a request waits for others to fill its batch (default: 5)")
+    parser.add_argument("--verbose", action="store_true", help="Log every HTTP request")
+    args = parser.parse_args()
+    if not args.port and not args.unix:
+        parser.error("use --port and/or --unix")
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    paths = {name: getattr(args, name) for name in ("maldist", "ja4", "hybrid")}
+    for name, path in paths.items():
+        if path and not os.path.exists(path):
+            print(f"{name}: {path} not found, model not served", file=sys.stderr)
+            paths[name] = None
+
+    start = time.time()
+    models = Models(paths["maldist"], paths["ja4"], paths["hybrid"], args.scaler, args.ja4_classes.split(","),
+                    args.max_batch, args.max_wait / 1000, args.verdict_cache_size,
+                    args.flat_max_batch)
+    if not models.batchers:
+        print("No models to serve", file=sys.stderr)
+        sys.exit(1)
+    if models.verdicts is not None:
+        if args.verdict_table:
+            print(f"{models.verdicts.load(args.verdict_table)} JA4 verdicts loaded from {args.verdict_table}", file=sys.stderr)
+        if args.warm:
+            print(f"{models.verdicts.warm(args.warm)} JA4 fingerprint pairs scored", file=sys.stderr)
+    models.warm_up()
+    print(f"Models {', '.join(models.batchers)} loaded in {time.time() - start:.1f} s", file=sys.stderr)
+
+    servers = []
+    if args.port:
+        servers.append(ThreadingHTTPServer((args.host, args.port), http_handler(models, args.verbose)))
+        print(f"Listening on http://{args.host}:{args.port}/", file=sys.stderr)
+    if args.unix:
+        if os.path.exists(args.unix):
+            os.unlink(args.unix)
+        servers.append(UnixServer(args.unix, unix_handler(models)))
+        print(f"Listening on {args.unix}", file=sys.stderr)
+
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    threads = [threading.Thread(target=server.serve_forever, daemon=True) for server in servers]
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+        if args.unix and os.path.exists(args.unix):
+            os.unlink(args.unix)
+        if models.verdicts is not None and args.verdict_table:
+            models.verdicts.save(args.verdict_table)
+        print(json.dumps(models.stats()), file=sys.stderr)
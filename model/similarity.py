@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+#
+# similarity.py <JA4 CSV or Parquet> [--against <JA4 CSV or Parquet>] [-c <column> ...] [-g <group column>] [-m overlap|jaccard] [-o <output CSV>]
+#
+# E.g., python3 similarity.py ../Datasets/JA4/Dataset2/desktop-malware.csv -c JA4hash JA4Shash -o malware_families_JA4_JA4S.csv
+#       python3 similarity.py ../Datasets/JA4/Dataset2/desktop-malware.csv --against ../Datasets/JA4/Dataset2/desktop-apps.csv -c JA4hash JA4X
+#
+# Similarity of the fingerprint sets of the families (AppName) of heatmaps.ipynb. The fingerprint
+# of a row is the values of the columns as strings joined by "_" (JA4hash, JA4hash_JA4Shash,
+# JA4hash_JA4X, ...). Instead of comparing the sets of every pair of families in Python, the
+# families are the rows of a sparse family x fingerprint incidence matrix M (1 if the family has
+# the fingerprint), and M @ M.T gives the number of common fingerprints of all the pairs at once;
+# its diagonal is the number of fingerprints of each family. Metrics:
+#   overlap   |A & B| / (|A| + |B|), the one of the notebook
+#   jaccard   |A & B| / |A | B|
+# The product only has entries for the pairs with common fingerprints, so the result is sparse
+# and thousands of families (or app names) fit in memory; similarity_frame() gives the dense
+# DataFrame for sns.heatmap.
+#
+# With --against (other= in similarity_frame()), the groups of the first input are compared with
+# those of the second one, the malware families x app families matrices of the notebook: the
+# fingerprints of both inputs are numbered together, so the columns of their incidence matrices
+# A and B match, and A @ B.T gives the common fingerprints of every (malware, app) pair.
+#
+
+import os
+import sys
+import argparse
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "tools"))
+from columnar import read_table
+
+
+METRICS = ["overlap", "jaccard"]
+
+
+def as_str(values):
+    """Values as strings with "nan" for the empty cells, as astype(str) gave in the notebook (pandas 2)."""
+    return values.astype(object).where(values.notna(), "nan").astype(str)
+
+
+def fingerprints(df, columns, sep="_"):
+    """Fingerprint of every row: the columns as strings joined by sep, like df["JA4hash"].astype(str) + "_" + ..."""
+    values = as_str(df[columns[0]])
+    for column in columns[1:]:
+        values = values + sep + as_str(df[column])
+    return values
+
+
+def incidence(df, columns=("JA4hash",), group="AppName"):
+    """(M, groups, fingerprints): the sparse group x fingerprint matrix (1 if the group has the fingerprint)."""
+    (M,), (groups,), prints = incidences([df], columns, group)
+    return M, groups, prints
+
+
+def incidences(frames, columns=("JA4hash",), group="AppName"):
+    """([M, ...], [groups, ...], fingerprints): incidence matrices of several frames over the same fingerprint columns."""
+    frames = [df[df[group].notna()] for df in frames]
+    cols, prints = pd.factorize(pd.concat([fingerprints(df, list(columns)) for df in frames], ignore_index=True))
+    matrices, groups = [], []
+    start = 0
+    for df in frames:
+        rows, names = pd.factorize(df[group], sort=True)        # sorted like groupby
+        M = scipy.sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols[start:start + len(rows)])),
+                                    shape=(len(names), len(prints)))
+        M.data[:] = 1      # duplicated (group, fingerprint) pairs were added up
+        matrices.append(M)
+        groups.append(list(names))
+        start += len(rows)
+    return matrices, groups, list(prints)
+
+
+def similarity(M, metric="overlap", N=None):
+    """Sparse matrix with the similarity of the fingerprint sets of every row of M and every row of N (default: M),
+    0 if nothing in common; M and N must have the same fingerprint columns (incidences())."""
+    if N is None:
+        N = M
+    common = (M @ N.T).tocoo()
+    a = np.asarray(M.sum(axis=1)).ravel()[common.row]
+    b = np.asarray(N.sum(axis=1)).ravel()[common.col]
+    if metric == "overlap":
+        total = a + b
+    elif metric == "jaccard":
+        total = a + b - common.data
+    else:
+        raise ValueError(f"unknown metric {metric} (one of {', '.join(METRICS)})")
+    values = np.divide(common.data, total, out=np.zeros(len(common.data)), where=total > 0)
+    return scipy.sparse.csr_matrix((values, (common.row, common.col)), shape=common.shape)
+
+
+def similarity_frame(df, columns=("JA4hash",), group="AppName", metric="overlap", other=None):
+    """Dense DataFrame group x group with the similarity of their fingerprints (df_similitud_* of heatmaps.ipynb);
+    with other, the groups of df (rows) against those of other (columns), e.g. malware families x apps."""
+    if other is None:
+        M, groups, _ = incidence(df, columns, group)
+        return pd.DataFrame(similarity(M, metric).toarray(), index=groups, columns=groups)
+    (M, N), (rows, cols), _ = incidences([df, other], columns, group)
+    return pd.DataFrame(similarity(M, metric, N).toarray(), index=rows, columns=cols)
+
+
+def read_input(path, columns, delimiter):
+    if path.endswith(".parquet") or os.path.isdir(path):
+        return read_table(path, columns=columns)
+    return pd.read_csv(path, sep=delimiter, usecols=columns)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Computes the similarity matrix of the fingerprints of malware families or applications.")
+    parser.add_argument("input", help="JA4 CSV (ja4.py -short output joined by join.py) or Parquet file")
+    parser.add_argument("--against", help="Second input: compare the groups of input (rows) with the groups of this one (columns)")
+    parser.add_argument("-c", "--columns", nargs="+", default=["JA4hash"], help="Columns of the fingerprint, e.g. JA4hash JA4Shash")
+    parser.add_argument("-g", "--group", default="AppName", help="Column of the families")
+    parser.add_argument("-m", "--metric", choices=METRICS, default="overlap", help="Similarity metric")
+    parser.add_argument("-d", "--delimiter", default=";", help="CSV delimiter")
+    parser.add_argument("-o", "--output", help="Output CSV (default: print the matrix)")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    columns = list(dict.fromkeys(args.columns + [args.group]))
+    df = read_input(args.input, columns, args.delimiter)
+    other = read_input(args.against, columns, args.delimiter) if args.against else None
+    frame = similarity_frame(df, args.columns, args.group, args.metric, other)
+    if args.output:
+        frame.to_csv(args.output)
+        print(f"{frame.shape[0]} x {frame.shape[1]} {args.metric} matrix of {'+'.join(args.columns)} saved into {args.output}")
+    else:
+        print(frame)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+#
+# verdict_cache.py [--model <joblib>] [--warm <JA4 CSV> ...] [-o <table file>] [--lookup <JA4hash> <JA4Shash>]
+#
+# E.g., python3 verdict_cache.py --model models/ja4.joblib --warm ../Datasets/JA4/Dataset2/*.csv -o models/ja4-verdicts.json
+#
+# The JA4 model of ja4_model.ipynb only sees FeatureHasher([JA4hash, JA4Shash]), so its output is a
+# function of the fingerprint pair, and real traffic has few distinct pairs. VerdictCache keeps the
+# class probabilities of every pair seen: a known pair is a dict lookup, the unknown pairs of a
+# lookup are scored by the forest in one batch. The table can be warmed with the pairs of the
+# training CSVs and saved; it is tagged with the SHA-256 of the model file, so a table of another
+# model is never loaded, and it is cleared when the model file changes on disk.
+#
+
+import os
+import csv
+import sys
+import time
+import hashlib
+import argparse
+
+import joblib
+from sklearn.feature_extraction import FeatureHasher
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "tools", "ja4"))
+from fpcache import LRUCache
+
+
+JA4_FIELDS = ["JA4hash", "JA4Shash"]
+JA4_CLASSES = ["DA", "DM"]                  # LabelEncoder of ja4_model.ipynb / hybrid.ipynb (sorted labels)
+N_FEATURES = 1024
+
+
+def ja4_values(rows):
+    """[[JA4hash, JA4Shash], ...] as strings, like df[['JA4hash', 'JA4Shash']].astype(str)."""
+    values = []
+    for row in rows:
+        pair = [row.get(f) for f in JA4_FIELDS] if isinstance(row, dict) else list(row)[:len(JA4_FIELDS)]
+        values.append(["nan" if v is None or v == "" else str(v) for v in pair])
+    return values
+
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class VerdictCache:
+    """Class probabilities of the JA4 model by fingerprint pair; reloads the model when its file changes."""
+
+    def __init__(self, model_path, maxsize=1 << 20, check_interval=5.0):
+        self.model_path = model_path
+        self.check_interval = check_interval    # seconds between two checks of the model file
+        self.hasher = FeatureHasher(n_features=N_FEATURES, input_type='string')
+        self.cache = LRUCache(maxsize, name="Verdict cache")
+        self.reloads = 0
+        self.load_model()
+
+    def load_model(self):
+        st = os.stat(self.model_path)
+        self.model = joblib.load(self.model_path)
+        self.stamp = (st.st_mtime_ns, st.st_size)
+        self.tag = f"ja4-verdict-{file_digest(self.model_path)}"
+        self.classes = list(self.model.classes_)
+        self.checked = time.monotonic()
+        self.cache.clear()
+
+    def check(self):
+        """Reloads the model (and empties the table) if its file has changed since it was loaded."""
+        now = time.monotonic()
+        if now - self.checked < self.check_interval:
+            return False
+        self.checked = now
+        try:
+            st = os.stat(self.model_path)
+        except FileNotFoundError:
+            return False        # being replaced, the old model is kept
+        if (st.st_mtime_ns, st.st_size) == self.stamp:
+            return False
+        self.load_model()
+        self.reloads += 1
+        return True
+
+    def lookup(self, rows):
+        """Returns the probabilities (tuples, in model.classes_ order) of rows (dicts or [JA4hash, JA4Shash])."""
+        self.check()
+        keys = [tuple(pair) for pair in ja4_values(rows)]
+        result = [self.cache.get(key) for key in keys]
+        missing = list(dict.fromkeys(key for key, value in zip(keys, result) if value is None))
+        if missing:
+            proba = self.model.predict_proba(self.hasher.transform([list(key) for key in missing]))
+            computed = dict(zip(missing, (tuple(p) for p in proba.tolist())))
+            for key, value in computed.items():
+                self.cache.put(key, value)
+            result = [computed[key] if value is None else value for key, value in zip(keys, result)]
+        return result
+
+    def warm(self, filenames, delimiter=';'):
+        """Scores the distinct pairs of JA4 CSV files (ja4.py -short output joined by join.py); returns their number."""
+        pairs = {}
+        for filename in filenames:
+            with open(filename, newline="") as f:
+                for row in csv.DictReader(f, delimiter=delimiter):
+                    pairs[tuple(ja4_values([row])[0])] = None
+        self.lookup(list(pairs))
+        return len(pairs)
+
+    def save(self, path):
+        self.cache.save(path, tag=self.tag)
+
+    def load(self, path):
+        """Loads a table saved with the same model file; returns the number of entries."""
+        return self.cache.load(path, tag=self.tag)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Precomputes the JA4 model verdicts of fingerprint pairs.")
+    parser.add_argument("--model", default="models/ja4.joblib", help="JA4 RandomForest (joblib)")
+    parser.add_argument("--warm", nargs="*", default=[], help="JA4 CSV files whose fingerprint pairs are scored")
+    parser.add_argument("-o", "--output", help="Table file to load and save (JSON)")
+    parser.add_argument("--lookup", nargs=2, action="append", default=[], metavar=("JA4HASH", "JA4SHASH"), help="Print the probabilities of this pair")
+    parser.add_argument("--maxsize", type=int, default=1 << 20, help="Max. number of pairs in the table")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    verdicts = VerdictCache(args.model, args.maxsize)
+    if args.output:
+        print(f"{verdicts.load(args.output)} pairs loaded from {args.output}")
+    if args.warm:
+        start = time.time()
+        n = verdicts.warm(args.warm)
+        print(f"{n} pairs of {len(args.warm)} files scored in {time.time() - start:.1f} s")
+    for pair in args.lookup:
+        print(f"{pair[0]};{pair[1]};{';'.join(f'{p:.6f}' for p in verdicts.lookup([pair])[0])}")
+    if args.output:
+        verdicts.save(args.output)
+        print(f"{len(verdicts.cache)} pairs saved into {args.output}")
+    print(verdicts.cache.report())
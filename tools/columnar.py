@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+#
+# columnar.py <CSV or Parquet> ... -o <output .parquet or DIR> [--partition family capture] [-d <delimiter>]
+#
+# E.g., python3 columnar.py heodo-ja4.csv -o heodo-ja4.parquet
+#       python3 columnar.py ../Datasets/MalDIST/Dataset2/*.csv -o ../Datasets/MalDIST/parquet/ --partition family capture
+#
+# Typed columnar output of the fingerprint (ja4.py, ja4x.py, ja4ts.py, join.py) and MalDIST feature
+# (extract_features.py, split_sessions.py, flow_tracker.py) tables. open_table() returns a writer
+# with the interface of csv.writer: a CSV file, or a Parquet file when the path ends in .parquet.
+# The first row written is the header; the type of a column depends on its name:
+#   SrcIP, DstIP                     uint32 (IPv4 only, other addresses are null)
+#   SrcPort, DstPort                 uint16
+#   label, family                    int16
+#   MalDIST features                 float64
+#   other columns (JA4, SNI, ...)    dictionary-encoded strings
+# Empty values are null, as pd.read_csv reads them (NaN). Rows are buffered and written as row
+# groups of --row-group-size rows, so the memory does not depend on the size of the table.
+#
+# With --partition (or partition_by), the output is a directory with one Parquet file per value
+# of the partition columns (hive layout, <DIR>/family=2/capture=heodo/part-0.parquet); "capture"
+# is the capture name taken from the Filename (JA4) or file_name (MalDIST) column. read_table()
+# loads a file or partitioned directory into a DataFrame with the IP addresses as strings again.
+# As a command, it converts CSV files (or combines Parquet files) into a Parquet file or dataset.
+#
+# Parquet output needs pyarrow; CSV output works without it. pyarrow is only imported when a
+# Parquet table is opened or read, so the extractors writing CSV do not load it.
+#
+
+import os
+import re
+import csv
+import sys
+import socket
+import struct
+import argparse
+
+pa = pq = None              # pyarrow, imported by _arrow()
+
+
+ROW_GROUP_SIZE = 65536
+IP_COLUMNS = {"SrcIP", "DstIP"}
+PORT_COLUMNS = {"SrcPort", "DstPort"}
+INT_COLUMNS = {"label", "family"}
+STRING_COLUMNS = {"file_name"}          # the other MalDIST columns are numeric
+CAPTURE_COLUMNS = ["Filename", "file_name"]
+
+
+def _arrow(what="Parquet output"):
+    """Imports pyarrow on the first Parquet table (CSV output does not need it)."""
+    global pa, pq
+    if pa is None:
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError(f"{what} needs pyarrow (pip install pyarrow)") from None
+        pa, pq = pyarrow, pyarrow.parquet
+
+
+def column_type(name, numeric=False):
+    """Arrow type of a column by name; numeric tables (MalDIST features) default to float64."""
+    if name in IP_COLUMNS:
+        return pa.uint32()
+    if name in PORT_COLUMNS:
+        return pa.uint16()
+    if name in INT_COLUMNS:
+        return pa.int16()
+    if numeric and name not in STRING_COLUMNS:
+        return pa.float64()
+    return pa.dictionary(pa.int32(), pa.string())
+
+
+def ip_value(value):
+    try:
+        return struct.unpack("!I", socket.inet_aton(value))[0] if value.count(".") == 3 else None
+    except (OSError, AttributeError):
+        return None
+
+
+def int_value(value):
+    if value is None or value == "":
+        return None
+    return int(float(value)) if isinstance(value, str) else int(value)
+
+
+def float_value(value):
+    if value is None or value == "":
+        return None
+    return float(value)
+
+
+def str_value(value):
+    if value is None or value == "":
+        return None
+    return value if isinstance(value, str) else str(value)
+
+
+def capture_name(value):
+    """Capture of a session name (<capture>_session_<N>) or JA4 Filename (<capture>-extracted)."""
+    value = str(value or "")
+    return re.sub(r"(_udp)?_session_\d+$", "", re.sub(r"-extracted$", "", value)) or "unknown"
+
+
+def partition_path(name, value):
+    value = str(value) if value not in (None, "") else "__HIVE_DEFAULT_PARTITION__"
+    return name + "=" + re.sub(r"[/\\=]", "_", value)
+
+
+class ParquetTable:
+    """csv.writer-like writer of a Parquet file or partitioned directory; the first row is the header."""
+
+    def __init__(self, path, columns=None, numeric=None, partition_by=(), row_group_size=ROW_GROUP_SIZE, delimiter=";", max_open=64):
+        _arrow()
+        self.path = path
+        self.numeric = numeric
+        self.partition_by = list(partition_by)
+        self.row_group_size = row_group_size
+        self.delimiter = delimiter      # of the lines given to write(), as the print()-ed output of ja4.py
+        self.max_open = max_open
+        self.columns = None
+        self.partial = ""
+        self.buffers = {}               # partition directory -> buffered rows
+        self.writers = {}               # partition directory -> ParquetWriter, least recently used first
+        self.parts = {}                 # partition directory -> number of files written
+        self.rows = 0
+        if columns is not None:
+            self.writerow(columns)
+
+    def set_columns(self, columns):
+        self.columns = list(columns)
+        if self.numeric is None:        # MalDIST feature tables are recognized by their columns
+            self.numeric = "file_name" in self.columns and "label" in self.columns
+        self.stored = [c for c in self.columns if c not in self.partition_by]
+        self.schema = pa.schema([(c, column_type(c, self.numeric)) for c in self.stored])
+        self.converters = []
+        for c in self.stored:
+            t = self.schema.field(c).type
+            self.converters.append(ip_value if c in IP_COLUMNS else int_value if pa.types.is_integer(t) else
+                                   float_value if pa.types.is_floating(t) else str_value)
+        index = {c: i for i, c in enumerate(self.columns)}
+        self.stored_idx = [index[c] for c in self.stored]
+        capture = next((index[c] for c in CAPTURE_COLUMNS if c in index), None)
+        self.partition_idx = []
+        for name in self.partition_by:
+            if name == "capture" and "capture" not in index:
+                if capture is None:
+                    raise ValueError(f"no {' or '.join(CAPTURE_COLUMNS)} column to partition by capture")
+                self.partition_idx.append((name, capture, capture_name))
+            elif name in index:
+                self.partition_idx.append((name, index[name], None))
+            else:
+                raise ValueError(f"no column {name} to partition by")
+
+    def writerow(self, row):
+        if self.columns is None:
+            self.set_columns(row)
+            return
+        row = list(row)
+        row += [""] * (len(self.columns) - len(row))        # lines without the Server Hello part
+        if self.partition_idx:
+            key = os.path.join(*(partition_path(name, f(row[i]) if f else row[i]) for name, i, f in self.partition_idx))
+        else:
+            key = ""
+        buf = self.buffers.setdefault(key, [])
+        buf.append(row)
+        self.rows += 1
+        if len(buf) >= self.row_group_size:
+            self.write_group(key)
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def write(self, text):
+        """Writes text lines of delimiter-separated values (a file-like object for print())."""
+        lines = (self.partial + text).split("\n")
+        self.partial = lines.pop()
+        for line in lines:
+            self.writerow(line.split(self.delimiter))
+
+    def flush(self):
+        pass        # rows are written a row group at a time
+
+    def write_group(self, key):
+        rows = self.buffers.pop(key, [])
+        if not rows:
+            return
+        arrays = []
+        for i, convert, field in zip(self.stored_idx, self.converters, self.schema):
+            values = [convert(row[i]) for row in rows]
+            if pa.types.is_dictionary(field.type):
+                arrays.append(pa.array(values, pa.string()).dictionary_encode())
+            else:
+                arrays.append(pa.array(values, field.type))
+        self.writer(key).write_table(pa.Table.from_arrays(arrays, schema=self.schema), row_group_size=self.row_group_size)
+
+    def writer(self, key):
+        writer = self.writers.pop(key, None)
+        if writer is None:
+            if self.partition_idx:
+                directory = os.path.join(self.path, key)
+                os.makedirs(directory, exist_ok=True)
+                n = self.parts.get(key, 0)
+                while os.path.exists(os.path.join(directory, f"part-{n}.parquet")):
+                    n += 1
+                self.parts[key] = n + 1
+                target = os.path.join(directory, f"part-{n}.parquet")
+            else:
+                target = self.path
+            writer = pq.ParquetWriter(target, self.schema, compression="zstd")
+            if len(self.writers) >= self.max_open:
+                self.writers.pop(next(iter(self.writers))).close()
+        self.writers[key] = writer
+        return writer
+
+    def close(self):
+        if self.partial:
+            self.write("\n")
+        if self.columns is not None:
+            for key in list(self.buffers):
+                self.write_group(key)
+            if not self.partition_idx and not self.writers:
+                self.writer("")         # empty table: a file with the schema only
+        for writer in self.writers.values():
+            writer.close()
+        self.writers.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CsvTable:
+    """csv.writer on a file it owns, with the same interface as ParquetTable."""
+
+    def __init__(self, path, columns=None, delimiter=","):
+        self.file = open(path, "w", newline="")
+        self.writer = csv.writer(self.file, delimiter=delimiter)
+        self.writerow = self.writer.writerow
+        self.writerows = self.writer.writerows
+        self.write = self.file.write
+        self.flush = self.file.flush
+        if columns is not None:
+            self.writerow(columns)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def is_parquet(path):
+    return str(path).endswith(".parquet") or os.path.isdir(path)
+
+
+def open_table(path, columns=None, delimiter=",", **kwargs):
+    """Writer of a table: Parquet if path ends in .parquet (kwargs go to ParquetTable), CSV otherwise."""
+    if str(path).endswith(".parquet") or kwargs.get("partition_by"):
+        return ParquetTable(path, columns, delimiter=delimiter, **kwargs)
+    return CsvTable(path, columns, delimiter)
+
+
+def read_table(path, columns=None, filters=None, ip_strings=True):
+    """Reads a Parquet file or partitioned directory into a DataFrame (IPs back to dotted strings)."""
+    _arrow("Parquet input")
+    df = pq.read_table(path, columns=columns, filters=filters).to_pandas()
+    if ip_strings:
+        for c in IP_COLUMNS & set(df.columns):
+            df[c] = [socket.inet_ntoa(struct.pack("!I", int(v))) if v == v and v is not None else None for v in df[c]]
+    return df
+
+
+def iter_rows(path, delimiter):
+    """Header and rows of a CSV file, or of a Parquet file or dataset (values as they would be read from the CSV).
+
+    Parquet is read one record batch at a time, so the memory does not depend on the size of the table.
+    """
+    if not is_parquet(path):
+        with open(path, newline="") as f:
+            yield from csv.reader(f, delimiter=delimiter)
+        return
+    _arrow("Parquet input")
+    import pyarrow.dataset
+    dataset = pyarrow.dataset.dataset(path, format="parquet", partitioning="hive")
+    header = dataset.schema.names
+    yield header
+    for batch in dataset.to_batches():
+        columns = []
+        for name, values in zip(header, batch.columns):
+            values = values.to_pylist()
+            if name in IP_COLUMNS:
+                values = [socket.inet_ntoa(struct.pack("!I", v)) if v is not None else "" for v in values]
+            columns.append(["" if v is None or v != v else v for v in values])
+        yield from map(list, zip(*columns))
+
+
+def convert(inputs, output, delimiter=None, partition_by=(), row_group_size=ROW_GROUP_SIZE):
+    """Writes the rows of the input tables (same columns) into one Parquet file or dataset; returns the number of rows."""
+    table = None
+    try:
+        for path in inputs:
+            sep = delimiter
+            if sep is None and not is_parquet(path):
+                with open(path) as f:
+                    sep = ";" if ";" in f.readline() else ","
+            rows = iter_rows(path, sep)
+            header = next(rows, None)
+            if header is None:
+                continue
+            if table is None:
+                table = ParquetTable(output, header, partition_by=partition_by, row_group_size=row_group_size)
+            elif header != table.columns:
+                raise ValueError(f"{path}: the columns differ from those of {inputs[0]}")
+            table.writerows(rows)
+        return table.rows if table else 0
+    finally:
+        if table is not None:
+            table.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Converts fingerprint or MalDIST feature CSVs into a typed Parquet file or partitioned dataset.")
+    parser.add_argument("inputs", nargs="+", help="CSV or Parquet files with the same columns")
+    parser.add_argument("-o", "--output", required=True, help="Output Parquet file (.parquet) or directory (with --partition)")
+    parser.add_argument("-d", "--delimiter", help="CSV delimiter (default: ';' if the header has one, ',' otherwise)")
+    parser.add_argument("--partition", nargs="+", default=[], help="Partition columns, e.g. family capture (capture: from Filename/file_name)")
+    parser.add_argument("--row-group-size", type=int, default=ROW_GROUP_SIZE, help="Rows per row group")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    n = convert(args.inputs, args.output, args.delimiter, args.partition, args.row_group_size)
+    print(f"{n} rows of {len(args.inputs)} files saved into {args.output}", file=sys.stderr)
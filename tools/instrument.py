@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+#
+# instrument.py -o <report prefix> [-s <stage>] -- <command> [args...]
+#
+# E.g., python3 instrument.py -o out/heodo-tshark -s tshark -- tshark -r heodo.pcap -T fields ... > heodo-extracted.csv
+#
+# Per-stage measurements of the get-ja4.sh and MalDIST scripts. A script creates a Metrics object,
+# wraps each stage in `with metrics.stage(name) as stage:` and adds counters to it (rows, packets,
+# flows dropped, time blocked reading a tshark pipe with stage.wait()), and the counters of its
+# caches with add_cache(). When the script is run with --metrics <prefix> (-metrics in ja4.py),
+# save() writes two files per run:
+#   <prefix>.json   stages with wall and CPU time, peak RSS, counters and cache statistics
+#   <prefix>.prom   the same values in the Prometheus text format (node_exporter textfile collector)
+# Both files are replaced atomically. Peak RSS is the maximum of the process up to the end of the
+# stage (ru_maxrss), so a stage only shows its own peak if it is higher than the previous ones.
+#
+# As a command, it runs another program (tshark) as a stage of its own: the standard input and
+# output are inherited, and its exit status is returned.
+#
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import resource
+import subprocess
+from contextlib import contextmanager
+
+
+PREFIX = "malja4dist"
+
+
+def peak_rss(who=resource.RUSAGE_SELF):
+    """Peak resident set size in bytes (ru_maxrss is in KiB on Linux, bytes on macOS)."""
+    rss = resource.getrusage(who).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def cpu_times():
+    """(CPU seconds of this process, CPU seconds and ru_maxrss of its finished children)."""
+    own, children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime, children.ru_utime + children.ru_stime, children.ru_maxrss
+
+
+class Stage:
+    """Measurements of one stage: times, peak RSS and named counters."""
+
+    def __init__(self, name):
+        self.name = name
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.children_cpu = 0.0
+        self.peak_rss = 0
+        self.children_peak_rss = 0
+        self.counters = {}
+
+    def add(self, counter, n=1):
+        self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def wait(self, iterable, counter="pipe_wait_seconds"):
+        """Yields the items of iterable (a pipe) adding the time blocked on each read to the counter."""
+        it = iter(iterable)
+        clock = time.perf_counter
+        blocked = 0.0
+        try:
+            while True:
+                start = clock()
+                try:
+                    item = next(it)
+                except StopIteration:
+                    blocked += clock() - start
+                    return
+                blocked += clock() - start
+                yield item
+        finally:
+            self.add(counter, blocked)
+
+    def as_dict(self):
+        return {"wall_seconds": round(self.wall, 6), "cpu_seconds": round(self.cpu, 6), "children_cpu_seconds": round(self.children_cpu, 6),
+                "peak_rss_bytes": self.peak_rss, "children_peak_rss_bytes": self.children_peak_rss, "counters": dict(self.counters)}
+
+
+class Metrics:
+    """Stages and caches of one run of a script, saved with save()."""
+
+    def __init__(self, script, run=None):
+        self.script = script
+        self.run = run or script
+        self.started = time.time()
+        self.stages = {}
+        self.caches = {}
+
+    @contextmanager
+    def stage(self, name):
+        """Measures the block as the stage `name` (a stage entered again accumulates)."""
+        stage = self.stages.setdefault(name, Stage(name))
+        wall = time.perf_counter()
+        cpu, children, children_rss = cpu_times()
+        try:
+            yield stage
+        finally:
+            end_cpu, end_children, end_children_rss = cpu_times()
+            stage.wall += time.perf_counter() - wall
+            stage.cpu += end_cpu - cpu
+            stage.children_cpu += end_children - children
+            stage.peak_rss = max(stage.peak_rss, peak_rss())
+            if end_children != children or end_children_rss != children_rss:     # children finished in the stage
+                stage.children_peak_rss = max(stage.children_peak_rss, peak_rss(resource.RUSAGE_CHILDREN))
+
+    def add_cache(self, name, hits, misses, size=None, maxsize=None, evictions=0):
+        self.caches[name] = {"hits": hits, "misses": misses, "evictions": evictions, "size": size, "maxsize": maxsize}
+
+    def add_lru(self, cache):
+        """Adds the counters of an fpcache.LRUCache."""
+        s = cache.stats()
+        self.add_cache(cache.name, s["hits"], s["misses"], s["size"], s["maxsize"], s["evictions"])
+
+    def add_lru_cache(self, name, func):
+        """Adds the counters of a functools.lru_cache function."""
+        info = func.cache_info()
+        self.add_cache(name, info.hits, info.misses, info.currsize, info.maxsize)
+
+    def as_dict(self):
+        return {"script": self.script, "run": self.run, "host": socket.gethostname(), "pid": os.getpid(), "started": self.started,
+                "finished": time.time(), "peak_rss_bytes": peak_rss(), "stages": {name: s.as_dict() for name, s in self.stages.items()},
+                "caches": self.caches}
+
+    def prometheus(self):
+        """Report in the Prometheus text exposition format."""
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            if not samples:
+                return
+            lines.append(f"# HELP {PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {PREFIX}_{name} {kind}")
+            for labels, value in samples:
+                labels = dict(script=self.script, run=self.run, **labels)
+                text = ",".join(f'{k}="{escape(v)}"' for k, v in labels.items())
+                lines.append(f"{PREFIX}_{name}{{{text}}} {value if isinstance(value, int) else float(value)!r}")
+
+        stages = list(self.stages.values())
+        metric("stage_wall_seconds", "gauge", "Wall time of the stage.", [({"stage": s.name}, s.wall) for s in stages])
+        metric("stage_cpu_seconds", "gauge", "CPU time (user + system) of the stage in this process.", [({"stage": s.name}, s.cpu) for s in stages])
+        metric("stage_children_cpu_seconds", "gauge", "CPU time of the child processes finished during the stage.",
+               [({"stage": s.name}, s.children_cpu) for s in stages if s.children_cpu])
+        metric("stage_peak_rss_bytes", "gauge", "Peak RSS of the process at the end of the stage.", [({"stage": s.name}, s.peak_rss) for s in stages])
+        metric("stage_children_peak_rss_bytes", "gauge", "Largest peak RSS of the finished child processes.",
+               [({"stage": s.name}, s.children_peak_rss) for s in stages if s.children_peak_rss])
+        counters = [({"stage": s.name, "counter": c}, v) for s in stages for c, v in s.counters.items()]
+        metric("stage_counter", "gauge", "Counters of the stage: rows, packets, flows dropped, seconds blocked on a pipe.", counters)
+        caches = self.caches.items()
+        metric("cache_hits_total", "counter", "Cache hits.", [({"cache": name}, c["hits"]) for name, c in caches])
+        metric("cache_misses_total", "counter", "Cache misses.", [({"cache": name}, c["misses"]) for name, c in caches])
+        metric("cache_evictions_total", "counter", "Cache evictions.", [({"cache": name}, c["evictions"]) for name, c in caches])
+        metric("run_finished_timestamp_seconds", "gauge", "End of the run (Unix time).", [({}, float(int(time.time())))])
+        return "\n".join(lines) + "\n"
+
+    def save(self, prefix):
+        """Writes <prefix>.json and <prefix>.prom."""
+        write_atomic(f"{prefix}.json", json.dumps(self.as_dict(), indent=1) + "\n")
+        write_atomic(f"{prefix}.prom", self.prometheus())
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def write_atomic(path, text):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Runs a command as an instrumented stage and writes its report (JSON and Prometheus).")
+    parser.add_argument("-o", "--output", required=True, help="Report prefix (<prefix>.json and <prefix>.prom)")
+    parser.add_argument("-s", "--stage", help="Stage name (default: the command name)")
+    parser.add_argument("command", nargs=argparse.REMAINDER, help="Command and arguments (after --)")
+    args = parser.parse_args()
+    if args.command[:1] == ["--"]:
+        args.command = args.command[1:]
+    if not args.command:
+        parser.error("missing command")
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    name = os.path.basename(args.command[0])
+    metrics = Metrics(name, os.path.basename(args.output))
+    with metrics.stage(args.stage or name) as stage:
+        status = subprocess.call(args.command)
+        stage.add("exit_status", status)
+    metrics.save(args.output)
+    sys.exit(status)
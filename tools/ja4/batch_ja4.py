@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+#
+# batch_ja4.py <PCAP file or directory> [...] [-a <AppName>] [-v <version>] [-t <type>] [-d <output DIR>] [-w <whois file>] [-p] [-j <jobs>]
+#
+# E.g., python3 batch_ja4.py captures/ -a MyApps -t 0 -d out/ -w ../../utils/whois.txt -j 32 --subdirs
+#
+# Batch version of get-ja4.sh (and exec.sh): fingerprints many PCAP files with a pool of worker
+# processes. The whois, resolution and ad-list files are loaded only once and shared with the workers,
+# each worker keeps its fingerprint cache across files. Per-file outputs are the same as those of
+# get-ja4.sh; a summary of the run is written into <output DIR>/batch-summary.csv.
+#
+
+import os
+import re
+import sys
+import csv
+import time
+import argparse
+import subprocess
+import multiprocessing
+from contextlib import redirect_stdout
+
+import ja4
+from fpcache import LRUCache
+from join import join_files
+from ja4ts import extract_ja4ts_tshark
+from pcap_ja4 import EXTRACTED_HEADER, process_pcap
+
+
+JA4XPY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ja4x.py")
+TSHARK_FIELDS = ["ip.src", "ip.dst", "tcp.srcport", "tcp.dstport", "udp.srcport", "udp.dstport", "ip.proto",
+                 "tls.handshake.type", "tls.handshake.version", "tls.handshake.ciphersuite", "tls.handshake.extension.type",
+                 "tls.handshake.extensions_server_name", "tls.handshake.extensions_supported_group",
+                 "tls.handshake.extensions_ec_point_format", "tls.handshake.extensions_alpn_str", "tls.handshake.sig_hash_alg",
+                 "tls.handshake.extensions.supported_version", "frame.time"]
+SUMMARY_HEADER = ["File", "Status", "Handshakes", "Seconds", "Error"]
+
+# shared by all files processed by a worker (set by init_worker)
+worker = {}
+
+
+def capture_name(pcap):
+    """Name of the output files, like get-ja4.sh: basename without .pcap / .pcapng."""
+    return re.sub(r".p*cap.*", "", os.path.basename(pcap), count=1)
+
+
+def find_captures(paths):
+    """Expands directories into the PCAP/PCAPNG files they contain (not recursive)."""
+    captures = []
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith((".pcap", ".pcapng", ".cap")):
+                    captures.append(os.path.join(path, name))
+        else:
+            captures.append(path)
+    return captures
+
+
+def init_worker(side_files, options):
+    worker["side_files"] = side_files
+    worker["options"] = options
+    worker["cache"] = LRUCache(options["cache_size"], name="Fingerprint cache") if options["cache_size"] > 0 else None
+
+
+def extract_tshark(pcap, extracted):
+    with open(extracted, "w") as out:
+        out.write(EXTRACTED_HEADER + "\n")
+        out.flush()
+        cmd = ["tshark", "-r", pcap, "-T", "fields", "-E", "separator=;"]
+        for field in TSHARK_FIELDS:
+            cmd.extend(["-e", field])
+        cmd.extend(["-R", "tls.handshake.type==1 or tls.handshake.type==2", "-2"])
+        subprocess.run(cmd, stdout=out, check=True)
+
+
+def write_fingerprints(extracted, output, short):
+    options = worker["options"]
+    db = ja4.process_tls_file(extracted, short=short, app_name=options["app"], version=options["version"],
+                              traffic_type=options["type"], cache=worker["cache"], db={}, side_files=worker["side_files"])
+    with open(output, "w") as out:
+        ja4.write_tls_db(db, short, out)
+    return len(db)
+
+
+def process_capture(pcap):
+    """Runs the steps of get-ja4.sh for one file; existing outputs are not recomputed. Returns a summary row."""
+    options = worker["options"]
+    start = time.time()
+    name = capture_name(pcap)
+    outdir = options["outdir"] or os.path.dirname(pcap) or "."
+    if options["subdirs"]:
+        outdir = os.path.join(outdir, os.path.basename(pcap).removesuffix(".pcapng"))
+    os.makedirs(outdir, exist_ok=True)
+
+    extracted = os.path.join(outdir, f"{name}-extracted.csv")
+    raw_file = os.path.join(outdir, f"{name}-ja4-raw.csv")
+    short_file = os.path.join(outdir, f"{name}-ja4.csv")
+    ja4x_file = os.path.join(outdir, f"{name}-ja4x.csv")
+    ja4ts_file = os.path.join(outdir, f"{name}-ja4ts.csv")
+    handshakes = ""
+
+    try:
+        # the progress messages of the extraction tools are dropped, errors end up in the summary
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            # the single pass also writes the JA4X and JA4TS files: it runs if any of the three is missing
+            if options["singlepass"]:
+                if not all(os.path.isfile(f) for f in (extracted, ja4x_file, ja4ts_file)):
+                    process_pcap(pcap, extracted, ja4x_file, ja4ts_file)
+            elif not os.path.isfile(extracted):
+                extract_tshark(pcap, extracted)
+
+            if not os.path.isfile(raw_file):
+                handshakes = write_fingerprints(extracted, raw_file, short=False)
+
+            if not os.path.isfile(short_file):
+                handshakes = write_fingerprints(extracted, short_file, short=True)
+                if not options["singlepass"]:
+                    subprocess.run([sys.executable, JA4XPY, pcap, "-o", ja4x_file], stdout=devnull, check=True)
+                    extract_ja4ts_tshark(pcap, ja4ts_file)
+                join_files([short_file, ja4x_file, ja4ts_file], short_file)
+    except Exception as e:
+        return [pcap, "error", handshakes, f"{time.time() - start:.3f}", f"{type(e).__name__}: {e}"]
+    return [pcap, "ok", handshakes, f"{time.time() - start:.3f}", ""]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Computes JA4+ fingerprints of many PCAP files in parallel (batch version of get-ja4.sh).")
+    parser.add_argument("pcaps", nargs="+", help="PCAP/PCAPNG files or directories with them")
+    parser.add_argument("-a", "--app", default="Unknown", help="Application name")
+    parser.add_argument("-v", "--version", default="0", help="Version")
+    parser.add_argument("-t", "--type", default="0", type=str.upper, choices=['0', 'A', 'M'], help="Traffic type: 0 (normal), A (analytics), M (malware)")
+    parser.add_argument("-d", "--outdir", default=None, help="Output directory (default: directory of each PCAP file)")
+    parser.add_argument("-w", "--whois", default=None, help="WHOIS file (maps IP to organization)")
+    parser.add_argument("-r", "--res", default=None, help="Resolution file (maps ports to process names)")
+    parser.add_argument("--adlist", default=None, help="Ad list file (contains ad server domain names)")
+    parser.add_argument("-p", "--singlepass", action="store_true", help="Read each PCAP only once with pcap_ja4.py instead of tshark")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="Number of worker processes (default: number of CPUs)")
+    parser.add_argument("--subdirs", action="store_true", help="Write the outputs of each PCAP into its own subdirectory (like exec.sh)")
+    parser.add_argument("--cache-size", type=int, default=65536, help="Max. number of cached handshake fingerprints per worker (0 disables the cache)")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.outdir and not os.path.isdir(args.outdir):
+        print(f"Cannot access output directory \"{args.outdir}\"")
+        sys.exit(1)
+
+    captures = find_captures(args.pcaps)
+    side_files = ja4.load_side_files(args.res, args.whois, args.adlist)
+    options = {"app": args.app, "version": args.version, "type": args.type, "outdir": args.outdir, "subdirs": args.subdirs,
+               "singlepass": args.singlepass, "cache_size": args.cache_size}
+
+    summary_file = os.path.join(args.outdir or ".", "batch-summary.csv")
+    start = time.time()
+    failed = 0
+    with open(summary_file, "w", newline="") as f, \
+         multiprocessing.Pool(args.jobs, initializer=init_worker, initargs=(side_files, options)) as pool:
+        writer = csv.writer(f, delimiter=';')
+        writer.writerow(SUMMARY_HEADER)
+        for count, row in enumerate(pool.imap_unordered(process_capture, captures), 1):
+            writer.writerow(row)
+            if row[1] != "ok":
+                failed += 1
+            print(f"[{count}/{len(captures)}] {row[0]}: {row[1]} {row[4]}".rstrip())
+
+    print(f"Processed {len(captures)} files ({failed} failed) in {time.time() - start:.1f} s, summary saved into {summary_file}")
+    sys.exit(1 if failed else 0)
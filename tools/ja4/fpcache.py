@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+#
+# fpcache.py -- bounded LRU cache with hit/miss/eviction counters and optional persistence
+#
+# Used in front of the fingerprint computations: the same handshake parameters are seen over
+# and over again, so most lookups are hits. The cache can be saved into a JSON file and loaded
+# by the next run, so a new capture from the same hosts starts warm.
+#
+
+import os
+import json
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Least recently used cache of at most maxsize entries."""
+
+    def __init__(self, maxsize=65536, name="cache"):
+        self.maxsize = maxsize
+        self.name = name
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        try:
+            value = self.data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+            self.evictions += 1
+
+    def get_or_compute(self, key, func, *args):
+        """Returns the cached value of key, computes it as func(*args) on a miss."""
+        value = self.get(key)
+        if value is None:
+            value = func(*args)
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        self.data.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"size": len(self.data), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "hit_rate": self.hits / lookups if lookups else 0.0}
+
+    def report(self):
+        s = self.stats()
+        return (f"{self.name}: {s['hits']} hits, {s['misses']} misses, {s['evictions']} evictions, "
+                f"{s['size']}/{s['maxsize']} entries (hit rate {100 * s['hit_rate']:.1f}%)")
+
+    def save(self, path, tag=""):
+        """Saves the entries (least recently used first) into a JSON file."""
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"tag": tag, "entries": [[list(k) if isinstance(k, tuple) else k, v] for k, v in self.data.items()]}, f)
+        os.replace(tmp, path)
+
+    def load(self, path, tag=""):
+        """Loads entries saved by save(); a missing file or a file with another tag is ignored.
+
+        Keys and values stored as JSON lists are converted back to tuples.
+        """
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return 0
+        if saved.get("tag") != tag:
+            return 0
+        for key, value in saved["entries"]:
+            self.put(tuple(key) if isinstance(key, list) else key, tuple(value) if isinstance(value, list) else value)
+        return len(saved["entries"])
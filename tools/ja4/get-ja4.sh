@@ -1,10 +1,14 @@
 #!/bin/bash
 
 #
-# get-ja4.sh <PCAP>  [-a <AppName>] [-v <version>] [-t <type:0 (normal) | M (malware) | A (analytics)>] [-d <output DIR>] [-w <whois file>]
+# get-ja4.sh <PCAP>  [-a <AppName>] [-v <version>] [-t <type:0 (normal) | M (malware) | A (analytics)>] [-d <output DIR>] [-w <whois file>] [-p] [-m <metrics DIR>]
 #
 # E.g., ./get-ja4.sh heodo.pcap -a Heodo -t M -w whois.txt
 #
+# With -p, the PCAP file is read only once by pcap_ja4.py (TLS over TCP only) instead of three tshark runs.
+# With -m, every step writes its timings and counters into <metrics DIR>/<file>-<step>.json and .prom
+# (see ../instrument.py); the .prom files can be collected by the node_exporter textfile collector.
+#
 # Extracts TLS/QUIC data from a PCAP file and creates JA4 a JA4S fingerprints, for IPv4 only.
 # Whois file is a list of CSV entries in format <IP address>;<OrgName> generated by get-whois.pl.
 #
@@ -14,6 +18,8 @@
 # Last update: 31/5/2024
 #
 # Changes: parameter whois added
+#          parameter -p (single-pass extraction) added
+#          parameter -m (per-step metrics) added
 #
 
 
@@ -25,16 +31,20 @@ JA4PY="ja4.py"
 JA4XPY="ja4x.py"
 JA4TSPY="ja4ts.py"
 JOINPY="join.py"
+PCAPJA4PY="pcap_ja4.py"
+INSTRUMENTPY="../instrument.py"
+TSHARK="tshark"
 APPNAME="Unknown" # default application name
 VERSION="0"       # default version
 TYPE="0"          # default type: 0 = normal traffic, other values: M = alware, A = advertisements/analytics
+SINGLEPASS="0"    # default extraction: tshark
 
 #
 # Reading input parameters
 # 
 
-if [ $# -lt 1 -o $# -gt 11 ]; then
-    echo "Usage: $0 <PCAP file> [-a <AppName>] [-v <version>] [-t <type:0 (normal) | M (malware) | A (analytics)>] [-d <output DIR>] [-w <whois file>]"
+if [ $# -lt 1 -o $# -gt 14 ]; then
+    echo "Usage: $0 <PCAP file> [-a <AppName>] [-v <version>] [-t <type:0 (normal) | M (malware) | A (analytics)>] [-d <output DIR>] [-w <whois file>] [-p] [-m <metrics DIR>]"
     exit 1;
 fi
 
@@ -48,7 +58,7 @@ else
 fi
 
 shift 1
-while getopts ":a:v:t:d:w:" options; do
+while getopts ":a:v:t:d:w:pm:" options; do
     case ${options} in
 	a)
 	    APPNAME=${OPTARG}
@@ -78,6 +88,16 @@ while getopts ":a:v:t:d:w:" options; do
 		exit 1;
 	    fi
 	    ;;
+	p)
+	    SINGLEPASS="1"
+	    ;;
+	m)
+	    METRICSDIR=${OPTARG}
+	    if [ ! -d $METRICSDIR ]; then
+		echo "Cannot access metrics directory \"$METRICSDIR\""
+		exit 1;
+	    fi
+	    ;;
 	\?)
 	    echo "Error: Invalid argument -${OPTARG}"
             exit 1;;
@@ -98,15 +118,40 @@ fi
 echo "Processing file \"${INFILE}\" ..."
 echo "Output will be saved into \"${OUTDIR}/\" directory ..."
 
+#
+# metrics options of a step: metrics <option name> <step>
+#
+metrics() {
+    if [ -n "${METRICSDIR}" ]; then
+	echo "$1 ${METRICSDIR}/${FILENAME}-$2"
+    fi
+}
+if [ -n "${METRICSDIR}" ]; then
+    TSHARK="python3 ${INSTRUMENTPY} -o ${METRICSDIR}/${FILENAME}-tshark -s tshark -- tshark"
+fi
+
 #
 # extracting TLS data using thark into  a csv file; if the output file exists, processing is skipped
 #
 OUTFILE=${FILENAME}-extracted.csv
+TLSJA4X=${FILENAME}-ja4x.csv
+TLSJA4TS=${FILENAME}-ja4ts.csv
+
+# the single pass also writes the JA4X and JA4TS files: it runs if any of the three is missing
+if [ "${SINGLEPASS}" = "1" ] && [ ! -f "${OUTDIR}/${OUTFILE}" -o ! -f "${OUTDIR}/${TLSJA4X}" -o ! -f "${OUTDIR}/${TLSJA4TS}" ]; then
+    echo "Processing TLS traffic, certificates and SYN-ACKs in a single pass ..."
+    python3 ${PCAPJA4PY} "${INFILE}" -d "${OUTDIR}" -n "${FILENAME}" $(metrics --metrics pcap_ja4)
+
+    if [ $? -ne 0 ]; then
+	    echo "Error 1: SSL/TLS processing failed."
+	    exit 1;
+    fi
+fi
 
 if [ ! -f "${OUTDIR}/${OUTFILE}" ]; then 
     echo "Processing TLS traffic ..."
     echo "SrcIP;DstIP;TCP SrcPort;TCP DstPort;UDP SrcPort; UDP DstPort;Proto;Type;Ver;Ciphersuite;List of extensions;SNI;Supported Groups;EC;ALPN;Signature Algorithms;Supported Versions;Time" > "${OUTDIR}/${OUTFILE}"
-    tshark -r "${INFILE}" -T fields -E separator=";" -e ip.src -e ip.dst -e tcp.srcport -e tcp.dstport -e udp.srcport -e udp.dstport -e ip.proto -e tls.handshake.type -e tls.handshake.version -e tls.handshake.ciphersuite -e tls.handshake.extension.type -e tls.handshake.extensions_server_name -e tls.handshake.extensions_supported_group -e tls.handshake.extensions_ec_point_format -e tls.handshake.extensions_alpn_str -e tls.handshake.sig_hash_alg -e tls.handshake.extensions.supported_version -e frame.time -R "tls.handshake.type==1 or tls.handshake.type==2" -2 >> "${OUTDIR}/${OUTFILE}" 
+    ${TSHARK} -r "${INFILE}" -T fields -E separator=";" -e ip.src -e ip.dst -e tcp.srcport -e tcp.dstport -e udp.srcport -e udp.dstport -e ip.proto -e tls.handshake.type -e tls.handshake.version -e tls.handshake.ciphersuite -e tls.handshake.extension.type -e tls.handshake.extensions_server_name -e tls.handshake.extensions_supported_group -e tls.handshake.extensions_ec_point_format -e tls.handshake.extensions_alpn_str -e tls.handshake.sig_hash_alg -e tls.handshake.extensions.supported_version -e frame.time -R "tls.handshake.type==1 or tls.handshake.type==2" -2 >> "${OUTDIR}/${OUTFILE}" 
     
     if [ $? -ne 0 ]; then
 	    echo "Error 1: SSL/TLS processing failed."
@@ -117,17 +162,15 @@ fi
 # processing TLS extracted data and computing JA4+ fingerprints -- full output with JA4 and JA4s raw
 #
 TLSJA4=${FILENAME}-ja4-raw.csv
-TLSJA4X=${FILENAME}-ja4x.csv
-TLSJA4TS=${FILENAME}-ja4ts.csv
 
 if [ ! -f "${OUTDIR}/${TLSJA4}" ]; then
     echo "Saving JA4 raw fingerprints into ${OUTDIR}/${TLSJA4}"
     if [ -r ${WHOISFILE} ]; then
-	    python3 ${JA4PY} -f "${OUTDIR}/${OUTFILE}" -app "${APPNAME}" -ver "${VERSION}" -type "${TYPE}" -whois "${WHOISFILE}" > "${OUTDIR}/${TLSJA4}"
+	    python3 ${JA4PY} -f "${OUTDIR}/${OUTFILE}" -app "${APPNAME}" -ver "${VERSION}" -type "${TYPE}" -whois "${WHOISFILE}" $(metrics -metrics ja4-raw) > "${OUTDIR}/${TLSJA4}"
 		#python3 ${JA4XPY} "${INFILE}" -o "${OUTDIR}/${TLSJA4X}"
 		#python3 ${JOINPY} "${OUTDIR}/${TLSJA4}" "${OUTDIR}/${TLSJA4X}" -o "${OUTDIR}/${TLSJA4}"
     else
-	    python3 ${JA4PY} -f "${OUTDIR}/${OUTFILE}" -app "${APPNAME}" -ver "${VERSION}" -type "${TYPE}" > "${OUTDIR}/${TLSJA4}"
+	    python3 ${JA4PY} -f "${OUTDIR}/${OUTFILE}" -app "${APPNAME}" -ver "${VERSION}" -type "${TYPE}" $(metrics -metrics ja4-raw) > "${OUTDIR}/${TLSJA4}"
 		#python3 ${JA4XPY} "${INFILE}" -o "${OUTDIR}/${TLSJA4X}"
 		#python3 ${JOINPY} "${OUTDIR}/${TLSJA4}" "${OUTDIR}/${TLSJA4X}" -o "${OUTDIR}/${TLSJA4}"
     fi
@@ -146,15 +189,19 @@ TLSJA4=${FILENAME}-ja4.csv
 if [ ! -f "${OUTDIR}/${TLSJA4}" ]; then
     echo "Saving JA4 fingerprints into ${OUTDIR}/${TLSJA4}"
     if [ -r ${WHOISFILE} ]; then
-	    python3 ${JA4PY} -f "${OUTDIR}/${OUTFILE}" -app "${APPNAME}" -ver "${VERSION}" -type "${TYPE}" -short -whois "${WHOISFILE}" > "${OUTDIR}/${TLSJA4}"
-		python3 ${JA4XPY} "${INFILE}" -o "${OUTDIR}/${TLSJA4X}"
-		python3 ${JA4TSPY} "${INFILE}" -o "${OUTDIR}/${TLSJA4TS}"
-		python3 ${JOINPY} "${OUTDIR}/${TLSJA4}" "${OUTDIR}/${TLSJA4X}" "${OUTDIR}/${TLSJA4TS}" -o "${OUTDIR}/${TLSJA4}"
+	    python3 ${JA4PY} -f "${OUTDIR}/${OUTFILE}" -app "${APPNAME}" -ver "${VERSION}" -type "${TYPE}" -short -whois "${WHOISFILE}" $(metrics -metrics ja4) > "${OUTDIR}/${TLSJA4}"
+		if [ "${SINGLEPASS}" != "1" ]; then
+		    python3 ${JA4XPY} "${INFILE}" -o "${OUTDIR}/${TLSJA4X}" $(metrics --metrics ja4x)
+		    python3 ${JA4TSPY} "${INFILE}" -o "${OUTDIR}/${TLSJA4TS}" $(metrics --metrics ja4ts)
+		fi
+		python3 ${JOINPY} "${OUTDIR}/${TLSJA4}" "${OUTDIR}/${TLSJA4X}" "${OUTDIR}/${TLSJA4TS}" -o "${OUTDIR}/${TLSJA4}" $(metrics --metrics join)
     else
-	    python3 ${JA4PY} -f "${OUTDIR}/${OUTFILE}" -app "${APPNAME}" -ver "${VERSION}" -type "${TYPE}" -short > "${OUTDIR}/${TLSJA4}"
-		python3 ${JA4XPY} "${INFILE}" -o "${OUTDIR}/${TLSJA4X}"
-		python3 ${JA4TSPY} "${INFILE}" -o "${OUTDIR}/${TLSJA4TS}"
-		python3 ${JOINPY} "${OUTDIR}/${TLSJA4}" "${OUTDIR}/${TLSJA4X}" "${OUTDIR}/${TLSJA4TS}" -o "${OUTDIR}/${TLSJA4}"
+	    python3 ${JA4PY} -f "${OUTDIR}/${OUTFILE}" -app "${APPNAME}" -ver "${VERSION}" -type "${TYPE}" -short $(metrics -metrics ja4) > "${OUTDIR}/${TLSJA4}"
+		if [ "${SINGLEPASS}" != "1" ]; then
+		    python3 ${JA4XPY} "${INFILE}" -o "${OUTDIR}/${TLSJA4X}" $(metrics --metrics ja4x)
+		    python3 ${JA4TSPY} "${INFILE}" -o "${OUTDIR}/${TLSJA4TS}" $(metrics --metrics ja4ts)
+		fi
+		python3 ${JOINPY} "${OUTDIR}/${TLSJA4}" "${OUTDIR}/${TLSJA4X}" "${OUTDIR}/${TLSJA4TS}" -o "${OUTDIR}/${TLSJA4}" $(metrics --metrics join)
     fi
     
     if [ $? -ne 0 ]; then
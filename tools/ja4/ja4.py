@@ -6,13 +6,25 @@ import os
 import re
 import hashlib
 import argparse
-from collections import defaultdict
+import calendar
+import time
+import functools
+import itertools
+from collections import defaultdict, OrderedDict
+
+from fpcache import LRUCache
+from whois_index import WhoisIndex, is_index
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from instrument import Metrics
+from columnar import open_table
 
 
 delim = ";"
 adlist = "/../utils/ad-list.txt"
 tls_db = defaultdict(str)     # a hash array of all processed TLS handshakes
 short_db = defaultdict(str)  # a hash array of unique entries of the short list
+CACHE_TAG = "ja4-handshake-1"  # version of the cached values, change it when handshake_fingerprint changes
 
 
 GREASE_HEX = ["0x0a0a", "0x1a1a", "0x2a2a", "0x3a3a", "0x4a4a", "0x5a5a", "0x6a6a", "0x7a7a", "0x8a8a", "0x9a9a", "0xaaaa", "0xbaba", "0xcaca", "0xdada", "0xeaea", "0xfafa"]
@@ -31,19 +43,21 @@ def sha256_hex(s):
     return hashlib.sha256(s.encode()).hexdigest()
 
 
-def load_adlist():
+def load_adlist(filename=adlist):
     try:
         addservers = {}
-        with open(adlist, "r") as adfile:
+        with open(filename, "r") as adfile:
             for line in adfile:
                 line = line.strip()
                 addservers[line] = 1
         return addservers
     except FileNotFoundError:
-        print(f"Warning: {adlist} not found. Skipping ad-list processing.")
+        print(f"Warning: {filename} not found. Skipping ad-list processing.")
         return {}
 
 def load_whois_file(whoisfile):
+    if is_index(whoisfile):     # compiled by whois_index.py: longest-prefix match instead of exact IPs
+        return WhoisIndex(whoisfile)
     try:
         whois_db = {}
         with open(whoisfile, 'r') as file:
@@ -69,183 +83,427 @@ def load_resolution_file(resfile):
         print(f"Warning: {resfile} not found. Skipping ad-list processing.")
         return {}
 
-def process_tls_file(filename, short=False, app_name="Unknown", version="0", traffic_type="0", resfile=None, whoisfile=None, adfile=None):
-    whois_db = {}
-    res_db = {}
-    adservers = {}
+EXTRACTED_FIELDS = ["srcIP", "dstIP", "srcTCPort", "dstTCPort", "srcUDPort", "dstUDPort", "proto", "type", "version",
+                    "cipher_suite", "extensions", "sni", "supported_groups", "ec_format", "alpn", "sig",
+                    "supported_versions", "time"]   # columns of the extracted CSV (tshark output)
+
+GREASE_DEC = frozenset(str(g) for g in GREASE)
+GREASE_HEX_SET = frozenset(GREASE_HEX)
+_grease_substrings = {GREASE_DEC: {}, GREASE_HEX_SET: {}}    # token -> True if it contains a GREASE value
+
+
+def strip_grease(value, sep, grease):
+    """Removes GREASE tokens from a list separated by sep.
+
+    The result is identical to the former loop of re.sub(f"{grease}{sep}?", "", value): a removed
+    token takes its following separator with it (so a trailing GREASE leaves a trailing separator).
+    Tokens that merely contain a GREASE value fall back to the regular expressions.
+    """
+    tokens = value.split(sep)
+    substrings = _grease_substrings[grease]
+    kept = []
+    for token in tokens:
+        if token in grease:
+            continue
+        tainted = substrings.get(token)
+        if tainted is None:
+            tainted = substrings[token] = any(g in token for g in grease)
+        if tainted:
+            for g in (GREASE if grease is GREASE_DEC else GREASE_HEX):
+                value = re.sub(f"{g}{re.escape(sep)}?", "", value)
+            return value
+        kept.append(token)
+    if len(kept) == len(tokens):
+        return value
+    if kept and tokens[-1] in grease:
+        return sep.join(kept) + sep
+    return sep.join(kept)
+
+
+_hex_to_dec = {}    # hex token -> decimal string
+
+
+def hex_to_dec(token):
+    dec = _hex_to_dec.get(token)
+    if dec is None:
+        dec = _hex_to_dec[token] = str(int(token, 16))
+    return dec
+
+
+# The parts of a handshake (cipher suite list, extension list, ...) repeat far more often than
+# whole handshakes, so each part is converted once and memoized.
+
+@functools.lru_cache(maxsize=65536)
+def ja3_ciphers(cipher_suite):
+    """Decimal cipher suites without GREASE values for JA3."""
+    return strip_grease("-".join([hex_to_dec(s) for s in cipher_suite.split(",")]), "-", GREASE_DEC)
+
+
+@functools.lru_cache(maxsize=65536)
+def ja4_ciphers(cipher_suite):
+    """Sorted hex cipher suites without GREASE values and their two digit count for JA4."""
+    ja4_cipher_suite = strip_grease(cipher_suite, ",", GREASE_HEX_SET)
+    cipher_sorted = sorted(ja4_cipher_suite.split(","))             # sort the cipher suites for JA4 Client Hello
+    ja4_cipher_suite = ",".join(cipher_sorted).replace("0x", "")   # remove 0x prefix in hex numbers
+    return ja4_cipher_suite, f"{len(ja4_cipher_suite.split(',')):02d}"
+
+
+@functools.lru_cache(maxsize=65536)
+def ja4_extensions(extensions, client):
+    """Returns the JA3 extension list without GREASE values, the JA4 extension list and its two digit count."""
+    extensions = strip_grease(extensions.replace(",", "-"), "-", GREASE_DEC)  # JA3 expects a list separated by '-'
+
+    ext = extensions.split("-")
+    if client:  # Client Hello -> sorted list required
+        ext = [e for e in ext if e.strip() and e.isdigit()]  # Filtra cadenas vacías y no numéricas
+        ext_sorted = sorted(ext, key=int)
+    else:  # Server Hello -> the order of extensions preserved
+        ext_sorted = ext
+
+    ja4_ext = ",".join([f"{int(e):04x}" for e in ext_sorted if e and f"{int(e):04x}" not in ["0000", "0010"]])
+    return extensions, ja4_ext, f"{len(ext_sorted):02d}"
+
+
+@functools.lru_cache(maxsize=4096)
+def ja4_tls_version(version_, supported_versions):
+    """Returns the handshake version as an integer and the JA4 version string."""
+    version = int(version_, 16)
+    ja4_version = strip_grease(supported_versions, ",", GREASE_HEX_SET)
+    if not ja4_version:                         # if extension supported_versions is not present
+        ja4_version = f"0x{version:04x}"        # use the handshake TLS version converted to hex
+    else:
+        ja4_version = sorted(ja4_version.split(","))[-1]    # the highest supported version
+    return version, TLS_MAPPER.get(ja4_version, "00")     # map the TLS value to the JA4 string, 00 if not found
+
+
+@functools.lru_cache(maxsize=65536)
+def ja3_groups(supported_groups):
+    """Decimal supported groups without GREASE values for JA3."""
+    groups = [g for g in supported_groups.split(",") if g.strip()]
+    sg = "-".join([hex_to_dec(g) for g in groups]) if groups else "0"
+    return strip_grease(sg, "-", GREASE_DEC)
+
+
+@functools.lru_cache(maxsize=4096)
+def ja4_alpn(alpn):
+    if not alpn:
+        return "00"         # if empty, set the predefined value
+    alpn = alpn.split(",")[0]       # if non-empty, select the first value in the list
+    if len(alpn) > 2:
+        alpn = alpn[0] + alpn[-1]   # if a string is too short, map it to two chars
+    return alpn
+
+
+def handshake_fingerprint(proto, type_, version_, cipher_suite, extensions, ja4_sni, supported_groups, ec_format, alpn, sig, supported_versions):
+    """Computes the fingerprints of one Client Hello (type_ "1") or Server Hello.
+
+    Returns (version, cipher_suite_dec, extensions, sig, ja3, ja4, ja4_r) for a Client Hello and
+    (version, cipher_suite_dec, extensions, sig, ja3s, ja4s, ja4s_r) for a Server Hello.
+    """
+    ja4_protocol = "t" if proto == '6' else "q"     # TCP (TLS over TCP) or UDP (QUIC over UDP)
+    client = type_ == "1"
+    version, ja4_version = ja4_tls_version(version_, supported_versions)
+    cipher_suite_dec = ja3_ciphers(cipher_suite)
+    ja4_cipher_suite, ja4_suites_no = ja4_ciphers(cipher_suite)
+    extensions, ja4_ext, ja4_ext_no = ja4_extensions(extensions, client)
+    alpn = ja4_alpn(alpn)
+    sig = sig.replace("0x", "")
+
+    if client:  # Client Hello fingerprints JA3 and JA4
+        ja3 = md5_hex(f"{version},{cipher_suite_dec},{extensions},{ja3_groups(supported_groups)},{ec_format}")
+        ja4_a = f"{ja4_protocol}{ja4_version}{ja4_sni}{ja4_suites_no}{ja4_ext_no}{alpn}"
+        ja4_b = sha256_hex(ja4_cipher_suite)[:12]
+        ja4_c = sha256_hex(f"{ja4_ext}_{sig}")[:12]
+        return version, cipher_suite_dec, extensions, sig, ja3, f"{ja4_a}_{ja4_b}_{ja4_c}", f"{ja4_a}_{ja4_cipher_suite}_{ja4_ext}_{sig}"
+
+    # Server Hello fingerprints JA3S and JA4S
+    ja3s = md5_hex(f"{version},{cipher_suite_dec},{extensions}")
+    ja4_a = f"{ja4_protocol}{ja4_version}{ja4_ext_no}{alpn}"
+    ja4_c = sha256_hex(ja4_ext)[:12]
+    return version, cipher_suite_dec, extensions, sig, ja3s, f"{ja4_a}_{ja4_cipher_suite}_{ja4_c}", f"{ja4_a}_{ja4_cipher_suite}_{ja4_ext}"
+
+
+def fingerprint_batch(columns, cache=None):
+    """Computes JA3/JA4 (Client Hello) and JA3S/JA4S (Server Hello) fingerprints for a chunk of rows.
+
+    columns maps the names in EXTRACTED_FIELDS to equally long lists of values. Every distinct
+    handshake in the chunk is fingerprinted only once; with a cache (fpcache.LRUCache) the results
+    are also kept across chunks and files, keyed by the raw handshake parameters. Returns a dict of lists with the keys
+    "type", "version", "cipher_suite_dec", "extensions", "sig" and "ja3", "ja4", "ja4_r" (Client Hello)
+    or "ja3s", "ja4s", "ja4s_r" (Server Hello); the fingerprints of the other hello type are None.
+    """
+    types = [t.split(",")[0] for t in columns["type"]]   # only the first handshake type is interesting
+    keys = list(zip(columns["proto"], types, columns["version"], columns["cipher_suite"], columns["extensions"],
+                    ["d" if sni else "i" for sni in columns["sni"]], columns["supported_groups"],
+                    columns["ec_format"], columns["alpn"], columns["sig"], columns["supported_versions"]))
+    if cache is None:
+        unique = {key: None for key in keys}
+        for key in unique:
+            unique[key] = handshake_fingerprint(*key)
+        values = [unique[key] for key in keys]
+    else:
+        values = [cache.get_or_compute(key, handshake_fingerprint, *key) for key in keys]
 
-    file_name = os.path.splitext(os.path.basename(filename))[0]
+    result = {"type": types}
+    for i, name in enumerate(["version", "cipher_suite_dec", "extensions", "sig"]):
+        result[name] = [v[i] for v in values]
+    for i, name in enumerate(["ja3", "ja4", "ja4_r"], 4):
+        result[name] = [v[i] if t == "1" else None for v, t in zip(values, types)]
+    for i, name in enumerate(["ja3s", "ja4s", "ja4s_r"], 4):
+        result[name] = [v[i] if t != "1" else None for v, t in zip(values, types)]
+    return result
 
-    # Cargar archivos adicionales si es necesario
-    if whoisfile:
-        whois_db = load_whois_file(whoisfile)
-    
-    if resfile:
-        res_db = load_resolution_file(resfile)
-    
-    if adfile:
-        addservers = load_adlist()
-    
+
+def read_extracted(filename, chunksize=65536):
+    """Reads the extracted CSV (tshark output) in chunks, yields dicts of columns (see EXTRACTED_FIELDS)."""
     with open(filename, 'r') as file:
         reader = csv.reader(file, delimiter=';')
-        header = next(reader)  # Skip header
-        #print(f"Encabezado {header}")
+        next(reader)  # Skip header
+        while True:
+            rows = list(itertools.islice(reader, chunksize))
+            if not rows:
+                return
+            for row in rows:
+                if len(row) != len(EXTRACTED_FIELDS):
+                    raise ValueError(f"Expected {len(EXTRACTED_FIELDS)} columns, got {len(row)}: {row}")
+            yield dict(zip(EXTRACTED_FIELDS, map(list, zip(*rows))))
+
+
+def parse_frame_time(value):
+    """Converts tshark's frame.time ("Nov 14, 2023 22:13:20.123456789 CET") into seconds, None if it cannot be parsed.
+
+    The time zone name is ignored: the value is only used to measure time between handshakes.
+    """
+    try:
+        date, _, clock = value.rpartition(" ")[0].rpartition(" ")
+        whole, _, frac = clock.partition(".")
+        t = time.strptime(f"{date} {whole}", "%b %d, %Y %H:%M:%S")
+        return calendar.timegm(t) + (float(f"0.{frac}") if frac else 0.0)
+    except ValueError:
+        return None
+
+
+def handshake_rows(filename, short=False, app_name="Unknown", traffic_type="0", res_db=None, whois_db=None, adservers=None, cache=None,
+                   chunks=None):
+    """Yields (type, key, text, time) for every Client Hello (type "1") and Server Hello (type "2") of the extracted CSV.
+
+    For a Client Hello, text is the client part of the output line; for a Server Hello, it is the server part
+    to be appended to the Client Hello with the same key. chunks are the rows as dicts of columns (see
+    read_extracted); by default they are read from filename, which also gives the Filename column.
+    """
+    res_db = res_db or {}
+    whois_db = whois_db or {}
+    adservers = adservers or {}
+    file_name = os.path.splitext(os.path.basename(filename))[0]
+    if chunks is None:
+        chunks = read_extracted(filename)
 
-        for row in reader:
-            srcIP, dstIP, srcTCPort, dstTCPort, srcUDPort, dstUDPort, proto, type_, version_, cipher_suite, extensions, sni, supported_groups, ec_format, alpn, sig, supported_versions, time = row
-            app_type = traffic_type
+    for columns in chunks:
+        fps = fingerprint_batch(columns, cache)
 
-            
-            
+        for i in range(len(fps["type"])):
+            srcIP, dstIP, proto, sni = columns["srcIP"][i], columns["dstIP"][i], columns["proto"][i], columns["sni"][i]
+            app_type = traffic_type
 
             org_name = whois_db.get(dstIP, "") # resolve the dstIP using the WHOIS database
 
-            # Analizar las comunicaciones TLS
             if proto == '6':  # TCP (TLS over TCP)
-                ja4_protocol = "t"
-                srcPort = int(srcTCPort)
-                dstPort = int(dstTCPort)
+                srcPort = int(columns["srcTCPort"][i])
+                dstPort = int(columns["dstTCPort"][i])
             else:  # UDP (QUIC over UDP)
-                ja4_protocol = "q"
-                srcPort = int(srcUDPort)
-                dstPort = int(dstUDPort)
+                srcPort = int(columns["srcUDPort"][i])
+                dstPort = int(columns["dstUDPort"][i])
             
             if res_db.get(srcPort): # check if the local port can be mapped to an application
                 app_type = "0"
                 app_name = res_db[srcPort] # assign the mapping from the external resolution file
-                #print(f"resolution for port {srcPort}: app_name = {app_name}\n")
-            
-            # TLS handshake type (Client Hello = 1, Server Hello = 2)
-            type_ = type_.split(",")[0] # in case of the Server Hello, more types can be included into one packet. Only first value interesting
-            version = int(version_, 16)
-            ja4_cipher_suite = cipher_suite
-            
-
-            if sni: # set the SNI to "d" (domain) if SNI is non-empty or to "i" (IP) if empty
-                ja4_sni = "d"
-                if sni in adservers: # if a SNI is in the ad-list file, the TLS fingerprint is marked as "A" (ads)
-                    app_type = "A"
-            else:
-                ja4_sni = "i"
-            #print(f"SNI {ja4_sni}\n")
-
-            if not alpn:
-                alpn = "00"         # if empty, set the predefined value
-                full_alpn = ""      # initialize the full ALPN string
-            else:
-                full_alpn = alpn   
-                alpn_list = alpn.split(",")   
-                alpn = alpn_list[0]         # if non-empty, select the first value in the list
-                if len(alpn) > 2:
-                    alpn = alpn[0] + alpn[-1]   # if a string is too short, map it to two chars
-            #print(f"ALPN {alpn}\n")
-
-            #SIG: a list of hash algorithms for JA4 signature (extension type 0x0d = 13)
-            ja4_version = supported_versions            # a list of supported versions (extension type 0x2b = 43)
-            supported_versions = supported_versions     # keeps original value for the extended output CSV
-
-            suites = cipher_suite.split(",")            
-            cipher_suite_dec = "-".join([str(int(s, 16)) for s in suites])   # convert the cipher suites from hex to decimal format for JA3 hash
-
-            extensions = extensions.replace(",", "-") # JA4 hash expects a list of extensions separated by '-'
-            for grease in GREASE:                     # exclude GREASE values from the cipher_suites and extensions for JA3
-                cipher_suite_dec = re.sub(f"{grease}-?", "", cipher_suite_dec)
-                extensions = re.sub(f"{grease}-?", "", extensions)
-
-            for grease_hex in GREASE_HEX:            # exclude GREASE_HEX values from cipher_suites and supported_versions for JA4
-                ja4_cipher_suite = re.sub(f"{grease_hex},?", "", ja4_cipher_suite)
-                ja4_version = re.sub(f"{grease_hex},?", "", ja4_version)   
-            
-            suites = ja4_cipher_suite.split(",")    # processing JA4 cipher suites
-            cipher_sorted = sorted(suites)          # sort the cipher suites for JA4 Client Hello
-            ja4_cipher_suite = ",".join(cipher_sorted).replace("0x", "")   # remove 0x prefix in hex numbers
-
-
-            if not ja4_version:                         # if extension supported_versions is not present
-                ja4_version = f"0x{version:04x}"        # use the handshake TLS version converted to hex
-            else:
-                sup_versions = ja4_version.split(",")
-                ver_sorted = sorted(sup_versions)      # select the max SSL version from the supported groups
-                ja4_version = ver_sorted[-1]           # the highest value of the sorted list has the last index
-            
-
-            ja4_version = TLS_MAPPER.get(ja4_version, "00")     # map the TLS value to the JA4 string 00 if current TLS version not found in the list
-
-            ja4_suites_no = len(ja4_cipher_suite.split(","))    # count the number of cipher suites separated by ","
-            ja4_suites_no = f"{ja4_suites_no:02d}"              # two digit number is expected
-
-
-            ext = extensions.split("-")
-            if type_ == "1":  # Client Hello -> sorted list required    
-                ext = [e for e in ext if e.strip() and e.isdigit()]  # Filtra cadenas vacías y no numéricas
-                ext_sorted = sorted(ext, key=int)
-            else:  # Server Hello -> the order of extensions preserved
-                ext_sorted = ext
             
-            ja4_ext_no = f"{len(ext_sorted):02d}"   # the number of extensions
-            ja4_ext = ",".join([f"{int(e):04x}" for e in ext_sorted if e and f"{int(e):04x}" not in ["0000", "0010"]])
-
+            if sni and sni in adservers: # if a SNI is in the ad-list file, the TLS fingerprint is marked as "A" (ads)
+                app_type = "A"
 
-            sig = sig.replace("0x", "")
+            full_alpn = columns["alpn"][i]      # keeps original values for the extended output CSV
+            supported_versions = columns["supported_versions"][i]
+            tls_version = fps["version"][i]
+            cipher_suite_dec = fps["cipher_suite_dec"][i]
+            extensions = fps["extensions"][i]
 
-            groups = supported_groups.split(",")
-            # Filtrar valores vacíos antes de la conversión
-            groups = [g for g in groups if g.strip()]  
-            sg = "-".join([str(int(g, 16)) for g in groups]) if groups else "0"  # convert decimal extension to hexadecimal
+            if fps["type"][i] == "1":  # Client Hello fingerprints JA3 and JA4
+                key = f"{srcIP}:{dstIP}:{srcPort}"                                                  # compute a hash key for the Client Hello
+                ja3, ja4, ja4_r = fps["ja3"][i], fps["ja4"][i], fps["ja4_r"][i]
 
-            for grease in GREASE:                               # exclude GREASE values from the supported groups
-                sg = re.sub(f"{grease}-?", "", sg)
-            
-
-            # compute JA3, JA4, JA3S and JA4S hashes
-
-            if type_ == "1":  # Client Hello fingerprints JA3 and JA4
-                key = f"{srcIP}:{dstIP}:{srcPort}"                                                  # compute a hash key for the Client Hello for tls_db
-                ja3 = md5_hex(f"{version},{cipher_suite_dec},{extensions},{sg},{ec_format}")        # compute the JA3 client fingerprint
-                # compute the JA4 client fingerpring
-                ja4_a = f"{ja4_protocol}{ja4_version}{ja4_sni}{ja4_suites_no}{ja4_ext_no}{alpn}"    
-                ja4_b = sha256_hex(ja4_cipher_suite)[:12]
-                ja4_c = sha256_hex(f"{ja4_ext}_{sig}")[:12]
-                # raw format
-                ja4_r = f"{ja4_a}_{ja4_cipher_suite}_{ja4_ext}_{sig}"
-                # hash format
-                ja4 = f"{ja4_a}_{ja4_b}_{ja4_c}"
-
-                # create a new entry
                 if short:
                     entry = f"{srcIP}{delim}{dstIP}{delim}{srcPort}{delim}{dstPort}{delim}{sni}{delim}{org_name}{delim}{ja3}{delim}{ja4}{delim}{app_name}{delim}{app_type}"
                 else:
-                    entry = f"{srcIP}{delim}{dstIP}{delim}{srcPort}{delim}{dstPort}{delim}{proto}{delim}{sni}{delim}{org_name}{delim}{version}{delim}{cipher_suite_dec}{delim}{extensions}{delim}{supported_groups}{delim}{ec_format}{delim}{full_alpn}{delim}{sig}{delim}{supported_versions}{delim}{ja3}{delim}{ja4}{delim}{ja4_r}{delim}{app_name}{delim}{app_type}"
-                # insert a new entry into the TLS hash array
-                tls_db[key] = entry
+                    entry = f"{srcIP}{delim}{dstIP}{delim}{srcPort}{delim}{dstPort}{delim}{proto}{delim}{sni}{delim}{org_name}{delim}{tls_version}{delim}{cipher_suite_dec}{delim}{extensions}{delim}{columns['supported_groups'][i]}{delim}{columns['ec_format'][i]}{delim}{full_alpn}{delim}{fps['sig'][i]}{delim}{supported_versions}{delim}{ja3}{delim}{ja4}{delim}{ja4_r}{delim}{app_name}{delim}{app_type}"
+                yield "1", key, entry, columns["time"][i]
             
             else:  # Server Hello fingerprints JA3s and JA4s
-                ja3s = md5_hex(f"{version},{cipher_suite_dec},{extensions}")      # compute the JA3 server fingerprint  
-                # compute the JA4 server fingerprint
-                ja4_a = f"{ja4_protocol}{ja4_version}{ja4_ext_no}{alpn}"
-                ja4_b = ja4_cipher_suite
-                ja4_c = sha256_hex(ja4_ext)[:12]
-                # raw format
-                ja4s_r = f"{ja4_a}_{ja4_b}_{ja4_ext}"
-                # hash format
-                ja4s = f"{ja4_a}_{ja4_b}_{ja4_c}"
-                # compute a hash key for the Server Hello for %tls_db
+                ja3s, ja4s, ja4s_r = fps["ja3s"][i], fps["ja4s"][i], fps["ja4s_r"][i]
+                # compute a hash key for the Server Hello (same as the key of its Client Hello)
                 key = f"{dstIP}:{srcIP}:{dstPort}"
 
-                if key in tls_db:   # if a Client Hello exists in the db
-                    entry = tls_db[key]     # add data from the Server Hello to the entry
-                    count = entry.count(delim)  # check the number of delimiters in the entry
-                    if short:
-                        if count > 9:   # 9 - max delimiters for the preprocessed client hello (for raw output)	
-                            return
-                        tls_db[key] = f"{entry}{delim}{ja3s}{delim}{ja4s}{delim}{file_name}{delim}{version}"
-                    else:
-                        if count > 19:  # 19 - max delimiters for the preprocessed client hello (for raw output)
-                            return
-                        # process only client entries without the server part (skip duplicated server Hello)
-                        tls_db[key] = f"{entry}{delim}{cipher_suite_dec}{delim}{extensions}{delim}{supported_versions}{delim}{ja3s}{delim}{ja4s}{delim}{ja4s_r}{delim}{file_name}{delim}{version}"
+                if short:
+                    entry = f"{ja3s}{delim}{ja4s}{delim}{file_name}{delim}{tls_version}"
+                else:
+                    entry = f"{cipher_suite_dec}{delim}{extensions}{delim}{supported_versions}{delim}{ja3s}{delim}{ja4s}{delim}{ja4s_r}{delim}{file_name}{delim}{tls_version}"
+                yield "2", key, entry, columns["time"][i]
+
 
+def load_side_files(resfile=None, whoisfile=None, adfile=None):
+    """Loads the optional resolution, WHOIS and ad-list files, returns (res_db, whois_db, adservers)."""
+    whois_db = {}
+    res_db = {}
+    adservers = {}
 
+    # Cargar archivos adicionales si es necesario
+    if whoisfile:
+        whois_db = load_whois_file(whoisfile)
+    
+    if resfile:
+        res_db = load_resolution_file(resfile)
+    
+    if adfile:
+        adservers = load_adlist(adfile)
+
+    return res_db, whois_db, adservers
+
+
+def process_tls_file(filename, short=False, app_name="Unknown", version="0", traffic_type="0", resfile=None, whoisfile=None, adfile=None, cache=None,
+                     db=None, side_files=None, counts=None):
+    """Matches all Client and Server Hellos of the file in db (the global tls_db by default) and returns it.
+
+    side_files is a (res_db, whois_db, adservers) tuple loaded before by load_side_files(); if it is None,
+    the files are loaded here. If counts (a dict) is given, the numbers of rows read, handshakes matched
+    and duplicated Server Hellos are added to it.
+    """
+    if db is None:
+        db = tls_db
+    if side_files is None:
+        side_files = load_side_files(resfile, whoisfile, adfile)
+    res_db, whois_db, adservers = side_files
+    matched = set()     # keys whose Client Hello already has its Server Hello
+    rows = skipped = 0
+
+    for hello, key, entry, _ in handshake_rows(filename, short, app_name, traffic_type, res_db, whois_db, adservers, cache):
+        rows += 1
+        if hello == "1":
+            db[key] = entry     # insert a new entry into the TLS hash array
+            matched.discard(key)
+        elif key in db and key not in matched:  # if a Client Hello exists in the db, add data from the Server Hello
+            db[key] = f"{db[key]}{delim}{entry}"
+            matched.add(key)
+        else:
+            skipped += 1        # duplicated Server Hellos are skipped
+    if counts is not None:
+        for name, n in (("rows", rows), ("handshakes", len(matched)), ("server_hellos_skipped", skipped)):
+            counts[name] = counts.get(name, 0) + n
+    return db
+
+
+def write_tls_db(db, short=False, out=None):
+    """Prints the header and the entries of db sorted by key."""
+    print_header(short, out)
+    for key in sorted(db.keys()):
+        print(db[key], file=out)
+
+
+class PendingHellos:
+    """Client Hellos waiting for their Server Hello, bounded in number and age."""
+
+    def __init__(self, timeout=60.0, maxsize=100000):
+        self.timeout = timeout
+        self.maxsize = maxsize
+        self.pending = OrderedDict()    # key -> (time, entry), oldest first
+        self.now = None
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, key, entry, t):
+        """Adds a Client Hello; a pending Client Hello with the same key is replaced (as in tls_db)."""
+        self.pending.pop(key, None)
+        self.pending[key] = (t if t is not None else self.now, entry)
+
+    def match(self, key):
+        """Removes and returns the pending Client Hello of key, None if there is none."""
+        item = self.pending.pop(key, None)
+        return item[1] if item else None
+
+    def expire(self, now):
+        """Yields the Client Hellos older than the timeout and the oldest ones above maxsize."""
+        if now is not None:
+            self.now = now
+        while self.pending:
+            key, (t, entry) = next(iter(self.pending.items()))
+            too_old = self.now is not None and t is not None and t < self.now - self.timeout
+            if not too_old and len(self.pending) <= self.maxsize:
+                break
+            del self.pending[key]
+            yield entry
+
+    def drain(self):
+        """Yields all remaining Client Hellos (end of input)."""
+        while self.pending:
+            yield self.pending.popitem(last=False)[1][1]
+
+
+def match_hellos(rows, pending, end=True, counts=None):
+    """Yields the output lines of handshake rows (handshake_rows) matching Client and Server Hellos.
+
+    A Client Hello waits in pending (PendingHellos) for its Server Hello, and is yielded alone when
+    it expires and, if end is true, after the last row. Server Hellos without a pending Client Hello
+    (or duplicated) are skipped. If counts (a dict) is given, the numbers of rows read, handshakes
+    matched, Client Hellos yielded alone (expired: before the end) and Server Hellos skipped are added to it.
+    """
+    n = {"rows": 0, "handshakes": 0, "client_hellos_expired": 0, "client_hellos_unmatched": 0, "server_hellos_skipped": 0}
+    try:
+        for hello, key, entry, frame_time in rows:
+            n["rows"] += 1
+            for client in pending.expire(parse_frame_time(frame_time)):
+                n["client_hellos_expired"] += 1
+                yield client
+            if hello == "1":
+                pending.add(key, entry, pending.now)
+                for client in pending.expire(None):     # maxsize
+                    n["client_hellos_expired"] += 1
+                    yield client
+            else:
+                client = pending.match(key)
+                if client is not None:
+                    n["handshakes"] += 1
+                    yield f"{client}{delim}{entry}"
+                else:
+                    n["server_hellos_skipped"] += 1
+        if end:
+            for client in pending.drain():
+                n["client_hellos_unmatched"] += 1
+                yield client
+    finally:
+        if counts is not None:
+            for name, value in n.items():
+                counts[name] = counts.get(name, 0) + value
+
+
+def stream_tls_file(filename, out=sys.stdout, short=False, app_name="Unknown", traffic_type="0", resfile=None, whoisfile=None, adfile=None,
+                    cache=None, timeout=60.0, max_pending=100000, counts=None):
+    """Writes every Client Hello as soon as its Server Hello is seen, in constant memory.
+
+    Client Hellos without a Server Hello are written alone when they are older than timeout seconds
+    (Time column), when more than max_pending are waiting, or at the end of the file.
+    Lines are written in the order the handshakes complete, not sorted. If counts (a dict) is given,
+    the counters of match_hellos are added to it.
+    """
+    res_db, whois_db, adservers = load_side_files(resfile, whoisfile, adfile)
+    rows = handshake_rows(filename, short, app_name, traffic_type, res_db, whois_db, adservers, cache)
+    for line in match_hellos(rows, PendingHellos(timeout, max_pending), counts=counts):
+        out.write(f"{line}\n")
+
+
+def print_header(short=False, out=None):
+    if short:
+        print(f"SrcIP{delim}DstIP{delim}SrcPort{delim}DstPort{delim}SNI{delim}OrgName{delim}JA3hash{delim}JA4hash{delim}AppName{delim}Type{delim}JA3Shash{delim}JA4Shash{delim}Filename{delim}Version", file=out)
+    else:
+        print(f"SrcIP{delim}DstIP{delim}SrcPort{delim}DstPort{delim}Proto{delim}SNI{delim}OrgName{delim}TLSVersion{delim}ClientCipherSuite{delim}ClientExtensions{delim}ClientSupportedGroups{delim}EC_fmt{delim}ALPN{delim}SignatureAlgorithms{delim}ClientSupportedVersions{delim}JA3hash{delim}JA4hash{delim}JA4_raw{delim}AppName{delim}Type{delim}ServerCipherSuite{delim}ServerExtensions{delim}ServerSupportedVersions{delim}JA3Shash{delim}JA4Shash{delim}JA4S_raw{delim}Filename{delim}Version", file=out)
 
 
 def parse_args():
@@ -258,20 +516,47 @@ def parse_args():
     parser.add_argument("-res", type=str, help="Resolution file (maps ports to process names)")
     parser.add_argument("-whois", type=str, help="WHOIS file (maps IP to organization)")
     parser.add_argument("-adlist", type=str, help="Ad list file (contains ad server domain names)")
+    parser.add_argument("-cache-size", type=int, default=65536, help="Max. number of cached handshake fingerprints (0 disables the cache)")
+    parser.add_argument("-cache-file", type=str, help="File to load the fingerprint cache from and save it into")
+    parser.add_argument("-stream", action="store_true", help="Print handshakes as soon as they are matched (unsorted, constant memory)")
+    parser.add_argument("-timeout", type=float, default=60.0, help="Stream mode: seconds a Client Hello waits for its Server Hello")
+    parser.add_argument("-max-pending", type=int, default=100000, help="Stream mode: max. number of Client Hellos waiting for a Server Hello")
+    parser.add_argument("-cache-stats", action="store_true", help="Print cache hits, misses and evictions to stderr")
+    parser.add_argument("-metrics", type=str, help="Write the timings and counters of the run into <prefix>.json and <prefix>.prom")
+    parser.add_argument("-parquet", type=str, help="Write the output into a Parquet file (typed columns) instead of stdout")
     return parser.parse_args()
 
 if __name__ == '__main__':
     args = parse_args()
-    process_tls_file(args.file, short=args.short, app_name=args.app, version=args.ver, traffic_type=args.type,
-                     resfile=args.res, whoisfile=args.whois, adfile=args.adlist)
-
-    if args.short:
-        print(f"SrcIP{delim}DstIP{delim}SrcPort{delim}DstPort{delim}SNI{delim}OrgName{delim}JA3hash{delim}JA4hash{delim}AppName{delim}Type{delim}JA3Shash{delim}JA4Shash{delim}Filename{delim}Version")
+    cache = None
+    if args.cache_size > 0:
+        cache = LRUCache(args.cache_size, name="Fingerprint cache")
+        if args.cache_file:
+            cache.load(args.cache_file, tag=CACHE_TAG)
+
+    metrics = Metrics("ja4", os.path.basename(args.metrics) if args.metrics else None)
+    out = open_table(args.parquet, delimiter=delim) if args.parquet else sys.stdout
+    if args.stream:
+        with metrics.stage("fingerprint") as stage:
+            print_header(args.short, out)
+            stream_tls_file(args.file, out=out, short=args.short, app_name=args.app, traffic_type=args.type, resfile=args.res,
+                            whoisfile=args.whois, adfile=args.adlist, cache=cache, timeout=args.timeout, max_pending=args.max_pending,
+                            counts=stage.counters)
     else:
-        print(f"SrcIP{delim}DstIP{delim}SrcPort{delim}DstPort{delim}Proto{delim}SNI{delim}OrgName{delim}TLSVersion{delim}ClientCipherSuite{delim}ClientExtensions{delim}ClientSupportedGroups{delim}EC_fmt{delim}ALPN{delim}SignatureAlgorithms{delim}ClientSupportedVersions{delim}JA3hash{delim}JA4hash{delim}JA4_raw{delim}AppName{delim}Type{delim}ServerCipherSuite{delim}ServerExtensions{delim}ServerSupportedVersions{delim}JA3Shash{delim}JA4Shash{delim}JA4S_raw{delim}Filename{delim}Version")
-
-    for key in sorted(tls_db.keys()):
-        print(tls_db[key])
-    
-    
-    
\ No newline at end of file
+        with metrics.stage("fingerprint") as stage:
+            process_tls_file(args.file, short=args.short, app_name=args.app, version=args.ver, traffic_type=args.type,
+                             resfile=args.res, whoisfile=args.whois, adfile=args.adlist, cache=cache, counts=stage.counters)
+        with metrics.stage("write") as stage:
+            write_tls_db(tls_db, args.short, out)
+            stage.add("lines", len(tls_db))
+    if args.parquet:
+        out.close()
+
+    if cache is not None:
+        if args.cache_file:
+            cache.save(args.cache_file, tag=CACHE_TAG)
+        if args.cache_stats:
+            print(cache.report(), file=sys.stderr)
+        metrics.add_lru(cache)
+    if args.metrics:
+        metrics.save(args.metrics)
@@ -1,6 +1,19 @@
+import os
+import sys
 import subprocess
-import csv
+import functools
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from instrument import Metrics
+from columnar import open_table
+
+JA4TS_HEADER = ["SrcIP", "DstIP", "SrcPort", "DstPort", "ja4ts"]
+JA4T_HEADER = ["SrcIP", "DstIP", "SrcPort", "DstPort", "ja4t"]
+
+TCP_SYN = 0x02
+TCP_ACK = 0x10
+
+@functools.lru_cache(maxsize=1024)  # hay muy pocas combinaciones distintas de opciones
 def parse_tcp_options_raw(hex_str):
     """Parsea la cadena hexadecimal cruda de tcp.options y extrae los tipos en orden"""
     types = []
@@ -19,7 +32,22 @@ def parse_tcp_options_raw(hex_str):
             i += length * 2
     return "-".join(types)
 
-def extract_ja4ts_tshark(pcap_file, output_csv):
+def ja4ts_fingerprint(window, options_raw, mss, wscale):
+    """Construye la huella JA4TS (SYN-ACK) o JA4T (SYN) a partir de los campos TCP"""
+    ja4_b = parse_tcp_options_raw(hex_str=options_raw)
+
+    window = window or "0"
+    mss = mss or "0"
+    wscale = wscale or "0"
+
+    return f"{window}-{ja4_b}-{mss}-{wscale}"
+
+def extract_ja4ts_tshark(pcap_file, output_csv, ja4t_csv=None, stage=None):
+    """Escribe las huellas JA4TS de los SYN-ACK en output_csv y, si se indica, las JA4T de los SYN en ja4t_csv.
+
+    La salida de tshark se lee línea a línea y cada fila se escribe en cuanto se lee (memoria constante).
+    Con stage (instrument.Stage) se cuentan las filas y el tiempo bloqueado esperando a tshark.
+    """
     # Campos necesarios
     fields = [
         "ip.src",
@@ -29,13 +57,17 @@ def extract_ja4ts_tshark(pcap_file, output_csv):
         "tcp.window_size_value",      # ja4_a
         "tcp.options",                # ja4_b (orden de opciones)
         "tcp.options.mss_val",        # ja4_c
-        "tcp.options.wscale.shift"          # ja4_d
+        "tcp.options.wscale.shift",         # ja4_d
+        "tcp.flags"
     ]
 
-    # Comando tshark para SYN-ACK
+    # Comando tshark para SYN-ACK (y SYN para JA4T)
+    display_filter = "tcp.flags == 0x12"
+    if ja4t_csv:
+        display_filter += " or (tcp.flags.syn == 1 and tcp.flags.ack == 0)"
     cmd = [
         "tshark", "-r", pcap_file,
-        "-Y", "tcp.flags == 0x12",
+        "-Y", display_filter,
         "-T", "fields"
     ]
 
@@ -46,32 +78,36 @@ def extract_ja4ts_tshark(pcap_file, output_csv):
     cmd.extend(["-E", "separator=,", "-E", "quote=d", "-E", "occurrence=f"])
 
     # Ejecutar tshark
-    result = subprocess.run(cmd, capture_output=True, text=True)
-    lines = result.stdout.strip().split("\n")
+    ps = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
 
-    with open(output_csv, "w", newline="") as f:
-        writer = csv.writer(f, delimiter=";")
-        writer.writerow(["SrcIP", "DstIP", "SrcPort", "DstPort", "ja4ts"])  # cabecera
+    # CSV o Parquet (si el nombre acaba en .parquet), con cabecera
+    with open_table(output_csv, JA4TS_HEADER, delimiter=";") as writer, \
+            open_table(ja4t_csv or os.devnull, JA4T_HEADER, delimiter=";") as syn_writer:
 
-        for line in lines:
-            parts = [p.strip('"') for p in line.split(",")]
+        synacks = syns = 0
+        for line in (ps.stdout if stage is None else stage.wait(ps.stdout)):
+            parts = [p.strip('"') for p in line.strip().split(",")]
             if len(parts) != len(fields):
                 continue  # saltar líneas incompletas
 
-            src_ip, dst_ip, src_port, dst_port, ja4_a, options_raw, mss, wscale = parts
-
-            ja4_b = parse_tcp_options_raw(hex_str=options_raw)
-            
-
-            ja4_a = ja4_a or "0"
-            mss = mss or "0"
-            wscale = wscale or "0"
+            src_ip, dst_ip, src_port, dst_port, ja4_a, options_raw, mss, wscale, flags = parts
 
-            ja4ts = f"{ja4_a}-{ja4_b}-{mss}-{wscale}"
+            ja4ts = ja4ts_fingerprint(ja4_a, options_raw, mss, wscale)
 
-            writer.writerow([dst_ip, src_ip, dst_port, src_port, ja4ts])
+            if int(flags, 16) & TCP_ACK:
+                writer.writerow([dst_ip, src_ip, dst_port, src_port, ja4ts])
+                synacks += 1
+            else:
+                syn_writer.writerow([src_ip, dst_ip, src_port, dst_port, ja4ts])  # JA4T: del cliente al servidor
+                syns += 1
 
+    ps.wait()
+    if stage is not None:
+        stage.add("synacks", synacks)
+        stage.add("syns", syns)
     print(f"[✓] CSV generado en '{output_csv}'")
+    if ja4t_csv:
+        print(f"[✓] CSV generado en '{ja4t_csv}'")
 
 
 # Ejemplo de uso
@@ -79,7 +115,14 @@ if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser(description="Extraer JA4TS desde SYN-ACK en un PCAP")
     parser.add_argument("pcap", help="Archivo PCAP de entrada")
-    parser.add_argument("-o", "--output", help="Archivo CSV de salida", default="ja4ts_output.csv")
+    parser.add_argument("-o", "--output", help="Archivo CSV de salida (Parquet si acaba en .parquet)", default="ja4ts_output.csv")
+    parser.add_argument("--ja4t", help="Archivo CSV de salida para las huellas JA4T de los SYN (misma pasada de tshark)")
+    parser.add_argument("--metrics", help="Guarda tiempos y contadores de la ejecución en <prefijo>.json y <prefijo>.prom")
     args = parser.parse_args()
 
-    extract_ja4ts_tshark(args.pcap, args.output)
+    metrics = Metrics("ja4ts", os.path.basename(args.metrics) if args.metrics else None)
+    with metrics.stage("ja4ts") as stage:
+        extract_ja4ts_tshark(args.pcap, args.output, args.ja4t, stage)
+    if args.metrics:
+        metrics.add_lru_cache("parse_tcp_options_raw", parse_tcp_options_raw)
+        metrics.save(args.metrics)
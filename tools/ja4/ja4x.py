@@ -6,8 +6,16 @@ from hashlib import sha256
 import argparse
 from subprocess import PIPE, Popen
 from datetime import datetime
+from collections import OrderedDict
+import functools
 import signal
 
+from fpcache import LRUCache
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from instrument import Metrics
+from columnar import open_table
+
 
 SAMPLE_COUNT = 200
 raw_fingerprint = False
@@ -17,10 +25,14 @@ debug = False
 mode = "default"
 fp_out = None
 jsons = []
-conn_cache = {}
-http_cache = {}
-quic_cache = {}
-TCP_FLAGS = { 'SYN': 0x0002, 'ACK': 0x0010, 'FIN': 0x0001 }
+conn_cache = OrderedDict()   # stream -> state, least recently seen first
+http_cache = OrderedDict()
+quic_cache = OrderedDict()
+TCP_FLAGS = { 'SYN': 0x0002, 'ACK': 0x0010, 'FIN': 0x0001, 'RST': 0x0004 }
+IDLE_TIMEOUT = 300           # seconds without packets after which the state of a stream is dropped
+# the same server chains (CDNs, common intermediates) come in almost every flow
+rdn_cache = LRUCache(16384, name="Issuer/subject cache")      # (issuer OIDs, subject OIDs) -> hex lists and hashes
+ext_cache = LRUCache(16384, name="Extension cache")           # extension OIDs -> hash of the extensions
 
 
 keymap = {
@@ -82,6 +94,43 @@ def cache_update(x, field, value, debug_stream=-1):
         update = True
     return update
 
+def packet_time(x):
+    """Packet timestamp in seconds (frame.time_epoch), None if it cannot be parsed."""
+    try:
+        return float(x['timestamp'])
+    except (KeyError, ValueError):
+        try:
+            return datetime.fromisoformat(x['timestamp'].replace('Z', '+00:00')[:26]).timestamp()  # newer tshark: ISO 8601
+        except (KeyError, ValueError):
+            return None
+
+def touch_stream(x):
+    """Marks the stream of the packet as the most recently seen one."""
+    cache = get_cache(x)
+    stream = x['stream']
+    if stream in cache:
+        cache.move_to_end(stream)
+        cache[stream]['last_seen'] = packet_time(x)
+
+def close_stream(x):
+    """Drops the state of a TCP stream (FIN or RST)."""
+    conn_cache.pop(x['stream'], None)
+    http_cache.pop(x['stream'], None)
+
+def evict_idle(now, timeout=IDLE_TIMEOUT):
+    """Drops the state of the streams without packets in the last timeout seconds; returns how many were dropped."""
+    if now is None:
+        return 0
+    dropped = 0
+    for cache in (conn_cache, http_cache, quic_cache):
+        while cache:
+            state = next(iter(cache.values()))
+            if state.get('last_seen') is None or state['last_seen'] >= now - timeout:
+                break
+            cache.popitem(last=False)
+            dropped += 1
+    return dropped
+
 def scan_tls(layer):
     if not layer:
         return None
@@ -128,7 +177,8 @@ def layer_update(x, pkt, layer):
             x.update({'rdn_oids': l['x509if_x509if_oid']})
         x.update({'printable_certs': l['x509sat_x509sat_printableString']}) if 'x509sat_x509sat_printableString' in l else None
 
-def encode_variable_length_quantity(v: int) -> list:
+@functools.lru_cache(maxsize=4096)
+def encode_variable_length_quantity(v: int) -> tuple:
     m = 0x00
     output = []
     while v >= 0x80:
@@ -136,8 +186,9 @@ def encode_variable_length_quantity(v: int) -> list:
         v = v >> 7
         m = 0x80
     output.insert(0, v | m)
-    return output
+    return tuple(output)
 
+@functools.lru_cache(maxsize=4096)
 def oid_to_hex(oid: str) -> str:
     a = [int(x) for x in oid.split(".")]
     oid = [a[0] * 40 + a[1]]
@@ -165,19 +216,33 @@ def remove_oids(seq, oids):
     for oid in oids:
         seq.remove(oid) if oid in seq else None
 
+def rdn_hashes(issuer_oids, subject_oids):
+    issuers = [oid_to_hex(issuer) for issuer in issuer_oids]
+    subjects = [oid_to_hex(subject) for subject in subject_oids]
+    return tuple(issuers), tuple(subjects), sha_encode(issuers), sha_encode(subjects)
+
+def extension_hash(exts):
+    hex_strings = [oid_to_hex(ext) for ext in exts]
+    return sha256(",".join(hex_strings).encode('utf8')).hexdigest()[:12]
+
 def issuers_subjects(x):
     for issuer_len, subject_len in zip(x['issuer_sequence'], x['subject_sequence']):
         # we have one issuer and subject sequence for each certificate
-        issuers = []
-        subjects = []
-        for i in range(0, int(issuer_len)):
-            issuer = x['rdn_oids'].pop(0)
-            issuers.append(oid_to_hex(issuer))
-        for i in range(0, int(subject_len)):
-            subject = x['rdn_oids'].pop(0)
-            subjects.append(oid_to_hex(subject))
+        issuer_oids = tuple(x['rdn_oids'].pop(0) for i in range(0, int(issuer_len)))
+        subject_oids = tuple(x['rdn_oids'].pop(0) for i in range(0, int(subject_len)))
+        issuers, subjects, i_hash, s_hash = rdn_cache.get_or_compute((issuer_oids, subject_oids), rdn_hashes, issuer_oids, subject_oids)
+        yield list(issuers), list(subjects), i_hash, s_hash
 
-        yield issuers, subjects, sha_encode(issuers), sha_encode(subjects)
+
+def cache_report():
+    """Hit rates of the certificate caches, one line per cache."""
+    lines = [rdn_cache.report(), ext_cache.report()]
+    for func in (oid_to_hex, encode_variable_length_quantity):
+        info = func.cache_info()
+        lookups = info.hits + info.misses
+        lines.append(f"{func.__name__}: {info.hits} hits, {info.misses} misses, {info.currsize}/{info.maxsize} entries "
+                     f"(hit rate {100 * info.hits / lookups if lookups else 0.0:.1f}%)")
+    return "\n".join(lines)
 
 
 # Función principal para JA4X
@@ -236,38 +301,41 @@ def to_ja4x(x, debug_stream=-1):
         exts = x['cert_extensions'][:i] if isinstance(x['cert_extensions'], list) else [x['cert_extensions']]
         if isinstance(x['cert_extensions'], list):
             del x['cert_extensions'][:i]
-        hex_strings = [oid_to_hex(ext) for ext in exts]
+        exts = tuple(exts)
 
-        ja4x = f'{x["issuer_hashes"][idx]}_{x["subject_hashes"][idx]}_' + sha256(",".join(hex_strings).encode('utf8')).hexdigest()[:12]
+        ja4x = f'{x["issuer_hashes"][idx]}_{x["subject_hashes"][idx]}_' + ext_cache.get_or_compute(exts, extension_hash, exts)
         x[f'JA4X.{idx+1}'] = ja4x
         x['ja4x_list'].append(ja4x)  
         cache_update(x, f'JA4X.{idx+1}', x[f'JA4X.{idx+1}'], debug_stream)
     return x
 
+JA4X_HEADER = ['SrcIP', 'DstIP', 'SrcPort', 'DstPort', 'JA4X', 'Issuer', 'Subject']
+
+def ja4x_row(entry):
+    # Unir todas las huellas JA4X, Issuers y Subjects en cadenas separadas por comas
+    ja4x_str = ', '.join(entry.get('ja4x_list', []))
+    issuer_str = ', '.join(entry.get('issuer_list', []))
+    subject_str = ', '.join(entry.get('subject_list', []))
+
+    # El certificado lo envía el servidor, la fila se orienta desde el cliente
+    return [
+        entry['dst'],
+        entry['src'],
+        entry['dstport'],
+        entry['srcport'],
+        ja4x_str,  # Columna JA4X
+        issuer_str,  # Columna Issuer
+        subject_str  # Columna Subject
+    ]
+
 def save_to_csv(data, filename):
     with open(filename, mode='w', newline='') as file:
         writer = csv.writer(file, delimiter=';')
         # Encabezados del CSV
-        writer.writerow(['SrcIP', 'DstIP', 'SrcPort', 'DstPort', 'JA4X', 'Issuer', 'Subject'])
-        
+        writer.writerow(JA4X_HEADER)
+
         for entry in data:
-            # Unir todas las huellas JA4X en una sola cadena separada por comas
-            ja4x_str = ', '.join(entry.get('ja4x_list', []))
-            # Unir todos los Issuers en una sola cadena separada por comas
-            issuer_str = ', '.join(entry.get('issuer_list', []))
-            # Unir todos los Subjects en una sola cadena separada por comas
-            subject_str = ', '.join(entry.get('subject_list', []))
-            
-            # Escribir la fila en el CSV
-            writer.writerow([
-                entry['dst'],
-                entry['src'], 
-                entry['dstport'], 
-                entry['srcport'],
-                ja4x_str,  # Columna JA4X
-                issuer_str,  # Columna Issuer
-                subject_str  # Columna Subject
-            ])
+            writer.writerow(ja4x_row(entry))
 
 # Función principal
 def main():
@@ -275,101 +343,126 @@ def main():
 
     parser = argparse.ArgumentParser(description="Extrae huellas JA4X de un archivo PCAP y guarda en CSV.")
     parser.add_argument("pcap", help="Archivo PCAP a procesar")
-    parser.add_argument("-o", "--output", help="Archivo CSV de salida", default="output.csv")
+    parser.add_argument("-o", "--output", help="Archivo CSV de salida (Parquet si acaba en .parquet)", default="output.csv")
+    parser.add_argument("--cache-stats", action="store_true", help="Muestra la tasa de aciertos de las cachés de certificados")
+    parser.add_argument("--idle-timeout", type=float, default=IDLE_TIMEOUT, help="Segundos sin paquetes tras los que se descarta el estado de un stream")
+    parser.add_argument("--metrics", help="Guarda tiempos y contadores de la ejecución en <prefijo>.json y <prefijo>.prom")
     args = parser.parse_args()
-
-    # Procesar el archivo PCAP
-    ps = Popen(["tshark", "-r", args.pcap, "-T", "ek", "-n"], stdout=PIPE, encoding='utf-8')
-    data = []
-
-    for idx, line in enumerate(iter(ps.stdout.readline, '')): # enumerate(sys.stdin):
-        if "layers" in line:
-            pkt = json.loads(line)
-            layers = pkt['layers'] 
-
-            x = {}
-            layer_update(x, pkt, 'frame')
-            layer_update(x, pkt, 'ip') if 'ipv6' not in x['protos'] else layer_update(x, pkt, 'ipv6')
-
-            if 'tcp' in x['protos']:
-                layer_update(x, pkt, 'tcp') 
-                if 'ocsp' in x['protos'] or 'x509ce' in x['protos']:
-                    layer_update(x, pkt, 'x509af') 
-                elif 'http' in x['protos']:
-                    if 'http2' in x['protos']:
-                        layer_update(x, pkt, 'http2') 
-                    else:
-                        layer_update(x, pkt, 'http') 
-                elif 'tls' in x['protos']:
-                    layer_update(x, pkt, 'tls') 
-                elif 'ssh' in x['protos']:
-                    layer_update(x, pkt, 'ssh')
-                x['quic'] = False
-
-
-            elif 'udp' in x['protos'] and 'quic' in x['protos']: 
-                layer_update(x, pkt, 'udp')
-                layer_update(x, pkt, 'quic')
-                x['quic'] = True
-
-            else:
-                continue
-
-            if 'stream' not in x:
-                continue
-
-            # We update the stream value into the cache first
-            # to start recording this entry and then the tuple as well
-            #print (idx, x['stream'], x['protos'])
-            x['stream'] = int(x['stream'])
-
-            [ cache_update(x, key, x[key]) for key in [ 'stream', 'src', 'dst', 'srcport', 'dstport', 'protos' ] ] #if x['srcport'] != '443' else None
-
-            # Added for SSH
-            if 'tcp' in x['protos'] and 'ja4ssh' in output_types:
-                if (int(x['srcport']) == 22) or (int(x['dstport']) == 22):
-                    cache_update(x, 'count', 0)
-                    cache_update(x, 'stats', [])
+    metrics = Metrics("ja4x", os.path.basename(args.metrics) if args.metrics else None)
+    packets = chains = dropped = 0
+
+    with metrics.stage("ja4x") as stage:
+        # Procesar el archivo PCAP
+        ps = Popen(["tshark", "-r", args.pcap, "-T", "ek", "-n"], stdout=PIPE, encoding='utf-8')
+        # Las filas se escriben en cuanto se procesa cada cadena de certificados (Parquet si la salida acaba en .parquet)
+        writer = out = open_table(args.output, JA4X_HEADER, delimiter=';')
+
+        # el tiempo bloqueado leyendo la tubería es el tiempo de disección de tshark
+        for idx, line in enumerate(stage.wait(iter(ps.stdout.readline, ''))): # enumerate(sys.stdin):
+            if "layers" in line:
+                packets += 1
+                pkt = json.loads(line)
+                layers = pkt['layers'] 
+
+                x = {}
+                layer_update(x, pkt, 'frame')
+                layer_update(x, pkt, 'ip') if 'ipv6' not in x['protos'] else layer_update(x, pkt, 'ipv6')
+
+                if 'tcp' in x['protos']:
+                    layer_update(x, pkt, 'tcp') 
+                    if 'ocsp' in x['protos'] or 'x509ce' in x['protos']:
+                        layer_update(x, pkt, 'x509af') 
+                    elif 'http' in x['protos']:
+                        if 'http2' in x['protos']:
+                            layer_update(x, pkt, 'http2') 
+                        else:
+                            layer_update(x, pkt, 'http') 
+                    elif 'tls' in x['protos']:
+                        layer_update(x, pkt, 'tls') 
+                    elif 'ssh' in x['protos']:
+                        layer_update(x, pkt, 'ssh')
+                    x['quic'] = False
+
+
+                elif 'udp' in x['protos'] and 'quic' in x['protos']: 
+                    layer_update(x, pkt, 'udp')
+                    layer_update(x, pkt, 'quic')
+                    x['quic'] = True
+
+                else:
+                    continue
+
+                if 'stream' not in x:
+                    continue
+
+                # We update the stream value into the cache first
+                # to start recording this entry and then the tuple as well
+                #print (idx, x['stream'], x['protos'])
+                x['stream'] = int(x['stream'])
+
+                [ cache_update(x, key, x[key]) for key in [ 'stream', 'src', 'dst', 'srcport', 'dstport', 'protos' ] ] #if x['srcport'] != '443' else None
+                touch_stream(x)
+                dropped += evict_idle(packet_time(x), args.idle_timeout)
+
+                # Added for SSH
+                if 'tcp' in x['protos'] and 'ja4ssh' in output_types:
+                    if (int(x['srcport']) == 22) or (int(x['dstport']) == 22):
+                        cache_update(x, 'count', 0)
+                        cache_update(x, 'stats', [])
                     
 
-            # Timestamp recording happens on cache here
-            # This is for TCP
-            if 'tcp' in x['protos']: # and 'tls' not in x['protos']:
-                if 'flags' in x:
-                    flags = int(x['flags'], 0)
-                    if (flags & TCP_FLAGS['SYN']) and not (flags & TCP_FLAGS['ACK']):
-                        cache_update(x, 'A', x['timestamp'])
-                        cache_update(x, 'timestamp', x['timestamp'])
-                        cache_update(x, 'client_ttl', x['ttl']) if 'ttl' in x else None
-                    if (flags & TCP_FLAGS['SYN']) and (flags & TCP_FLAGS['ACK']):
-                        cache_update(x, 'B', x['timestamp'])
-                        cache_update(x, 'server_ttl', x['ttl']) if 'ttl' in x else None
-                    if (flags & TCP_FLAGS['ACK']) and not (flags & TCP_FLAGS['SYN']) and 'ack' in x and x['ack'] == '1' and 'seq' in x and x['seq'] == '1':
-                        cache_update(x, 'C', x['timestamp'])
-
-            # Timestamp recording for QUIC, printing of QUIC JA4 and JA4S happens
-            # after we see the final D packet.
-            if 'packet_type' in x:
-                if x['packet_type'] == '0' and 'type' in x and x['type'] == '1':
-                    cache_update(x, 'A', x['timestamp']) 
-                    cache_update(x, 'client_ttl', x['ttl'])
-                if x['packet_type'] == '0' and 'type' in x and x['type'] == '2':
-                    cache_update(x, 'B', x['timestamp']) 
-                    cache_update(x, 'server_ttl', x['ttl'])
-                if x['packet_type'] == '2' and x['srcport'] == '443':
-                    cache_update(x, 'C', x['timestamp']) 
-                if x['packet_type'] == '2' and x['dstport'] == '443':
-                    if (cache_update(x, 'D', x['timestamp'])):
-                        continue
+                # Timestamp recording happens on cache here
+                # This is for TCP
+                if 'tcp' in x['protos']: # and 'tls' not in x['protos']:
+                    if 'flags' in x:
+                        flags = int(x['flags'], 0)
+                        if (flags & TCP_FLAGS['SYN']) and not (flags & TCP_FLAGS['ACK']):
+                            cache_update(x, 'A', x['timestamp'])
+                            cache_update(x, 'timestamp', x['timestamp'])
+                            cache_update(x, 'client_ttl', x['ttl']) if 'ttl' in x else None
+                        if (flags & TCP_FLAGS['SYN']) and (flags & TCP_FLAGS['ACK']):
+                            cache_update(x, 'B', x['timestamp'])
+                            cache_update(x, 'server_ttl', x['ttl']) if 'ttl' in x else None
+                        if (flags & TCP_FLAGS['ACK']) and not (flags & TCP_FLAGS['SYN']) and 'ack' in x and x['ack'] == '1' and 'seq' in x and x['seq'] == '1':
+                            cache_update(x, 'C', x['timestamp'])
+                        if flags & (TCP_FLAGS['FIN'] | TCP_FLAGS['RST']):
+                            close_stream(x)
+
+                # Timestamp recording for QUIC, printing of QUIC JA4 and JA4S happens
+                # after we see the final D packet.
+                if 'packet_type' in x:
+                    if x['packet_type'] == '0' and 'type' in x and x['type'] == '1':
+                        cache_update(x, 'A', x['timestamp']) 
+                        cache_update(x, 'client_ttl', x['ttl'])
+                    if x['packet_type'] == '0' and 'type' in x and x['type'] == '2':
+                        cache_update(x, 'B', x['timestamp']) 
+                        cache_update(x, 'server_ttl', x['ttl'])
+                    if x['packet_type'] == '2' and x['srcport'] == '443':
+                        cache_update(x, 'C', x['timestamp']) 
+                    if x['packet_type'] == '2' and x['dstport'] == '443':
+                        if (cache_update(x, 'D', x['timestamp'])):
+                            continue
 
             
 
-            if x['hl'] == 'x509af':
-                to_ja4x(x) 
-                #print(x)
-                data.append(x)
-
-    save_to_csv(data, args.output)
+                if x['hl'] == 'x509af':
+                    to_ja4x(x) 
+                    #print(x)
+                    writer.writerow(ja4x_row(x))
+                    chains += 1
+
+        out.close()
+        ps.wait()
+        for name, n in (("packets", packets), ("certificate_chains", chains), ("streams_dropped", dropped)):
+            stage.add(name, n)
+    if args.metrics:
+        for cache in (rdn_cache, ext_cache):
+            metrics.add_lru(cache)
+        for func in (oid_to_hex, encode_variable_length_quantity):
+            metrics.add_lru_cache(func.__name__, func)
+        metrics.save(args.metrics)
+    if args.cache_stats:
+        print(cache_report())
     print(f"Datos guardados en {args.output}")
 
 if __name__ == '__main__':
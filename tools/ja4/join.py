@@ -1,32 +1,223 @@
-import pandas as pd
+#!/usr/bin/env python3
+#
+# join.py <JA4 CSV or .parquet> <JA4X CSV or .parquet> <JA4TS CSV or .parquet> [-o <output CSV or .parquet>] [--run-size <rows>] [--metrics <prefix>]
+#
+# Une las huellas JA4/JA4S, JA4X y JA4TS de un flujo (full outer join por SrcIP, DstIP, SrcPort, DstPort).
+#
+# The 4-tuple is encoded into one integer key (96 bits for IPv4, see flow_key). Each input is
+# sorted by the key with an external merge sort (sorted runs of --run-size rows in temporary
+# files, merged with heapq), and the sorted inputs are merge-joined, so the inputs can be larger
+# than memory. The result is written sorted by the key; the output may be one of the inputs
+# (get-ja4.sh does that), it is replaced only when the join is complete. '-o -' writes to stdout,
+# an output ending in .parquet is written as a Parquet file (columnar.py). The inputs may be Parquet
+# files too (ja4.py -parquet, ja4x.py/ja4ts.py -o x.parquet), read as the equivalent CSV rows.
+#
+
+import os
+import sys
+import csv
+import heapq
+import socket
 import argparse
+import itertools
+import tempfile
+from operator import itemgetter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from instrument import Metrics
+from columnar import ParquetTable, iter_rows
+
+
+KEYS = ["SrcIP", "DstIP", "SrcPort", "DstPort"]
+SUFFIXES = [("_ja4s_ja4", "_ja4x"), ("_x", "_y")]   # como en los pd.merge anteriores
+RUN_SIZE = 1000000
+
+
+def ip_code(ip):
+    """(32, address) for an IPv4 address, (128, address) for IPv6."""
+    try:
+        return (32, int.from_bytes(socket.inet_aton(ip), "big")) if "." in ip and ":" not in ip else \
+            (128, int.from_bytes(socket.inet_pton(socket.AF_INET6, ip), "big"))
+    except OSError:
+        raise ValueError(f"invalid IP address {ip!r}")
+
+
+def flow_key(src, dst, sport, dport):
+    """Encodes the 4-tuple into an integer; raises ValueError if the values cannot be encoded.
+
+    IPv4 flows get a 96-bit key (src << 64 | dst << 32 | sport << 16 | dport). Flows with an IPv6
+    address use 128-bit addresses (IPv4 ones mapped, ::ffff:a.b.c.d) and a tag bit at 2^288, so
+    their keys are all above the IPv4 ones and the two layouts never collide.
+    """
+    sport, dport = int(sport), int(dport)
+    if not (0 <= sport < 65536 and 0 <= dport < 65536):
+        raise ValueError("invalid port")
+    (src_bits, src), (dst_bits, dst) = ip_code(src), ip_code(dst)
+    if src_bits == dst_bits == 32:
+        return (src << 64) | (dst << 32) | (sport << 16) | dport
+    src |= 0xFFFF << 32 if src_bits == 32 else 0
+    dst |= 0xFFFF << 32 if dst_bits == 32 else 0
+    return (1 << 288) | (src << 160) | (dst << 32) | (sport << 16) | dport
+
+
+def write_run(rows, tmpdir):
+    fd, path = tempfile.mkstemp(suffix=".run", dir=tmpdir)
+    with os.fdopen(fd, "w", newline="") as f:
+        writer = csv.writer(f, delimiter=';')
+        for key, row in rows:
+            writer.writerow([key] + row)
+    return path
+
+
+def read_run(path):
+    with open(path, newline="") as f:
+        for row in csv.reader(f, delimiter=';'):
+            yield int(row[0]), row[1:]
+
+
+def sorted_rows(reader, key_idx, tmpdir, run_size=RUN_SIZE, unkeyed=None, counts=None):
+    """Yields (key, row) of the CSV rows sorted by flow key (stable for equal keys).
+
+    Rows whose 4-tuple cannot be encoded are appended to the unkeyed list instead. If counts (a dict)
+    is given, the number of rows read and of sorted runs written to disk are added to it.
+    """
+    runs = []
+    buf = []
+    rows = 0
+    for rows, row in enumerate(reader, 1):
+        try:
+            key = flow_key(*(row[i] for i in key_idx))
+        except (ValueError, IndexError):
+            if unkeyed is not None:
+                unkeyed.append(row)
+            continue
+        buf.append((key, row))
+        if len(buf) >= run_size:
+            buf.sort(key=itemgetter(0))
+            runs.append(write_run(buf, tmpdir))
+            buf = []
+    buf.sort(key=itemgetter(0))
+    if counts is not None:
+        counts["rows_read"] = counts.get("rows_read", 0) + rows
+        counts["runs_spilled"] = counts.get("runs_spilled", 0) + (len(runs) + 1 if runs else 0)
+    if not runs:
+        yield from buf
+        return
+    runs.append(write_run(buf, tmpdir))
+    buf = []
+    yield from heapq.merge(*(read_run(path) for path in runs), key=itemgetter(0))
+
+
+def output_header(headers):
+    """Columns of the result: all the columns of the first file and the other columns of the following ones."""
+    columns = list(headers[0])
+    for n, header in enumerate(headers[1:]):
+        left, right = SUFFIXES[min(n, len(SUFFIXES) - 1)]
+        extra = [c for c in header if c not in KEYS]
+        overlap = set(columns) & set(extra) - set(KEYS)
+        columns = [f"{c}{left}" if c in overlap else c for c in columns] + [f"{c}{right}" if c in overlap else c for c in extra]
+    return columns
+
+
+def join_files(files, output, run_size=RUN_SIZE, counts=None):
+    """Full outer join of the CSV or Parquet files on the flow 4-tuple into output; returns the number of rows written."""
+    if output == "-":
+        return join_streams(files, sys.stdout, None, run_size, counts)
+
+    # la salida puede ser uno de los ficheros de entrada: se escribe aparte y se reemplaza al final
+    out_dir = os.path.dirname(os.path.abspath(output))
+    fd, tmp_output = tempfile.mkstemp(suffix=".tmp", dir=out_dir)
+    try:
+        if output.endswith(".parquet"):
+            os.close(fd)
+            with ParquetTable(tmp_output, delimiter=';') as out:
+                count = join_streams(files, out, out_dir, run_size, counts)
+        else:
+            with os.fdopen(fd, "w", newline="") as out:
+                count = join_streams(files, out, out_dir, run_size, counts)
+        os.replace(tmp_output, output)
+    except BaseException:
+        os.unlink(tmp_output)
+        raise
+    return count
+
+
+def join_streams(files, out, tmpdir=None, run_size=RUN_SIZE, counts=None):
+    readers = [iter_rows(path, ';') for path in files]
+    try:
+        headers = [next(reader, None) or list(KEYS) for reader in readers]
+        for path, header in zip(files, headers):
+            if not set(KEYS) <= set(header):
+                raise ValueError(f"{path}: missing columns {', '.join(k for k in KEYS if k not in header)}")
+        key_idx = [[header.index(k) for k in KEYS] for header in headers]
+        other_idx = [[i for i, c in enumerate(header) if c not in KEYS] for header in headers]
+
+        writer = out if isinstance(out, ParquetTable) else csv.writer(out, delimiter=';')
+        writer.writerow(output_header(headers))
+        count = 0
+        with tempfile.TemporaryDirectory(dir=tmpdir) as runs_dir:
+            unkeyed = [[] for _ in files]
+            groups = [itertools.groupby(sorted_rows(reader, idx, runs_dir, run_size, unkeyed[n], counts), key=itemgetter(0))
+                      for n, (reader, idx) in enumerate(zip(readers, key_idx))]
+            heads = [next(g, None) for g in groups]
+
+            while any(heads):
+                key = min(head[0] for head in heads if head)
+                matched = []
+                for n, head in enumerate(heads):
+                    if head and head[0] == key:
+                        matched.append([row for _, row in head[1]])
+                        heads[n] = next(groups[n], None)
+                    else:
+                        matched.append([None])
+                # key values come from the first file that has the flow
+                first = next(n for n, rows in enumerate(matched) if rows[0] is not None)
+                for combination in itertools.product(*matched):
+                    writer.writerow(joined_row(combination, first, headers, key_idx, other_idx))
+                    count += 1
 
+        # rows with a 4-tuple that cannot be encoded are not joined
+        for n, rows in enumerate(unkeyed):
+            for row in rows:
+                combination = [row if m == n else None for m in range(len(files))]
+                writer.writerow(joined_row(combination, n, headers, key_idx, other_idx))
+                count += 1
+        if counts is not None:
+            counts["rows_unkeyed"] = counts.get("rows_unkeyed", 0) + sum(map(len, unkeyed))
+        return count
+    finally:
+        for reader in readers:
+            reader.close()
 
-parser = argparse.ArgumentParser(description="Une huellas JA4S y JA4X de dos archivos csv")
-parser.add_argument("ja4", help="Archivo JA4 fingerprint")
-parser.add_argument("ja4x", help="Archivo JA4X fingerprint")
-parser.add_argument("ja4ts", help="Archivo JA4TS fingerprint")
-parser.add_argument("-o", "--output", help="Archivo CSV de salida", default="output.csv")
-args = parser.parse_args()
 
+def joined_row(combination, first, headers, key_idx, other_idx):
+    keys = [combination[first][i] if i < len(combination[first]) else "" for i in key_idx[first]]
+    base = combination[0]
+    if base is None:
+        base = [""] * len(headers[0])
+        for k, i in zip(keys, key_idx[0]):
+            base[i] = k
+    row = list(base)
+    for rows, idx in zip(combination[1:], other_idx[1:]):
+        row.extend([rows[i] if i < len(rows) else "" for i in idx] if rows is not None else [""] * len(idx))
+    return row
 
-df_ja4s_ja4 = pd.read_csv(args.ja4, sep=";")
-df_ja4x = pd.read_csv(args.ja4x, sep=";")
-df_ja4ts = pd.read_csv(args.ja4ts, sep=";")
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Une huellas JA4S y JA4X de dos archivos csv")
+    parser.add_argument("ja4", help="Archivo JA4 fingerprint (CSV o Parquet)")
+    parser.add_argument("ja4x", help="Archivo JA4X fingerprint (CSV o Parquet)")
+    parser.add_argument("ja4ts", help="Archivo JA4TS fingerprint (CSV o Parquet)")
+    parser.add_argument("-o", "--output", help="Archivo CSV de salida ('-' para stdout, Parquet si acaba en .parquet)", default="output.csv")
+    parser.add_argument("--run-size", type=int, default=RUN_SIZE, help="Filas ordenadas en memoria antes de usar ficheros temporales")
+    parser.add_argument("--metrics", help="Guarda tiempos y contadores de la ejecución en <prefijo>.json y <prefijo>.prom")
+    return parser.parse_args()
 
-# Realizar el full join (outer join) en las columnas especificadas
-full_join = pd.merge(
-    df_ja4s_ja4,
-    df_ja4x,
-    on=['SrcIP', 'DstIP', 'SrcPort', 'DstPort'],
-    how='outer',
-    suffixes=('_ja4s_ja4', '_ja4x')
-)
 
-full_join = pd.merge(
-    full_join,
-    df_ja4ts,
-    on=["SrcIP", "DstIP", "SrcPort", "DstPort"],
-    how="outer"
-)
\ No newline at end of file
+if __name__ == '__main__':
+    args = parse_args()
+    metrics = Metrics("join", os.path.basename(args.metrics) if args.metrics else None)
+    with metrics.stage("join") as stage:
+        stage.add("rows_written", join_files([args.ja4, args.ja4x, args.ja4ts], args.output, args.run_size, stage.counters))
+    if args.metrics:
+        metrics.save(args.metrics)
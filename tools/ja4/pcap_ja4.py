@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+#
+# pcap_ja4.py <PCAP> [-d <output DIR>] [-n <name>] [--metrics <prefix>]
+#
+# Single-pass replacement for the three tshark runs of get-ja4.sh. The capture is read once,
+# TCP payload is reassembled per flow direction until the clear-text TLS handshake ends and
+# the following files are written:
+#   <name>-extracted.csv  ClientHello/ServerHello fields in the tshark -T fields format read by ja4.py
+#   <name>-ja4x.csv       JA4X fingerprints of the server certificates (to_ja4x from ja4x.py)
+#   <name>-ja4ts.csv      JA4TS fingerprints of the SYN-ACK packets (parse_tcp_options_raw from ja4ts.py)
+#
+# Like get-ja4.sh, TLS hellos and SYN-ACKs are extracted for IPv4 only. QUIC Initial packets are
+# encrypted and are not decoded here, use the tshark path of get-ja4.sh for QUIC traffic.
+#
+
+import os
+import sys
+import csv
+import time
+import argparse
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from pcapio import read_packets, TCP_SYN, TCP_ACK, TCP_FIN, TCP_RST
+from instrument import Metrics
+
+from ja4x import to_ja4x, ja4x_row, JA4X_HEADER, rdn_cache, ext_cache
+from ja4ts import ja4ts_fingerprint, parse_tcp_options_raw, JA4TS_HEADER
+
+
+delim = ";"
+EXTRACTED_HEADER = "SrcIP;DstIP;TCP SrcPort;TCP DstPort;UDP SrcPort; UDP DstPort;Proto;Type;Ver;Ciphersuite;List of extensions;SNI;Supported Groups;EC;ALPN;Signature Algorithms;Supported Versions;Time"
+
+MAX_BUFFER = 1 << 18        # max. reassembled handshake data per flow direction (256 kB)
+MAX_OUT_OF_ORDER = 64       # max. number of buffered out-of-order segments per flow direction
+
+MONTHS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+
+# TLS extensions decoded from the hellos (the same tshark fields used by get-ja4.sh)
+EXT_SERVER_NAME = 0
+EXT_SUPPORTED_GROUPS = 10
+EXT_EC_POINT_FORMATS = 11
+EXT_SIGNATURE_ALGORITHMS = 13
+EXT_ALPN = 16
+EXT_DELEGATED_CREDENTIALS = 34
+EXT_SUPPORTED_VERSIONS = 43
+EXT_SIGNATURE_ALGORITHMS_CERT = 50
+
+
+def frame_time(pkt):
+    """Formats the packet timestamp like tshark's frame.time field (in UTC)."""
+    sec, frac = divmod(pkt.ticks, pkt.resolution)
+    ns = frac * 1000000000 // pkt.resolution
+    t = time.gmtime(sec)
+    return f"{MONTHS[t.tm_mon - 1]} {t.tm_mday:2d}, {t.tm_year} {t.tm_hour:02d}:{t.tm_min:02d}:{t.tm_sec:02d}.{ns:09d} UTC"
+
+
+def u16(b, pos):
+    return (b[pos] << 8) | b[pos + 1]
+
+
+def u24(b, pos):
+    return (b[pos] << 16) | (b[pos + 1] << 8) | b[pos + 2]
+
+
+def parse_hello(mtype, body):
+    """Parses a ClientHello (1) or ServerHello (2) into the tshark field values used by ja4.py."""
+    hello = {'version': u16(body, 0), 'ciphers': [], 'extensions': [], 'sni': [], 'groups': [], 'ec': [],
+             'alpn': [], 'sig': [], 'versions': []}
+    pos = 34                                    # version + random
+    pos += 1 + body[pos]                        # session id
+    if mtype == 1:
+        end = pos + 2 + u16(body, pos)
+        hello['ciphers'] = [u16(body, p) for p in range(pos + 2, end, 2)]
+        pos = end
+        pos += 1 + body[pos]                    # compression methods
+    else:
+        hello['ciphers'] = [u16(body, pos)]
+        pos += 3                                # cipher suite + compression method
+    if pos + 2 > len(body):
+        return hello
+    end = min(len(body), pos + 2 + u16(body, pos))
+    pos += 2
+    while pos + 4 <= end:
+        ext, elen = u16(body, pos), u16(body, pos + 2)
+        data = body[pos + 4:pos + 4 + elen]
+        pos += 4 + elen
+        hello['extensions'].append(ext)
+        if ext == EXT_SERVER_NAME and len(data) > 2:
+            p = 2
+            while p + 3 <= len(data):
+                nlen = u16(data, p + 1)
+                hello['sni'].append(data[p + 3:p + 3 + nlen].decode('utf-8', 'replace'))
+                p += 3 + nlen
+        elif ext == EXT_SUPPORTED_GROUPS and len(data) >= 2:
+            hello['groups'].extend(u16(data, p) for p in range(2, 2 + u16(data, 0) - 1, 2))
+        elif ext == EXT_EC_POINT_FORMATS and data:
+            hello['ec'].extend(data[1:1 + data[0]])
+        elif ext in (EXT_SIGNATURE_ALGORITHMS, EXT_SIGNATURE_ALGORITHMS_CERT, EXT_DELEGATED_CREDENTIALS) and len(data) >= 2:
+            hello['sig'].extend(u16(data, p) for p in range(2, 2 + u16(data, 0) - 1, 2))
+        elif ext == EXT_ALPN and len(data) >= 2:
+            p = 2
+            while p < len(data):
+                hello['alpn'].append(data[p + 1:p + 1 + data[p]].decode('utf-8', 'replace'))
+                p += 1 + data[p]
+        elif ext == EXT_SUPPORTED_VERSIONS:
+            if mtype == 1 and data:
+                hello['versions'].extend(u16(data, p) for p in range(1, 1 + data[0] - 1, 2))
+            elif len(data) >= 2:
+                hello['versions'].append(u16(data, 0))
+    return hello
+
+
+def der(buf, pos):
+    """Reads a DER TLV header, returns (tag, content start, content end)."""
+    tag, length = buf[pos], buf[pos + 1]
+    pos += 2
+    if length & 0x80:
+        n = length & 0x7f
+        length = int.from_bytes(buf[pos:pos + n], 'big')
+        pos += n
+    return tag, pos, pos + length
+
+
+def der_children(buf, start, end):
+    while start < end:
+        tag, s, e = der(buf, start)
+        yield tag, s, e
+        start = e
+
+
+def der_oid(b):
+    arcs = []
+    value = 0
+    for byte in b:
+        value = (value << 7) | (byte & 0x7f)
+        if not byte & 0x80:
+            arcs.append(value)
+            value = 0
+    first = min(arcs[0] // 40, 2)
+    return ".".join(str(a) for a in [first, arcs[0] - 40 * first] + arcs[1:])
+
+
+def parse_name(buf, start, end, oids, printable):
+    """Collects the attribute OIDs and printable strings of an X.509 Name, returns the number of RDNs."""
+    rdns = 0
+    for tag, s, e in der_children(buf, start, end):
+        rdns += 1
+        for _, atv_s, atv_e in der_children(buf, s, e):
+            (_, oid_s, oid_e), (vtag, val_s, val_e) = list(der_children(buf, atv_s, atv_e))[:2]
+            oids.append(der_oid(buf[oid_s:oid_e]))
+            if vtag == 0x13:                # PrintableString
+                printable.append(buf[val_s:val_e].decode('ascii', 'replace'))
+    return rdns
+
+
+def parse_certificates(body):
+    """Parses a Certificate handshake message into the ja4x.py fields (tshark -T ek x509 fields)."""
+    x = {'issuer_sequence': [], 'subject_sequence': [], 'rdn_oids': [], 'extension_lengths': [],
+         'cert_extensions': [], 'printable_certs': []}
+    pos, end = 3, 3 + u24(body, 0)
+    while pos + 3 <= end:
+        clen = u24(body, pos)
+        cert = body[pos + 3:pos + 3 + clen]
+        pos += 3 + clen
+        _, s, e = der(cert, 0)
+        _, s, e = der(cert, s)              # tbsCertificate
+        fields = list(der_children(cert, s, e))
+        if fields and fields[0][0] == 0xa0:
+            fields = fields[1:]             # explicit version
+        # serialNumber, signature, issuer, validity, subject, subjectPublicKeyInfo, [1], [2], [3] extensions
+        issuer, subject = fields[2], fields[4]
+        x['issuer_sequence'].append(str(parse_name(cert, issuer[1], issuer[2], x['rdn_oids'], x['printable_certs'])))
+        x['subject_sequence'].append(str(parse_name(cert, subject[1], subject[2], x['rdn_oids'], x['printable_certs'])))
+        for tag, s, e in fields[6:]:
+            if tag == 0xa3:
+                _, s, e = der(cert, s)
+                exts = [der(cert, ext_s) for _, ext_s, _ in der_children(cert, s, e)]
+                x['extension_lengths'].append(str(len(exts)))
+                x['cert_extensions'].extend(der_oid(cert[oid_s:oid_e]) for _, oid_s, oid_e in exts)
+    return {key: value for key, value in x.items() if value}
+
+
+def syn_ack_options(options):
+    """Returns the (mss, wscale) values of the TCP options, empty strings if absent."""
+    mss = wscale = ""
+    i = 0
+    while i < len(options):
+        kind = options[i]
+        if kind == 0:
+            break
+        if kind == 1:
+            i += 1
+            continue
+        if i + 1 >= len(options) or options[i + 1] < 2:
+            break
+        length = options[i + 1]
+        if kind == 2 and length == 4 and not mss:
+            mss = str(u16(options, i + 2))
+        elif kind == 3 and length == 3 and not wscale:
+            wscale = str(options[i + 2])
+        i += length
+    return mss, wscale
+
+
+def hello_row(pkt, types, hellos):
+    """Builds an extracted CSV row for a packet that completed one or more hello messages."""
+    def joined(field, fmt):
+        return ",".join(",".join(fmt(v) for v in h[field]) for h in hellos if h[field])
+
+    hex16 = "0x{:04x}".format
+    return [pkt.src, pkt.dst, str(pkt.sport), str(pkt.dport), "", "", "6",
+            ",".join(types),
+            ",".join(hex16(h['version']) for h in hellos),
+            joined('ciphers', hex16),
+            joined('extensions', str),
+            joined('sni', str),
+            joined('groups', hex16),
+            joined('ec', str),
+            joined('alpn', str),
+            joined('sig', hex16),
+            joined('versions', hex16),
+            frame_time(pkt)]
+
+
+class Direction:
+    """Reassembly state of one direction of a TCP flow."""
+    __slots__ = ('next_seq', 'out_of_order', 'buf', 'hs', 'done', 'last')
+
+    def __init__(self, next_seq=None):
+        self.next_seq = next_seq
+        self.last = None                # time of the last packet
+        self.out_of_order = {}
+        self.buf = bytearray()          # reassembled TCP payload not yet parsed into TLS records
+        self.hs = bytearray()           # handshake layer data not yet parsed into messages
+        self.done = False               # clear-text handshake finished or not TLS at all
+
+    def add(self, seq, payload):
+        if self.next_seq is None:
+            self.next_seq = seq
+        diff = (seq - self.next_seq) & 0xffffffff
+        if diff >= 0x80000000:          # retransmission, keep only new data
+            diff = (self.next_seq - seq) & 0xffffffff
+            if diff >= len(payload):
+                return
+            payload, seq = payload[diff:], self.next_seq
+        elif diff:
+            if len(self.out_of_order) < MAX_OUT_OF_ORDER:
+                self.out_of_order[seq] = payload
+            return
+        self.buf += payload
+        self.next_seq = (seq + len(payload)) & 0xffffffff
+        while self.next_seq in self.out_of_order:
+            payload = self.out_of_order.pop(self.next_seq)
+            self.buf += payload
+            self.next_seq = (self.next_seq + len(payload)) & 0xffffffff
+
+    def messages(self):
+        """Returns the handshake messages (type, body) completed by the data added so far."""
+        msgs = []
+        buf = self.buf
+        pos = 0
+        while len(buf) - pos >= 5:
+            ctype = buf[pos]
+            if ctype not in (20, 21, 22, 23) or buf[pos + 1] != 3:
+                self.done = True        # not TLS
+                break
+            rlen = u16(buf, pos + 3)
+            if len(buf) - pos - 5 < rlen:
+                break
+            if ctype != 22:             # change cipher spec, alert or application data: handshake is over
+                self.done = True
+                break
+            self.hs += buf[pos + 5:pos + 5 + rlen]
+            pos += 5 + rlen
+            while len(self.hs) >= 4 and len(self.hs) >= 4 + u24(self.hs, 1):
+                mlen = u24(self.hs, 1)
+                msgs.append((self.hs[0], bytes(self.hs[4:4 + mlen])))
+                del self.hs[:4 + mlen]
+        del buf[:pos]
+        if len(buf) + len(self.hs) > MAX_BUFFER:
+            self.done = True
+        if self.done:
+            self.buf = bytearray()
+            self.hs = bytearray()
+            self.out_of_order = {}
+        return msgs
+
+
+class Ja4Engine:
+    """Turns decoded packets into hello rows, certificate entries and SYN-ACK rows."""
+
+    def __init__(self):
+        self.flows = OrderedDict()      # (src, sport, dst, dport) -> Direction, least recently active first
+        self.certs = 0                  # number of certificate messages seen
+
+    def packet(self, pkt):
+        """Processes one packet, returns a list of events (kind, data).
+
+        kind is "hello" (a row of the extracted CSV), "cert" (an entry for to_ja4x) or
+        "synack" (a row of the JA4TS CSV).
+        """
+        events = []
+        if pkt.proto != 6 or pkt.sport is None:
+            return events
+        key = (pkt.src, pkt.sport, pkt.dst, pkt.dport)
+        flags = pkt.flags
+
+        if flags & TCP_SYN:
+            self.flows.pop(key, None)
+            self.flows[key] = Direction((pkt.seq + 1) & 0xffffffff)
+            self.flows[key].last = pkt.time
+            if (flags & 0xfff) == TCP_SYN | TCP_ACK and pkt.version == 4:
+                mss, wscale = syn_ack_options(pkt.options)
+                fp = ja4ts_fingerprint(str(pkt.window), pkt.options.hex(), mss, wscale)
+                events.append(("synack", [pkt.dst, pkt.src, str(pkt.dport), str(pkt.sport), fp]))
+
+        if pkt.payload:
+            d = self.flows.pop(key, None)
+            if d is None:
+                d = Direction()
+            self.flows[key] = d
+            d.last = pkt.time
+            if not d.done:
+                d.add(pkt.seq, pkt.payload)
+                self.handshake(pkt, d.messages(), events)
+
+        if flags & (TCP_FIN | TCP_RST):
+            self.flows.pop(key, None)
+            if flags & TCP_RST:
+                self.flows.pop((pkt.dst, pkt.dport, pkt.src, pkt.sport), None)
+        return events
+
+    def expire(self, now, timeout):
+        """Drops the state of the flow directions without packets for more than timeout seconds."""
+        while self.flows:
+            d = next(iter(self.flows.values()))
+            if d.last >= now - timeout:
+                break
+            self.flows.popitem(last=False)
+
+    def handshake(self, pkt, messages, events):
+        types, hellos, certs = [], [], []
+        for mtype, body in messages:
+            types.append(str(mtype))
+            try:
+                if mtype in (1, 2):
+                    hellos.append(parse_hello(mtype, body))
+                elif mtype == 11:
+                    certs.append(parse_certificates(body))
+            except (IndexError, ValueError):
+                pass                    # malformed message, skip it
+
+        if hellos and pkt.version == 4:
+            events.append(("hello", hello_row(pkt, types, hellos)))
+
+        for x in certs:
+            if 'extension_lengths' not in x:
+                continue                # tshark marks only certificates with extensions as x509af
+            self.certs += 1
+            x.update({'hl': 'x509af', 'stream': self.certs, 'src': pkt.src, 'dst': pkt.dst,
+                      'srcport': str(pkt.sport), 'dstport': str(pkt.dport), 'timestamp': str(pkt.time)})
+            events.append(("cert", x))
+
+
+def process_pcap(pcap, extracted, ja4x_file, ja4ts_file):
+    engine = Ja4Engine()
+    counts = {"hello": 0, "cert": 0, "synack": 0, "packets": 0}
+
+    with open(extracted, "w") as ext_out, \
+         open(ja4x_file, "w", newline="") as ja4x_out, \
+         open(ja4ts_file, "w", newline="") as ja4ts_out:
+        ext_out.write(EXTRACTED_HEADER + "\n")
+        ja4x_writer = csv.writer(ja4x_out, delimiter=';')
+        ja4x_writer.writerow(JA4X_HEADER)
+        ja4ts_writer = csv.writer(ja4ts_out, delimiter=';')
+        ja4ts_writer.writerow(JA4TS_HEADER)
+
+        for pkt in read_packets(pcap):
+            counts["packets"] += 1
+            for kind, data in engine.packet(pkt):
+                counts[kind] += 1
+                if kind == "hello":
+                    ext_out.write(delim.join(data) + "\n")
+                elif kind == "cert":
+                    to_ja4x(data)
+                    ja4x_writer.writerow(ja4x_row(data))
+                else:
+                    ja4ts_writer.writerow(data)
+    return counts
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Single-pass extraction of TLS hellos, JA4X and JA4TS data from a PCAP/PCAPNG file.")
+    parser.add_argument("pcap", help="Input PCAP or PCAPNG file ('-' for stdin)")
+    parser.add_argument("-d", "--outdir", default=None, help="Output directory (default: directory of the PCAP file)")
+    parser.add_argument("-n", "--name", default=None, help="Base name of the output files (default: PCAP file name without extension)")
+    parser.add_argument("--metrics", help="Write the timings and counters of the run into <prefix>.json and <prefix>.prom")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    outdir = args.outdir or os.path.dirname(args.pcap) or "."
+    name = args.name or os.path.basename(args.pcap).split(".pcap")[0]
+    os.makedirs(outdir, exist_ok=True)
+
+    metrics = Metrics("pcap_ja4", os.path.basename(args.metrics) if args.metrics else None)
+    with metrics.stage("pcap_ja4") as stage:
+        counts = process_pcap(args.pcap,
+                              os.path.join(outdir, f"{name}-extracted.csv"),
+                              os.path.join(outdir, f"{name}-ja4x.csv"),
+                              os.path.join(outdir, f"{name}-ja4ts.csv"))
+        stage.counters.update(counts)
+    if args.metrics:
+        metrics.add_lru(rdn_cache)
+        metrics.add_lru(ext_cache)
+        metrics.add_lru_cache("parse_tcp_options_raw", parse_tcp_options_raw)
+        metrics.save(args.metrics)
+    print(f"{counts['hello']} TLS hellos, {counts['cert']} certificate messages, {counts['synack']} SYN-ACKs saved into {outdir}/")
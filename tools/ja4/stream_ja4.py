@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+#
+# stream_ja4.py <PCAP stream, FIFO, file or -> [-d <output DIR>] [-n <name>] [-l <latency>] [--rotate <s>] [--reopen] [--follow [<s>]]
+#
+# E.g., tcpdump -i eth0 -U -w - | python3 stream_ja4.py - -d out/ -w ../../utils/whois.idx
+#       mkfifo /tmp/cap.fifo; python3 stream_ja4.py /tmp/cap.fifo -d out/ --reopen
+#       python3 ../pcap_replay.py capture.pcap -o /tmp/cap.fifo -s 10          (test with a saved capture)
+#       tcpdump -i eth0 -w cap.pcap & python3 stream_ja4.py cap.pcap -d out/ --follow 60
+#
+# Continuous version of get-ja4.sh -p: reads a pcap stream packet by packet (pcap_ja4.Ja4Engine)
+# and writes the JA4/JA4S, JA4X and JA4TS rows while the capture is still running:
+#   <name>-<start>-ja4.csv    JA4/JA4S lines of ja4.py -stream (-short unless --raw)
+#   <name>-<start>-ja4x.csv   JA4X fingerprints
+#   <name>-<start>-ja4ts.csv  JA4TS fingerprints
+# <start> is the UTC time the file was opened; a new set of files is started every --rotate
+# seconds, so finished files can be picked up (and joined with join.py) by other jobs.
+#
+# A row is written at most --latency seconds (wall clock) after the packet that completes it has
+# been read, even when no more packets arrive. A Client Hello is written when its Server Hello is
+# seen, or alone after --timeout seconds (capture time) like ja4.py -stream.
+#
+# A regular file is read once, up to its current end. With --follow, the end of the file is polled
+# for the packets appended to it (tail -f), until no data arrives for the given seconds or, without
+# a value, until Ctrl-C or SIGTERM.
+#
+
+import os
+import csv
+import sys
+import time
+import math
+import queue
+import signal
+import argparse
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from pcapio import open_capture, iter_records, decode
+
+import ja4
+from fpcache import LRUCache
+from pcap_ja4 import Ja4Engine
+from ja4x import to_ja4x, ja4x_row, JA4X_HEADER
+from ja4ts import JA4TS_HEADER
+
+
+class RotatingWriter:
+    """Output CSV file that is replaced by a new one every `rotate` seconds; files are created on the first row."""
+
+    def __init__(self, outdir, name, suffix, header, rotate=300):
+        self.outdir = outdir
+        self.name = name
+        self.suffix = suffix
+        self.header = header        # function writing the header into a file
+        self.rotate = rotate
+        self.out = None
+        self.writer = None          # csv writer of out (';')
+        self.opened = None
+        self.rows = 0
+        self.files = 0
+
+    def file(self, now):
+        """Returns the current file, opens a new one if there is none or the current one is too old."""
+        if self.out is not None and self.rotate and now - self.opened >= self.rotate:
+            self.close()
+        if self.out is None:
+            stamp = time.strftime("%Y%m%d-%H%M%S", time.gmtime(now))
+            self.out = open(os.path.join(self.outdir, f"{self.name}-{stamp}-{self.suffix}.csv"), "w", newline="")
+            self.writer = csv.writer(self.out, delimiter=';')
+            self.header(self.out)
+            self.opened = now
+            self.files += 1
+        return self.out
+
+    def write_line(self, line, now):
+        self.file(now).write(f"{line}\n")
+        self.rows += 1
+
+    def write_row(self, row, now):
+        self.file(now)
+        self.writer.writerow(row)
+        self.rows += 1
+
+    def flush(self, now):
+        if self.out is not None:
+            self.out.flush()
+            if self.rotate and now - self.opened >= self.rotate:
+                self.close()
+
+    def close(self):
+        if self.out is not None:
+            self.out.close()
+            self.out = None
+
+
+class FollowFile:
+    """Regular file being written: at its end, read() waits for the missing bytes (tail -f)."""
+
+    def __init__(self, f, idle=math.inf, poll=0.2):
+        self.f = f
+        self.idle = idle            # seconds without new data after which the file is finished
+        self.poll = poll
+
+    def read(self, n):
+        data = self.f.read(n)
+        last = time.monotonic()
+        while len(data) < n:
+            time.sleep(self.poll)
+            chunk = self.f.read(n - len(data))
+            if chunk:
+                data += chunk
+                last = time.monotonic()
+            elif time.monotonic() - last >= self.idle:
+                break
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+def read_stream(source, packets, reopen=False, follow=None):
+    """Reader thread: puts the decoded packets of the stream into the queue, then None (end of input).
+
+    With reopen, a named pipe is opened again after every writer closes it. With follow (seconds), a
+    regular file is read until no data is appended to it for that long.
+    """
+    try:
+        while True:
+            f = open_capture(source)
+            if follow is not None and os.path.isfile(source):
+                f = FollowFile(f, follow)
+            try:
+                for record in iter_records(f):
+                    packets.put(decode(*record))
+            finally:
+                if f is not sys.stdin.buffer:
+                    f.close()
+            if not reopen or source == "-":
+                break
+    except Exception as e:
+        print(f"Error reading {source}: {type(e).__name__}: {e}", file=sys.stderr)
+    finally:
+        packets.put(None)
+
+
+class StreamJa4:
+    """Turns the packets of a stream into rows of the three rotating outputs."""
+
+    def __init__(self, outdir, name, short=True, app_name="Unknown", traffic_type="0", side_files=({}, {}, {}),
+                 cache=None, rotate=300, timeout=60.0, max_pending=100000, idle_timeout=300.0):
+        self.short = short
+        self.app_name = app_name
+        self.traffic_type = traffic_type
+        self.side_files = side_files
+        self.cache = cache
+        self.name = name
+        self.idle_timeout = idle_timeout
+        self.engine = Ja4Engine()
+        self.pending = ja4.PendingHellos(timeout, max_pending)
+        self.hellos = []            # extracted rows not fingerprinted yet
+        self.ja4 = RotatingWriter(outdir, name, "ja4", lambda out: ja4.print_header(short, out), rotate)
+        self.ja4x = RotatingWriter(outdir, name, "ja4x", lambda out: csv.writer(out, delimiter=';').writerow(JA4X_HEADER), rotate)
+        self.ja4ts = RotatingWriter(outdir, name, "ja4ts", lambda out: csv.writer(out, delimiter=';').writerow(JA4TS_HEADER), rotate)
+        self.packets = 0
+
+    def packet(self, pkt):
+        """Processes one packet; returns True if it produced output to be written."""
+        self.packets += 1
+        now = time.time()
+        output = False
+        for kind, data in self.engine.packet(pkt):
+            output = True
+            if kind == "hello":
+                self.hellos.append(data)
+            elif kind == "cert":
+                to_ja4x(data)
+                self.ja4x.write_row(ja4x_row(data), now)
+            else:
+                self.ja4ts.write_row(data, now)
+        if self.packets % 1024 == 0:
+            self.engine.expire(pkt.time, self.idle_timeout)
+        return output
+
+    def fingerprint(self, end=False):
+        """Fingerprints the buffered hellos and writes the completed JA4 lines."""
+        now = time.time()
+        if self.hellos:
+            columns = dict(zip(ja4.EXTRACTED_FIELDS, map(list, zip(*self.hellos))))
+            self.hellos = []
+            res_db, whois_db, adservers = self.side_files
+            rows = ja4.handshake_rows(self.name, self.short, self.app_name, self.traffic_type, res_db, whois_db, adservers,
+                                      self.cache, chunks=[columns])
+        else:
+            rows = []
+        for line in ja4.match_hellos(rows, self.pending, end=end):
+            self.ja4.write_line(line, now)
+
+    def flush(self):
+        now = time.time()
+        for writer in (self.ja4, self.ja4x, self.ja4ts):
+            writer.flush(now)
+
+    def close(self):
+        self.fingerprint(end=True)
+        for writer in (self.ja4, self.ja4x, self.ja4ts):
+            writer.close()
+
+
+def run(source, stream, latency=2.0, batch=1024, reopen=False, follow=None):
+    """Reads the stream until it ends (or Ctrl-C), writing every row within `latency` seconds."""
+    packets = queue.Queue(maxsize=65536)
+    threading.Thread(target=read_stream, args=(source, packets, reopen, follow), daemon=True).start()
+    deadline = None         # time by which the buffered output must be written
+    try:
+        while True:
+            try:
+                pkt = packets.get(timeout=None if deadline is None else max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                pkt = False
+            if pkt is None:
+                break
+            if pkt is not False and stream.packet(pkt) and deadline is None:
+                deadline = time.monotonic() + latency
+            if deadline is not None and (time.monotonic() >= deadline or len(stream.hellos) >= batch):
+                stream.fingerprint()
+                stream.flush()
+                deadline = None
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stream.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Computes JA4/JA4S, JA4X and JA4TS fingerprints of a live pcap stream (stdin or named pipe) into rotating CSV files.")
+    parser.add_argument("source", help="PCAP stream: '-' for stdin, a named pipe or a file (see --follow)")
+    parser.add_argument("-d", "--outdir", default=".", help="Output directory (default: current directory)")
+    parser.add_argument("-n", "--name", default="stream", help="Base name of the output files (default: stream)")
+    parser.add_argument("-a", "--app", default="Unknown", help="Application name")
+    parser.add_argument("-t", "--type", default="0", type=str.upper, choices=['0', 'A', 'M'], help="Traffic type: 0 (normal), A (analytics), M (malware)")
+    parser.add_argument("-w", "--whois", default=None, help="WHOIS file or index (maps IP to organization)")
+    parser.add_argument("-r", "--res", default=None, help="Resolution file (maps ports to process names)")
+    parser.add_argument("--adlist", default=None, help="Ad list file (contains ad server domain names)")
+    parser.add_argument("--raw", action="store_true", help="Write the long JA4 output (ja4.py without -short)")
+    parser.add_argument("-l", "--latency", type=float, default=2.0, help="Max. seconds between reading a packet and writing its rows (default: 2)")
+    parser.add_argument("--batch", type=int, default=1024, help="Max. number of hellos fingerprinted together")
+    parser.add_argument("--rotate", type=float, default=300, help="Seconds after which new output files are started (0: never)")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Seconds (capture time) a Client Hello waits for its Server Hello")
+    parser.add_argument("--idle-timeout", type=float, default=300.0, help="Seconds (capture time) without packets after which a flow's state is dropped")
+    parser.add_argument("--reopen", action="store_true", help="Open the named pipe again when its writer closes it")
+    parser.add_argument("--follow", type=float, nargs="?", const=math.inf, default=None, metavar="SECONDS",
+                        help="Keep reading a file being written; stop after SECONDS without new data (no value: until Ctrl-C/kill)")
+    parser.add_argument("--cache-size", type=int, default=65536, help="Max. number of cached handshake fingerprints (0 disables the cache)")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    os.makedirs(args.outdir, exist_ok=True)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)      # kill: same clean stop as Ctrl-C
+    cache = LRUCache(args.cache_size, name="Fingerprint cache") if args.cache_size > 0 else None
+    stream = StreamJa4(args.outdir, args.name, short=not args.raw, app_name=args.app, traffic_type=args.type,
+                       side_files=ja4.load_side_files(args.res, args.whois, args.adlist), cache=cache, rotate=args.rotate,
+                       timeout=args.timeout, idle_timeout=args.idle_timeout)
+    run(args.source, stream, args.latency, args.batch, args.reopen, args.follow)
+    print(f"{stream.packets} packets read, {stream.ja4.rows} JA4, {stream.ja4x.rows} JA4X and {stream.ja4ts.rows} JA4TS rows "
+          f"written into {stream.ja4.files + stream.ja4x.files + stream.ja4ts.files} files in {args.outdir}/", file=sys.stderr)
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+#
+# whois_index.py <whois file> [-o <index file>] [--widen <prefix>] [--widen6 <prefix>]
+#
+# E.g., python3 whois_index.py ../../utils/whois.txt -o ../../utils/whois.idx --widen 24
+#
+# Compiles a whois file (<IP address or CIDR prefix>;<OrgName> per line, see get-whois.pl) into an
+# index of sorted, disjoint integer ranges for IPv4 and IPv6. The index file is memory-mapped, so
+# loading it costs nothing, and a lookup is a binary search giving the longest matching prefix.
+# With --widen N, a known address also covers its /N block if all known addresses in that
+# block belong to the same organization.
+#
+# ja4.py -whois accepts both the text file (exact IP match) and the index file.
+#
+
+import sys
+import mmap
+import socket
+import struct
+import bisect
+import argparse
+import functools
+import ipaddress
+
+
+MAGIC = b"WHOISIX1"
+HEADER = struct.Struct("<8sIII")   # magic, IPv4 ranges, IPv6 ranges, organizations
+
+
+def parse_whois(filename):
+    """Reads a whois file, returns a list of (ip_network, org) in the order of the file."""
+    entries = []
+    with open(filename, "r") as file:
+        for line in file:
+            parts = line.strip().split(';')
+            if len(parts) != 2:
+                continue
+            try:
+                entries.append((ipaddress.ip_network(parts[0], strict=False), parts[1]))
+            except ValueError:
+                continue
+    return entries
+
+
+def widen(entries, version, prefixlen):
+    """Returns /prefixlen networks of the given IP version whose known addresses all have the same org."""
+    blocks = {}
+    for net, org in entries:
+        if net.version != version or net.prefixlen < prefixlen:
+            continue
+        block = net.supernet(new_prefix=prefixlen)
+        if blocks.setdefault(block, org) != org:
+            blocks[block] = None        # ambiguous
+    return [(block, org) for block, org in blocks.items() if org is not None]
+
+
+def flatten(prefixes):
+    """Turns nested (start, end, org) prefixes into sorted disjoint ranges where the longest prefix wins.
+
+    Prefixes are either nested or disjoint. Of two equal prefixes the later one wins (as in a dict).
+    """
+    ranges = []
+
+    def emit(start, end, org):
+        if start > end:
+            return
+        if ranges and ranges[-1][1] + 1 == start and ranges[-1][2] == org:
+            ranges[-1] = (ranges[-1][0], end, org)
+        else:
+            ranges.append((start, end, org))
+
+    stack = []      # (end, org) of the prefixes containing the current position, innermost last
+    pos = 0
+    for start, end, org in sorted(prefixes, key=lambda p: (p[0], p[0] - p[1])):
+        while stack and stack[-1][0] < start:
+            top_end, top_org = stack.pop()
+            emit(pos, top_end, top_org)
+            pos = top_end + 1
+        if stack:
+            emit(pos, start - 1, stack[-1][1])
+        pos = start
+        stack.append((end, org))
+    while stack:
+        top_end, top_org = stack.pop()
+        emit(pos, top_end, top_org)
+        pos = top_end + 1
+    return ranges
+
+
+def compile_whois(whoisfile, indexfile, widen4=None, widen6=None):
+    """Compiles a whois file into an index file, returns the number of (IPv4, IPv6) ranges."""
+    entries = parse_whois(whoisfile)
+    if widen4:
+        entries = widen(entries, 4, widen4) + entries     # the exact entries are longer prefixes and win
+    if widen6:
+        entries = widen(entries, 6, widen6) + entries
+
+    orgs = {}
+    ranges = {}
+    for version in (4, 6):
+        prefixes = [(int(net.network_address), int(net.broadcast_address), orgs.setdefault(org, len(orgs)))
+                    for net, org in entries if net.version == version]
+        ranges[version] = flatten(prefixes)
+
+    blob = b""
+    offsets = [0]
+    for org in orgs:
+        blob += org.encode("utf-8")
+        offsets.append(len(blob))
+
+    with open(indexfile, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(ranges[4]), len(ranges[6]), len(orgs)))
+        # IPv4: starts, ends, orgs as uint32 arrays
+        f.write(struct.pack(f"<{len(ranges[4])}I", *(r[0] for r in ranges[4])))
+        f.write(struct.pack(f"<{len(ranges[4])}I", *(r[1] for r in ranges[4])))
+        f.write(struct.pack(f"<{len(ranges[4])}I", *(r[2] for r in ranges[4])))
+        if len(ranges[4]) % 2:
+            f.write(b"\0" * 4)          # keeps the uint64 arrays aligned
+        # IPv6: starts and ends as (high, low) uint64 pairs, orgs as uint64
+        f.write(struct.pack(f"<{2 * len(ranges[6])}Q", *(x for r in ranges[6] for x in divmod(r[0], 1 << 64))))
+        f.write(struct.pack(f"<{2 * len(ranges[6])}Q", *(x for r in ranges[6] for x in divmod(r[1], 1 << 64))))
+        f.write(struct.pack(f"<{len(ranges[6])}Q", *(r[2] for r in ranges[6])))
+        # organizations: offsets into a UTF-8 blob
+        f.write(struct.pack(f"<{len(offsets)}I", *offsets))
+        f.write(blob)
+    return len(ranges[4]), len(ranges[6])
+
+
+def is_index(filename):
+    try:
+        with open(filename, "rb") as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+class _U128:
+    """Sequence view of (high, low) uint64 pairs as 128-bit integers, for bisect."""
+
+    def __init__(self, words):
+        self.words = words
+
+    def __len__(self):
+        return len(self.words) // 2
+
+    def __getitem__(self, i):
+        return (self.words[2 * i] << 64) | self.words[2 * i + 1]
+
+
+class WhoisIndex:
+    """Memory-mapped whois index with longest-prefix lookups; get() works like the dict of load_whois_file."""
+
+    def __init__(self, filename, cachesize=65536):
+        self.filename = filename
+        self.cachesize = cachesize
+        with open(filename, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if sys.byteorder != "little":
+            raise ValueError("whois index files are little endian")
+        magic, n4, n6, norgs = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{filename} is not a whois index")
+
+        view = memoryview(self.map)
+        pos = HEADER.size
+        self.starts4 = view[pos:pos + 4 * n4].cast("I")
+        self.ends4 = view[pos + 4 * n4:pos + 8 * n4].cast("I")
+        self.orgs4 = view[pos + 8 * n4:pos + 12 * n4].cast("I")
+        pos += 12 * n4 + 4 * (n4 % 2)
+        self.starts6 = _U128(view[pos:pos + 16 * n6].cast("Q"))
+        self.ends6 = _U128(view[pos + 16 * n6:pos + 32 * n6].cast("Q"))
+        self.orgs6 = view[pos + 32 * n6:pos + 40 * n6].cast("Q")
+        pos += 40 * n6
+        self.offsets = view[pos:pos + 4 * (norgs + 1)].cast("I")
+        self.blob = pos + 4 * (norgs + 1)
+        self.lookup = functools.lru_cache(maxsize=cachesize)(self._lookup)
+
+    def __getstate__(self):
+        # the mapping cannot be pickled (multiprocessing), it is opened again
+        return {"filename": self.filename, "cachesize": self.cachesize}
+
+    def __setstate__(self, state):
+        self.__init__(state["filename"], state["cachesize"])
+
+    def org(self, i):
+        return self.map[self.blob + self.offsets[i]:self.blob + self.offsets[i + 1]].decode("utf-8")
+
+    def _lookup(self, ip):
+        try:
+            if ":" in ip:
+                x = int.from_bytes(socket.inet_pton(socket.AF_INET6, ip), "big")
+                starts, ends, orgs = self.starts6, self.ends6, self.orgs6
+            else:
+                x = int.from_bytes(socket.inet_aton(ip), "big")
+                starts, ends, orgs = self.starts4, self.ends4, self.orgs4
+        except (OSError, ValueError):
+            return None
+        i = bisect.bisect_right(starts, x) - 1
+        if i >= 0 and x <= ends[i]:
+            return self.org(orgs[i])
+        return None
+
+    def get(self, ip, default=None):
+        org = self.lookup(ip)
+        return default if org is None else org
+
+    def __contains__(self, ip):
+        return self.lookup(ip) is not None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compiles a whois file into a memory-mapped index with longest-prefix lookups.")
+    parser.add_argument("whois", help="Whois file (<IP address or CIDR prefix>;<OrgName> per line)")
+    parser.add_argument("-o", "--output", help="Index file (default: <whois file>.idx)")
+    parser.add_argument("--widen", type=int, help="Extend known IPv4 addresses to unambiguous /N blocks (e.g., 24)")
+    parser.add_argument("--widen6", type=int, help="Extend known IPv6 addresses to unambiguous /N blocks (e.g., 48)")
+    parser.add_argument("--lookup", nargs="*", default=[], help="Look up these addresses in the compiled index")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    output = args.output or f"{args.whois}.idx"
+    n4, n6 = compile_whois(args.whois, output, args.widen, args.widen6)
+    print(f"Saved {n4} IPv4 and {n6} IPv6 ranges into {output}")
+    if args.lookup:
+        index = WhoisIndex(output)
+        for ip in args.lookup:
+            print(f"{ip};{index.get(ip, '')}")
@@ -2,19 +2,30 @@ import os
 import pandas as pd
 import sys
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from columnar import convert
+
 
 input_dir = ""
-output_csv = ""
+output_csv = ""         # si acaba en .parquet (o hay partition_by) se escribe en Parquet, ver columnar.py
+partition_by = []       # p. ej. ["family", "capture"]: un directorio con un Parquet por familia y captura
+
+csv_files = sorted(f for f in os.listdir(input_dir) if f.endswith(".csv"))
+
+if output_csv.endswith(".parquet") or partition_by:
+    # las filas se copian por grupos, sin cargar todos los CSV en memoria
+    n = convert([os.path.join(input_dir, f) for f in csv_files], output_csv, ",", partition_by)
+    print(f"{n} filas de {len(csv_files)} archivos guardadas en: {output_csv}")
+    sys.exit(0)
 
 dataframes = []
 
-for csv_file in os.listdir(input_dir):
-    if csv_file.endswith(".csv"):  
-        full_path = os.path.join(input_dir, csv_file)
-        print(f"Procesando: {csv_file}")
-    
-        df = pd.read_csv(full_path)
-        dataframes.append(df)
+for csv_file in csv_files:
+    full_path = os.path.join(input_dir, csv_file)
+    print(f"Procesando: {csv_file}")
+
+    df = pd.read_csv(full_path)
+    dataframes.append(df)
 
 
 combined_df = pd.concat(dataframes, ignore_index=True)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+#
+# extract_features.py <root DIR> -o <output CSV> [-l <label>] [-f <family>] [-j <jobs>] [--metrics <prefix>]
+#
+# E.g., python3 extract_features.py Maxtor/ -o valak.csv -l 1 -f 4 -j 32
+#
+# Batch version of session_to_csv.sh + preprocesing_oneF.py + combine_csv.py: computes the
+# features of every session pcap under the root directory (as written by sessions.sh:
+# <root>/<capture>/<session>.pcap) in a pool of worker processes and streams all the rows
+# into one CSV (or Parquet file, see columnar.py) with the columns of preprocesing_oneF.py. The session name is
+# <capture>_<session>, as in preprocesing_oneF.py.
+#
+# Etiquetas: label 0 benigno, 1 malware; family 0 benigno, 1 Dridex, 2 Emotet, 3 Hancitor, 4 Valak, 5 Keylogger
+#
+
+import os
+import sys
+import math
+import time
+import argparse
+import multiprocessing
+from contextlib import redirect_stdout
+
+from preprocesing_oneF import batch_features, read_packets, COLUMNS, NUM_PACKETS
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from instrument import Metrics
+from columnar import open_table
+
+
+def find_sessions(root):
+    """Returns the session pcaps under root, sorted, with their session names."""
+    sessions = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if name.endswith((".pcap", ".pcapng")):
+                capture = os.path.basename(os.path.normpath(dirpath))
+                sessions.append((os.path.join(dirpath, name), f"{capture}_{name.split('.pcap')[0]}"))
+    return sessions
+
+
+def format_value(value):
+    # como pandas.to_csv: NaN vacío, floats con repr
+    if isinstance(value, float):
+        return "" if math.isnan(value) else repr(float(value))
+    return value
+
+
+def extract(args):
+    """Computes the features of a chunk of sessions in one batch; returns (pcap, features, error) for each."""
+    chunk, label, family = args
+    results = []
+    packets, names, ok = [], [], []
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        for pcap_file, session_name in chunk:
+            try:
+                packets.append(list(read_packets(pcap_file, limit=NUM_PACKETS)))
+            except Exception as e:
+                results.append([pcap_file, None, f"{type(e).__name__}: {e}"])
+                continue
+            names.append(session_name)
+            results.append([pcap_file, None, None])
+            ok.append(results[-1])
+        for result, features in zip(ok, batch_features(packets, names, label, family)):
+            result[1] = features
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Extracts the MalDIST features of all session pcaps under a directory into one CSV.")
+    parser.add_argument("root", help="Root directory with the session pcaps (<root>/<capture>/<session>.pcap)")
+    parser.add_argument("-o", "--output", required=True, help="Output CSV file (Parquet if it ends in .parquet)")
+    parser.add_argument("-l", "--label", type=int, default=1, help="Label: 0 benign, 1 malware (default: 1)")
+    parser.add_argument("-f", "--family", type=int, default=2, help="Family: 0 benign, 1 Dridex, 2 Emotet, 3 Hancitor, 4 Valak, 5 Keylogger (default: 2)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="Number of worker processes (default: number of CPUs)")
+    parser.add_argument("--chunksize", type=int, default=1024, help="Sessions computed by a worker in one batch")
+    parser.add_argument("--metrics", help="Write the timings and counters of the run into <prefix>.json and <prefix>.prom")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    metrics = Metrics("extract_features", os.path.basename(args.metrics) if args.metrics else None)
+    with metrics.stage("scan") as stage:
+        sessions = find_sessions(args.root)
+        stage.add("sessions", len(sessions))
+    print(f"{len(sessions)} sessions found in {args.root}")
+
+    start = time.time()
+    written = failed = empty = 0
+    tasks = ((sessions[i:i + args.chunksize], args.label, args.family) for i in range(0, len(sessions), args.chunksize))
+    with metrics.stage("extract") as stage, open_table(args.output, COLUMNS) as writer, multiprocessing.Pool(args.jobs) as pool:
+        # imap keeps the order of the sessions, rows are written as they arrive; the time waiting for
+        # the workers (process_session) is counted apart from the time writing
+        for results in stage.wait(pool.imap(extract, tasks), "worker_wait_seconds"):
+            for pcap_file, features, error in results:
+                if error:
+                    failed += 1
+                    print(f"Error in {pcap_file}: {error}", file=sys.stderr)
+                elif features is None:
+                    empty += 1
+                else:
+                    writer.writerow([format_value(v) for v in features])
+                    written += 1
+
+        stage.counters.update(sessions=written, empty=empty, failed=failed)
+    if args.metrics:
+        metrics.save(args.metrics)
+    print(f"Features of {written} sessions saved into {args.output} ({empty} empty, {failed} failed) in {time.time() - start:.1f} s")
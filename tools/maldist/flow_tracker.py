@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+#
+# flow_tracker.py <PCAP or -> -o <output CSV or -> [-l <label>] [-f <family>] [--idle-timeout <s>] [--udp] [--metrics <prefix>]
+#
+# E.g., tcpdump -i eth0 -w - | python3 flow_tracker.py - -o - -l 0 -f 0
+#       python3 flow_tracker.py capture.pcap -o capture.csv -l 1 -f 4
+#
+# Online version of split_sessions.py -o: reads the packets in capture order (file, pipe or stdin)
+# and keeps a table of the open flows. The row of a flow (the columns of preprocesing_oneF.py) is
+# written as soon as the flow has 32 packets, or when it has been idle for --idle-timeout seconds
+# (capture time), and its packets are freed. Only the 4-tuple and the last time of the flows
+# already written are kept, to drop the rest of their packets, until they go idle too; a packet
+# of a forgotten flow starts a new session. So the memory depends on the number of active flows,
+# not on the length of the capture, and no session pcaps are needed.
+#
+# Rows are computed in batches of up to --batch flows (all at once, see batch_features) and are
+# written at most --max-delay seconds (capture time) after the flow is complete.
+#
+
+import os
+import sys
+import csv
+import argparse
+from collections import OrderedDict
+from contextlib import redirect_stdout
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from pcapio import open_capture, iter_records, decode, TCP_SYN, TCP_ACK, TCP_FIN, TCP_RST
+from instrument import Metrics
+from columnar import open_table
+from preprocesing_oneF import batch_features, COLUMNS, NUM_PACKETS
+from split_sessions import flow_key
+from extract_features import format_value
+
+
+class Flow:
+    __slots__ = ('name', 'packets', 'last', 'closed')
+
+    def __init__(self, name, time):
+        self.name = name
+        self.packets = []       # first packets, None once the row is written
+        self.last = time        # time of the last packet
+        self.closed = False     # FIN or RST seen
+
+
+class FlowTracker:
+    """Table of open flows; add() returns the flows that are complete (32 packets) or idle."""
+
+    def __init__(self, idle_timeout=60, udp=False):
+        self.idle_timeout = idle_timeout
+        self.udp = udp
+        self.flows = OrderedDict()      # flow key -> Flow, least recently active first
+        self.counters = {6: 0, 17: 0}
+        self.emitted = 0
+        self.expired = 0                # flows removed from the table when idle
+        self.packets = 0
+        self.peak = 0                   # max. number of flows in the table
+
+    def add(self, pkt):
+        self.packets += 1
+        done = self.expire(pkt.time)
+        key = flow_key(pkt)
+        if key is None or (pkt.proto == 17 and not self.udp):
+            return done
+
+        flow = self.flows.pop(key, None)
+        if flow is not None and flow.closed and pkt.proto == 6 and pkt.flags & TCP_SYN and not pkt.flags & TCP_ACK:
+            if flow.packets is not None:
+                done.append(self.finish(flow))  # port reuse: new connection
+            flow = None
+        if flow is None:
+            prefix = "session" if pkt.proto == 6 else "udp_session"
+            flow = Flow(f"{prefix}_{self.counters[pkt.proto]}", pkt.time)
+            self.counters[pkt.proto] += 1
+        self.flows[key] = flow
+        self.peak = max(self.peak, len(self.flows))
+        flow.last = max(flow.last, pkt.time)
+        if pkt.proto == 6 and pkt.flags & (TCP_FIN | TCP_RST):
+            flow.closed = True
+        if flow.packets is None:
+            return done                 # row already written
+
+        # only the decoded header fields are needed
+        pkt.data = None
+        pkt.options = pkt.payload = b""
+        flow.packets.append(pkt)
+        if len(flow.packets) == NUM_PACKETS:
+            done.append(self.finish(flow))
+        return done
+
+    def finish(self, flow):
+        packets, flow.packets = flow.packets, None
+        self.emitted += 1
+        return flow.name, packets
+
+    def expire(self, now):
+        """Removes the flows idle since before now - idle_timeout, returns those whose row is not written yet."""
+        done = []
+        while self.flows:
+            flow = next(iter(self.flows.values()))
+            if flow.last >= now - self.idle_timeout:
+                break
+            self.flows.popitem(last=False)
+            self.expired += 1
+            if flow.packets is not None:
+                done.append(self.finish(flow))
+        return done
+
+    def close(self):
+        """Removes all the flows, returns those whose row is not written yet (end of the capture)."""
+        done = [self.finish(flow) for flow in self.flows.values() if flow.packets is not None]
+        self.flows.clear()
+        return done
+
+
+def track_flows(pcap, output, label=1, family=2, udp=False, idle_timeout=60, batch=64, max_delay=1.0):
+    """Writes the features of every flow of the capture into a CSV as soon as possible; returns the tracker."""
+    capture = "stdin" if pcap == "-" else os.path.basename(pcap).split('.pcap')[0]
+    tracker = FlowTracker(idle_timeout, udp)
+    pending = []        # complete flows whose row is not computed yet
+    since = None        # time of the oldest pending flow
+
+    out = sys.stdout if output == "-" else open_table(output)     # a Parquet file writes whole row groups
+    f = open_capture(pcap)
+    try:
+        writer = csv.writer(out) if out is sys.stdout else out
+        writer.writerow(COLUMNS)
+
+        def write_pending():
+            with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+                rows = batch_features([packets for _, packets in pending], [f"{capture}_{name}" for name, _ in pending], label, family)
+            writer.writerows([format_value(v) for v in row] for row in rows)
+            out.flush()
+            pending.clear()
+
+        for record in iter_records(f):
+            pkt = decode(*record)
+            done = tracker.add(pkt)
+            if done:
+                pending.extend(done)
+                if since is None:
+                    since = pkt.time
+            if pending and (len(pending) >= batch or pkt.time - since >= max_delay):
+                write_pending()
+                since = None
+
+        pending.extend(tracker.close())
+        if pending:
+            write_pending()
+    finally:
+        if f is not sys.stdin.buffer:
+            f.close()
+        if out is not sys.stdout:
+            out.close()
+    return tracker
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Computes the MalDIST features of the flows of a capture online, as soon as each flow has 32 packets.")
+    parser.add_argument("pcap", help="Input PCAP or PCAPNG file ('-' for stdin)")
+    parser.add_argument("-o", "--output", required=True, help="Output CSV file ('-' for stdout, Parquet if it ends in .parquet)")
+    parser.add_argument("-l", "--label", type=int, default=1, help="Label: 0 benign, 1 malware (default: 1)")
+    parser.add_argument("-f", "--family", type=int, default=2, help="Family: 0 benign, 1 Dridex, 2 Emotet, 3 Hancitor, 4 Valak, 5 Keylogger (default: 2)")
+    parser.add_argument("--udp", action="store_true", help="Also track UDP flows")
+    parser.add_argument("--idle-timeout", type=float, default=60, help="Seconds without packets after which a flow is complete (default: 60)")
+    parser.add_argument("--batch", type=int, default=64, help="Max. number of flows whose rows are computed together")
+    parser.add_argument("--max-delay", type=float, default=1.0, help="Max. seconds (capture time) a complete flow waits for its batch")
+    parser.add_argument("--metrics", help="Write the timings and counters of the run into <prefix>.json and <prefix>.prom")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    metrics = Metrics("flow_tracker", os.path.basename(args.metrics) if args.metrics else None)
+    with metrics.stage("flow_tracker") as stage:
+        tracker = track_flows(args.pcap, args.output, args.label, args.family, args.udp, args.idle_timeout, args.batch, args.max_delay)
+        stage.counters.update(packets=tracker.packets, flows=tracker.emitted, flows_expired=tracker.expired, peak_flows=tracker.peak)
+    if args.metrics:
+        metrics.save(args.metrics)
+    print(f"Features of {tracker.emitted} flows saved into {args.output} (max. {tracker.peak} flows in memory)", file=sys.stderr)
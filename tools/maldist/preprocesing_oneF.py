@@ -1,187 +1,237 @@
-from scapy.all import rdpcap, TCP, UDP, IP, Raw
 import numpy as np
-from scipy.stats import skew
 from collections import defaultdict
 import pandas as pd
 import os
 import sys
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from pcapio import read_packets, TCP_SYN, TCP_ACK
+
+NUM_PACKETS = 32    # solo se usan los primeros 32 paquetes de cada sesión
+
+
+def is_tcp(packet):
+    return packet.proto == 6 and packet.flags is not None
+
 def identify_src_dst_ips(packets):
     src_ip, dst_ip = None, None
     
     for packet in packets:
-        if not packet.haslayer(TCP):
+        if not is_tcp(packet):
             continue  
             
-        if packet[TCP].flags & 0x02 and not packet[TCP].flags & 0x10: 
-            src_ip = packet[IP].src
-            dst_ip = packet[IP].dst
+        if packet.flags & TCP_SYN and not packet.flags & TCP_ACK: 
+            src_ip = packet.src
+            dst_ip = packet.dst
             break
             
         
-        elif packet[TCP].flags & 0x12:  
-            src_ip = packet[IP].dst  
-            dst_ip = packet[IP].src 
+        elif packet.flags & (TCP_SYN | TCP_ACK):  
+            src_ip = packet.dst  
+            dst_ip = packet.src 
             break
     
     
     if src_ip is None:
         print("NO HAY SYN y ACK")
         for packet in packets:
-            if packet.haslayer(IP):
-                src_ip = packet[IP].src
-                dst_ip = packet[IP].dst
+            if packet.version == 4:
+                src_ip = packet.src
+                dst_ip = packet.dst
                 break
     
     return src_ip, dst_ip
 
 
-def compute_stats(packets):
-    sizes = [float(len(p)) for p in packets]
-    times = [float(p.time) for p in packets]
-    intervals = np.array(np.diff(times)) if len(times) > 1 else np.array([])
+GROUPS = ["bidirectional", "srcdst", "dstsrc", "handshake", "datatransfer"]
 
-    
-    stats = [
-        np.min(sizes) if sizes else 0,
-        np.max(sizes) if sizes else 0,
-        np.mean(sizes) if sizes else 0,
-        np.std(sizes) if sizes else 0,
-        skew(sizes) if len(sizes) > 1 else 0,
-        np.min(intervals) if intervals.size else 0,
-        np.max(intervals) if intervals.size else 0,
-        np.mean(intervals) if intervals.size else 0,
-        np.std(intervals) if intervals.size else 0,
-        skew(intervals) if len(intervals) > 1 else 0,
-        sum(sizes),
-        len(packets),
-        sum(sizes) / (max(times) - min(times) + 1e-9) if len(times) > 1 else 0,  
-        len(packets) / (max(times) - min(times) + 1e-9) if len(times) > 1 else 0  
-    ]
-    return stats
+# metadata of the first packets of a session
+SESSION_DTYPE = np.dtype([
+    ("time", "f8"),         # timestamp in seconds
+    ("iat", "f8"),          # time since the previous packet (exact, from integer ticks)
+    ("size", "f8"),         # captured length
+    ("window", "f8"),       # TCP window, 0 for other packets
+    ("direction", "f8"),    # 1 if from dst_ip to src_ip (see extract_protocol_fields)
+    ("srcdst", "?"),        # src_ip -> dst_ip
+    ("dstsrc", "?"),        # dst_ip -> src_ip
+    ("handshake", "?"),     # TCP with SYN
+])
 
 
-def extract_protocol_fields(packets, num_packets=32):
-    protocol_matrix = np.zeros((num_packets, 4)) 
-    
+def session_array(packets):
+    """Returns the metadata of the first packets of a session as a structured array (SESSION_DTYPE)."""
+    packets = packets[:NUM_PACKETS]
+    arr = np.zeros(len(packets), dtype=SESSION_DTYPE)
     if not packets:
-        return protocol_matrix
-    
-    src_ip, dst_ip = identify_src_dst_ips(packets[:32])
-    
-    
-    prev_time = packets[0].time if hasattr(packets[0], 'time') else 0.0
-    
-    for i, packet in enumerate(packets[:num_packets]):
-        if i > 0:
-            delta_time = packet.time - prev_time
-            prev_time = packet.time
+        return arr
+    src_ip, dst_ip = identify_src_dst_ips(packets)
+
+    rows = []
+    prev_ticks = packets[0].ticks
+    for packet in packets:
+        # con ticks enteros la resta es exacta, como con los Decimal de scapy
+        delta_time = (packet.ticks - prev_ticks) / packet.resolution
+        prev_ticks = packet.ticks
+
+        # como scapy: la dirección de la capa de enlace (MAC) si la hay, si no la de IP
+        if packet.link_src is not None:
+            src, dst = packet.link_src, packet.link_dst
         else:
-            delta_time = 0.0
-        
-        
-        direction = 0
-        if hasattr(packet, 'src') and hasattr(packet, 'dst'):
-            if packet.src == dst_ip and packet.dst == src_ip: 
-                direction = 1
-        
-        
-        pkt_size = len(packet)
-        
-        
-        pkt_iat = delta_time
-        
-        tcp_window = 0
-        if TCP in packet:
-            tcp_window = packet[TCP].window
-        
-        protocol_matrix[i] = [direction, pkt_size, pkt_iat, tcp_window]
-    
-    return protocol_matrix
+            src, dst = packet.src, packet.dst
+        direction = 1 if src is not None and dst is not None and src == dst_ip and dst == src_ip else 0
+
+        tcp = is_tcp(packet)
+        srcdst = bool(src_ip and dst_ip) and packet.src == src_ip and packet.dst == dst_ip
+        dstsrc = bool(src_ip and dst_ip) and not srcdst and packet.src == dst_ip and packet.dst == src_ip
+        rows.append((packet.time, delta_time, packet.caplen, packet.window if tcp else 0, direction,
+                     srcdst, dstsrc, tcp and bool(packet.flags & TCP_SYN)))
+    arr[:] = rows
+    return arr
+
+
+def _skew(a):
+    # scipy.stats.skew(bias=True) por filas, con las mismas operaciones para obtener los mismos valores
+    mean = np.mean(a, axis=1, keepdims=True)
+    d = a - mean
+    m2 = np.mean(d ** 2, axis=1)
+    m3 = np.mean(d ** 2 * d, axis=1)
+    with np.errstate(all='ignore'):
+        zero = m2 <= (np.finfo(m2.dtype).eps * mean[:, 0]) ** 2
+    # m2 ** 1.5 de un escalar (pow de libm): la versión vectorizada de numpy puede diferir en el último bit
+    return np.array([np.nan if z else c / b ** 1.5 for z, b, c in zip(zero.tolist(), m2.tolist(), m3.tolist())])
+
+
+def compute_stats(sizes, times):
+    """Returns the 14 statistics of each row of sizes and times (m x n arrays, one group per row).
+
+    Rows of the same length are reduced along the last axis, so numpy sums each row exactly as
+    it sums a 1-D array and the values are those of np.mean/np.std/scipy's skew on one group.
+    """
+    m, n = sizes.shape
+    stats = np.zeros((m, len(STAT_FIELDS)))
+    if n == 0:
+        return stats
+    stats[:, 0] = np.min(sizes, axis=1)
+    stats[:, 1] = np.max(sizes, axis=1)
+    stats[:, 2] = np.mean(sizes, axis=1)
+    stats[:, 3] = np.std(sizes, axis=1)
+    stats[:, 10] = np.sum(sizes, axis=1)    # sizes are integers: exact in any order
+    stats[:, 11] = n
+    if n > 1:
+        intervals = np.diff(times, axis=1)
+        stats[:, 4] = _skew(sizes)
+        stats[:, 5] = np.min(intervals, axis=1)
+        stats[:, 6] = np.max(intervals, axis=1)
+        stats[:, 7] = np.mean(intervals, axis=1)
+        stats[:, 8] = np.std(intervals, axis=1)
+        if n > 2:
+            stats[:, 9] = _skew(intervals)
+        span = np.max(times, axis=1) - np.min(times, axis=1) + 1e-9
+        stats[:, 12] = stats[:, 10] / span
+        stats[:, 13] = n / span
+    return stats
+
+
+def batch_matrices(arrays):
+    """Returns the stats matrices (S x 5 x 14) and protocol matrices (S x 32 x 4) of S sessions (session_array)."""
+    arrays = [arr[:NUM_PACKETS] for arr in arrays]
+    lengths = np.array([len(arr) for arr in arrays], dtype=np.intp)
+    stats = np.zeros((len(arrays), len(GROUPS), len(STAT_FIELDS)))
+    protocol = np.zeros((len(arrays), NUM_PACKETS, 4))
+    if not lengths.sum():
+        return stats, protocol
+    flat = np.concatenate(arrays)
+    session = np.repeat(np.arange(len(arrays)), lengths)
+    row = np.arange(len(flat)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+    masks = [np.ones(len(flat), dtype=bool), flat["srcdst"], flat["dstsrc"], flat["handshake"], ~flat["handshake"]]
+    for g, mask in enumerate(masks):
+        pos = np.flatnonzero(mask)
+        counts = np.bincount(session[pos], minlength=len(arrays))
+        first = np.cumsum(counts) - counts
+        # groups with the same number of packets are computed together
+        for n in np.unique(counts[counts > 0]):
+            sel = np.flatnonzero(counts == n)
+            idx = pos[first[sel, None] + np.arange(n)]
+            stats[sel, g] = compute_stats(flat["size"][idx], flat["time"][idx])
+
+    protocol[session, row] = np.column_stack([flat["direction"], flat["size"], flat["iat"], flat["window"]])
+    return stats, protocol
+
+
+def extract_protocol_fields(packets, num_packets=NUM_PACKETS):
+    """Returns the protocol matrix (direction, size, iat, tcp_window of the first 32 packets)."""
+    return batch_matrices([session_array(packets[:num_packets])])[1][0]
 
 
 def process_session(pcap_file):
-    packets = rdpcap(pcap_file)
-    
-    groups = {
-        "bidirectional" : [],
-        "srcdst" : [],
-        "dstsrc" : [],
-        "handshake" : [],
-        "datatransfer" : []
-    }
+    # solo se leen y decodifican los paquetes que se usan
+    packets = list(read_packets(pcap_file, limit=NUM_PACKETS))
+    return session_matrices(packets)
+
+
+def session_matrices(packets):
+    """Returns the stats matrix (5 x 14) and the protocol matrix (32 x 4) of the first packets of a session."""
     if not packets:
         return None, None  
-    
-    
-    src_ip, dst_ip = identify_src_dst_ips(packets[:32])
+    stats, protocol = batch_matrices([session_array(packets)])
+    return stats[0], protocol[0]
 
-    
-    for packet in packets[:32]:
-        groups['bidirectional'].append(packet)
-
-        if src_ip and dst_ip:
-            if packet['IP'].src == src_ip and packet['IP'].dst == dst_ip:
-                groups['srcdst'].append(packet)
-            elif packet['IP'].src == dst_ip and packet['IP'].dst == src_ip:
-                groups['dstsrc'].append(packet)
-
-        if TCP in packet:
-            if packet[TCP].flags & 2:  # SYN flag
-                groups['handshake'].append(packet)
-            else:
-                groups['datatransfer'].append(packet)
-        else:
-            groups['datatransfer'].append(packet)
-        
-    
-    
-    stats_matrix = np.zeros((5, 14))  
-    for i, group in enumerate(groups.values()):
-        stats_matrix[i, :] = compute_stats(group)
 
-    
-    
-    protocol_matrix = extract_protocol_fields(packets[:32])
-    
-    return stats_matrix, protocol_matrix
+STAT_FIELDS = ["min_size","max_size","mean_size", "std_size", "skew_size", "min_time","max_time","mean_time", "std_time", "skew_time","tot_size", "num_packets", "byte/s", "packet/s"]
+COLUMNS =   ["file_name", "label", "family"] + \
+            [f"bidirectional_{field}" for field in STAT_FIELDS] + \
+            [f"src2dst_{field}" for field in STAT_FIELDS] + \
+            [f"dst2src_{field}" for field in STAT_FIELDS] + \
+            [f"handshake_{field}" for field in STAT_FIELDS] + \
+            [f"datatransfer_{field}" for field in STAT_FIELDS] + \
+            [f"packet_{i+1}_{field}" for i in range(32) for field in ["direction", "size", "iat", "tcp_window"]]
 
 
-file_name = sys.argv[1]
-session_number = sys.argv[2]
-mal_name = sys.argv[3]
-session_number = session_number.split('.pcap')[0]
+def session_features(pcap_file, session_name, label=1, family=2):
+    """Returns the feature row (see COLUMNS) of a session pcap, None if it has no packets."""
+    return packet_features(list(read_packets(pcap_file, limit=NUM_PACKETS)), session_name, label, family)
 
-input_dir = f"/media/fingopolo/Maxtor/TFG/MalDIST/DATASET1/GROUPS/SESSIONS/VALAK/{mal_name}/{file_name}/{session_number}.pcap"  # Directorio con los archivos pcap de sesiones
-output_csv = f"/media/fingopolo/Maxtor/TFG/MalDIST/DATASET1/GROUPS/FEATURES/VALAK/{mal_name}_{file_name}_{session_number}.csv"
 
+def packet_features(packets, session_name, label=1, family=2):
+    """Returns the feature row (see COLUMNS) of the first packets of a session, None if there are none."""
+    return batch_features([packets], [session_name], label, family)[0]
 
-data = []
 
-session_name = f"{file_name}_{session_number}"  
-print(f"Procesando: {input_dir} -> {session_name}")
-result = process_session(input_dir)
-if result:
-    stats_matrix, protocol_matrix = result
-    
-    stats_matrix = stats_matrix.flatten()
-    protocol_matrix = protocol_matrix.flatten()
-    features = list(np.concatenate([stats_matrix, protocol_matrix]))
-    
-    
-    features.insert(0, 2) # Añadir familia 0 benigno 1 Dridex 2 Emotet 3 Hancitor 4 Valak 5 Keylogger
-    features.insert(0, 1)  # Añadir label 0 benigno 1 malware
-    features.insert(0, session_name)  
-    data.append(features)
-
-columns =   ["file_name", "label", "family"] + \
-            [f"bidirectional_{field}" for field in ["min_size","max_size","mean_size", "std_size", "skew_size", "min_time","max_time","mean_time", "std_time", "skew_time","tot_size", "num_packets", "byte/s", "packet/s"]] + \
-            [f"src2dst_{field}" for field in ["min_size","max_size","mean_size", "std_size", "skew_size", "min_time","max_time","mean_time", "std_time", "skew_time","tot_size", "num_packets", "byte/s", "packet/s"]] + \
-            [f"dst2src_{field}" for field in ["min_size","max_size","mean_size", "std_size", "skew_size", "min_time","max_time","mean_time", "std_time", "skew_time","tot_size", "num_packets", "byte/s", "packet/s"]] + \
-            [f"handshake_{field}" for field in ["min_size","max_size","mean_size", "std_size", "skew_size", "min_time","max_time","mean_time", "std_time", "skew_time","tot_size", "num_packets", "byte/s", "packet/s"]] + \
-            [f"datatransfer_{field}" for field in ["min_size","max_size","mean_size", "std_size", "skew_size", "min_time","max_time","mean_time", "std_time", "skew_time","tot_size", "num_packets", "byte/s", "packet/s"]] + \
-            [f"packet_{i+1}_{field}" for i in range(32) for field in ["direction", "size", "iat", "tcp_window"]]
-df = pd.DataFrame(data, columns=columns)
-df.to_csv(output_csv, index=False)
+def batch_features(sessions, session_names, label=1, family=2):
+    """Returns the feature rows (see COLUMNS) of many sessions (lists of packets) at once, None for empty ones."""
+    arrays = [session_array(packets) for packets in sessions]
+    stats, protocol = batch_matrices(arrays)
+    features = np.concatenate([stats.reshape(len(arrays), -1), protocol.reshape(len(arrays), -1)], axis=1)
+    rows = []
+    for arr, name, values in zip(arrays, session_names, features):
+        if not len(arr):
+            rows.append(None)
+            continue
+        # Añadir familia (0 benigno 1 Dridex 2 Emotet 3 Hancitor 4 Valak 5 Keylogger) y label (0 benigno 1 malware)
+        rows.append([name, label, family] + list(values))
+    return rows
+
+
+if __name__ == '__main__':
+    file_name = sys.argv[1]
+    session_number = sys.argv[2]
+    mal_name = sys.argv[3]
+    session_number = session_number.split('.pcap')[0]
+
+    input_dir = f"/media/fingopolo/Maxtor/TFG/MalDIST/DATASET1/GROUPS/SESSIONS/VALAK/{mal_name}/{file_name}/{session_number}.pcap"  # Directorio con los archivos pcap de sesiones
+    output_csv = f"/media/fingopolo/Maxtor/TFG/MalDIST/DATASET1/GROUPS/FEATURES/VALAK/{mal_name}_{file_name}_{session_number}.csv"
+
+
+    data = []
+
+    session_name = f"{file_name}_{session_number}"  
+    print(f"Procesando: {input_dir} -> {session_name}")
+    features = session_features(input_dir, session_name)
+    if features:
+        data.append(features)
+
+    df = pd.DataFrame(data, columns=COLUMNS)
+    df.to_csv(output_csv, index=False)
 
-print(f"Características guardadas en: {output_csv}")
\ No newline at end of file
+    print(f"Características guardadas en: {output_csv}")
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+#
+# split_sessions.py <PCAP> [-d <output DIR>] [-o <features CSV> -l <label> -f <family>] [--udp] [--metrics <prefix>]
+#
+# E.g., python3 split_sessions.py capture.pcap -d Maxtor/capture/          (session pcaps, like sessions.sh)
+#       python3 split_sessions.py capture.pcap -o capture.csv -l 1 -f 4     (features, no intermediate files)
+#
+# Reads the capture only once and groups the packets by bidirectional 5-tuple. Sessions are
+# numbered in order of their first packet, like tshark's tcp.stream; a SYN on a closed
+# connection (FIN or RST seen) starts a new session. With -d every session is written to
+# <DIR>/session_<N>.pcap in the same pass (udp_session_<N>.pcap for UDP). With -o the
+# features of preprocesing_oneF.py are computed from the first 32 packets of each session and
+# written as soon as a session has them; the session name is <capture>_session_<N>.
+#
+
+import os
+import sys
+import argparse
+from collections import OrderedDict
+from contextlib import redirect_stdout
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from pcapio import open_capture, iter_records, decode, pcap_header, pcap_record, TCP_SYN, TCP_ACK, TCP_FIN, TCP_RST
+from instrument import Metrics
+from columnar import open_table
+from preprocesing_oneF import packet_features, COLUMNS, NUM_PACKETS
+from extract_features import format_value
+
+
+class Session:
+    __slots__ = ('name', 'linktype', 'resolution', 'packets', 'count', 'closed')
+
+    def __init__(self, name, linktype, resolution):
+        self.name = name
+        self.linktype = linktype
+        self.resolution = resolution
+        self.packets = []       # first packets (features mode)
+        self.count = 0
+        self.closed = False     # FIN or RST seen
+
+
+def flow_key(pkt):
+    """Bidirectional 5-tuple of a TCP/UDP packet, None for other packets."""
+    if pkt.sport is None or pkt.proto not in (6, 17):
+        return None
+    a, b = (pkt.src, pkt.sport), (pkt.dst, pkt.dport)
+    return (pkt.proto,) + ((a, b) if a <= b else (b, a))
+
+
+def iter_sessions(pcap, udp=False):
+    """Yields (session, record, packet) for every TCP (and UDP) packet of the capture."""
+    sessions = {}
+    counters = {6: 0, 17: 0}
+    f = open_capture(pcap)
+    try:
+        for record in iter_records(f):
+            pkt = decode(*record)
+            key = flow_key(pkt)
+            if key is None or (pkt.proto == 17 and not udp):
+                continue
+            session = sessions.get(key)
+            if session is not None and session.closed and pkt.proto == 6 and pkt.flags & TCP_SYN and not pkt.flags & TCP_ACK:
+                session = None      # port reuse: new connection
+            if session is None:
+                prefix = "session" if pkt.proto == 6 else "udp_session"
+                session = Session(f"{prefix}_{counters[pkt.proto]}", record[2], record[1])
+                counters[pkt.proto] += 1
+                sessions[key] = session
+            if pkt.proto == 6 and pkt.flags & (TCP_FIN | TCP_RST):
+                session.closed = True
+            session.count += 1
+            yield session, record, pkt
+    finally:
+        if f is not sys.stdin.buffer:
+            f.close()
+
+
+class SessionWriter:
+    """Writes the packets of many sessions into their own pcap files, with a bounded number of open files."""
+
+    def __init__(self, outdir, max_open=256):
+        self.outdir = outdir
+        self.max_open = max_open
+        self.files = OrderedDict()  # session name -> open file, least recently used first
+        self.created = set()
+
+    def write(self, session, ticks, resolution, data):
+        f = self.files.pop(session.name, None)
+        if f is None:
+            path = os.path.join(self.outdir, f"{session.name}.pcap")
+            if session.name in self.created:
+                f = open(path, "ab")
+            else:
+                f = open(path, "wb")
+                f.write(pcap_header(session.linktype, session.resolution))
+                self.created.add(session.name)
+            while len(self.files) >= self.max_open:
+                self.files.popitem(last=False)[1].close()
+        self.files[session.name] = f
+        f.write(pcap_record(ticks, resolution, data, 1000000 if session.resolution == 1000000 else 1000000000))
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files.clear()
+
+
+def split_pcap(pcap, outdir, udp=False, max_open=256):
+    """Writes every session of the capture into its own pcap file; returns the number of sessions."""
+    writer = SessionWriter(outdir, max_open)
+    try:
+        for session, (ticks, resolution, _, data), _ in iter_sessions(pcap, udp):
+            writer.write(session, ticks, resolution, data)
+    finally:
+        writer.close()
+    return len(writer.created)
+
+
+def pcap_features(pcap, output, label=1, family=2, udp=False):
+    """Writes the features of every session of the capture into a CSV (or .parquet); returns the number of sessions."""
+    capture = os.path.basename(pcap).split('.pcap')[0]
+    pending = OrderedDict()     # sessions with less than NUM_PACKETS packets, by first packet
+    count = 0
+    with open_table(output, COLUMNS) as writer, open(os.devnull, "w") as devnull:
+
+        def emit(session):
+            with redirect_stdout(devnull):
+                features = packet_features(session.packets, f"{capture}_{session.name}", label, family)
+            writer.writerow([format_value(v) for v in features])
+            session.packets = None
+
+        for session, _, pkt in iter_sessions(pcap, udp):
+            if session.count > NUM_PACKETS:
+                continue
+            pkt.data = None     # only the decoded header fields are needed
+            session.packets.append(pkt)
+            if session.count == NUM_PACKETS:
+                pending.pop(id(session), None)
+                emit(session)
+                count += 1
+            else:
+                pending[id(session)] = session
+
+        for session in pending.values():
+            emit(session)
+            count += 1
+    return count
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Splits a capture into sessions in one pass: session pcaps and/or MalDIST features.")
+    parser.add_argument("pcap", help="Input PCAP or PCAPNG file ('-' for stdin)")
+    parser.add_argument("-d", "--outdir", help="Write every session into <DIR>/session_<N>.pcap")
+    parser.add_argument("-o", "--output", help="Write the features of every session into this CSV (Parquet if it ends in .parquet)")
+    parser.add_argument("-l", "--label", type=int, default=1, help="Label: 0 benign, 1 malware (default: 1)")
+    parser.add_argument("-f", "--family", type=int, default=2, help="Family: 0 benign, 1 Dridex, 2 Emotet, 3 Hancitor, 4 Valak, 5 Keylogger (default: 2)")
+    parser.add_argument("--udp", action="store_true", help="Also split UDP flows")
+    parser.add_argument("--max-open", type=int, default=256, help="Max. number of session files open at once")
+    parser.add_argument("--metrics", help="Write the timings and counters of the run into <prefix>.json and <prefix>.prom")
+    args = parser.parse_args()
+    if not args.outdir and not args.output:
+        parser.error("use -d and/or -o")
+    if args.outdir and args.output and args.pcap == "-":
+        parser.error("stdin can be read only once, use -d or -o")
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    metrics = Metrics("split_sessions", os.path.basename(args.metrics) if args.metrics else None)
+    if args.outdir:
+        os.makedirs(args.outdir, exist_ok=True)
+        with metrics.stage("split") as stage:
+            n = split_pcap(args.pcap, args.outdir, args.udp, args.max_open)
+            stage.add("sessions", n)
+        print(f"{n} sessions saved into {args.outdir}/")
+    if args.output:
+        with metrics.stage("features") as stage:
+            n = pcap_features(args.pcap, args.output, args.label, args.family, args.udp)
+            stage.add("sessions", n)
+        print(f"Features of {n} sessions saved into {args.output}")
+    if args.metrics:
+        metrics.save(args.metrics)
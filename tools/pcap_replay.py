@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+#
+# pcap_replay.py <PCAP> [-o <output file or FIFO>] [-s <speed>] [--topspeed] [--loop <N>]
+#
+# E.g., mkfifo /tmp/cap.fifo
+#       python3 pcap_replay.py capture.pcap -o /tmp/cap.fifo -s 10 &
+#       python3 ja4/stream_ja4.py /tmp/cap.fifo -d out/
+#
+# Writes the packets of a saved capture as a classic pcap stream (like tcpdump -w -), with the
+# original time between packets divided by --speed, so the streaming tools can be tested without
+# a live capture. Every packet is flushed as soon as it is written.
+#
+
+import sys
+import time
+import argparse
+
+from pcapio import open_capture, iter_records, pcap_header, pcap_record
+
+
+def replay(pcap, out, speed=1.0, topspeed=False, loops=1):
+    """Writes the records of pcap to the binary file out; returns the number of packets written."""
+    count = 0
+    header = False
+    for _ in range(loops):
+        f = open_capture(pcap)
+        try:
+            start = first = None
+            for ticks, resolution, linktype, data in iter_records(f):
+                if not header:
+                    # pcapng captures may mix resolutions, the stream keeps the one of the first packet
+                    out_resolution = 1000000 if resolution == 1000000 else 1000000000
+                    out.write(pcap_header(linktype, out_resolution))
+                    header = True
+                t = ticks / resolution
+                if not topspeed:
+                    if start is None:
+                        start, first = time.monotonic(), t
+                    delay = start + (t - first) / speed - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                out.write(pcap_record(ticks, resolution, data, out_resolution))
+                out.flush()
+                count += 1
+        finally:
+            if f is not sys.stdin.buffer:
+                f.close()
+    return count
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replays a saved capture as a pcap stream (tcpdump -w - style) into stdout, a file or a FIFO.")
+    parser.add_argument("pcap", help="Input PCAP or PCAPNG file")
+    parser.add_argument("-o", "--output", default="-", help="Output file or named pipe (default: stdout)")
+    parser.add_argument("-s", "--speed", type=float, default=1.0, help="Replay speed multiplier (default: 1, real time)")
+    parser.add_argument("--topspeed", action="store_true", help="Write the packets as fast as possible")
+    parser.add_argument("--loop", type=int, default=1, help="Number of times the capture is replayed")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    out = sys.stdout.buffer if args.output == "-" else open(args.output, "wb")
+    try:
+        n = replay(args.pcap, out, args.speed, args.topspeed, args.loop)
+        print(f"{n} packets replayed", file=sys.stderr)
+    except BrokenPipeError:
+        sys.exit(1)     # the reader went away
+    finally:
+        if out is not sys.stdout.buffer:
+            try:
+                out.close()
+            except BrokenPipeError:
+                pass
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+#
+# pcapio.py -- minimal pcap/pcapng reader and packet decoder
+#
+# Reads classic pcap (micro/nanosecond) and pcapng captures record by record
+# from a file, a named pipe or stdin, and decodes only the link, IP and
+# TCP/UDP headers. It replaces full dissection (tshark, scapy) where the
+# tools only need header fields and the TCP/UDP payload. Records can be
+# written back as classic pcap.
+#
+
+import sys
+import socket
+import struct
+
+
+PCAP_MAGIC = {
+    b"\xd4\xc3\xb2\xa1": ("<", 1000000),      # little endian, microseconds
+    b"\xa1\xb2\xc3\xd4": (">", 1000000),      # big endian, microseconds
+    b"\x4d\x3c\xb2\xa1": ("<", 1000000000),   # little endian, nanoseconds
+    b"\xa1\xb2\x3c\x4d": (">", 1000000000),   # big endian, nanoseconds
+}
+PCAPNG_SHB = b"\x0a\x0d\x0d\x0a"
+
+# link types
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LOOP = 108
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+LINKTYPE_LINUX_SLL2 = 276
+
+ETH_IPV4 = 0x0800
+ETH_IPV6 = 0x86dd
+ETH_VLAN = (0x8100, 0x88a8, 0x9100)
+
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_RST = 0x04
+TCP_ACK = 0x10
+
+
+class Packet:
+    """Decoded header fields of one captured frame."""
+    __slots__ = ('ticks', 'resolution', 'caplen', 'data', 'link_src', 'link_dst', 'version',
+                 'src', 'dst', 'proto', 'ttl', 'sport', 'dport', 'flags', 'seq', 'ack',
+                 'window', 'options', 'payload')
+
+    def __init__(self, ticks, resolution, data):
+        self.ticks = ticks              # timestamp in units of 1/resolution seconds
+        self.resolution = resolution
+        self.caplen = len(data)
+        self.data = data
+        self.link_src = None            # link layer addresses (MAC) if the link type has them
+        self.link_dst = None
+        self.version = None             # 4 or 6, None for non-IP frames
+        self.src = None
+        self.dst = None
+        self.proto = None
+        self.ttl = None
+        self.sport = None
+        self.dport = None
+        self.flags = None               # TCP flags (12 bits)
+        self.seq = None
+        self.ack = None
+        self.window = None
+        self.options = b""              # raw TCP options
+        self.payload = b""              # TCP/UDP payload
+
+    @property
+    def time(self):
+        # int / int is correctly rounded, so this equals float(Decimal(ticks) / resolution)
+        return self.ticks / self.resolution
+
+
+def open_capture(path):
+    """Opens a capture file for binary reading; '-' reads from stdin (pipes and FIFOs work too)."""
+    if path == "-":
+        return sys.stdin.buffer
+    return open(path, "rb")
+
+
+def _read_exact(f, n):
+    data = f.read(n)
+    while len(data) < n:
+        chunk = f.read(n - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def iter_records(f):
+    """Yields (ticks, resolution, linktype, data) for every record of a pcap or pcapng stream."""
+    magic = _read_exact(f, 4)
+    if len(magic) < 4:
+        return
+    if magic == PCAPNG_SHB:
+        yield from _iter_pcapng(f, magic)
+    elif magic in PCAP_MAGIC:
+        yield from _iter_pcap(f, magic)
+    else:
+        raise ValueError(f"Unknown capture format (magic {magic.hex()})")
+
+
+def _iter_pcap(f, magic):
+    endian, resolution = PCAP_MAGIC[magic]
+    header = _read_exact(f, 20)
+    if len(header) < 20:
+        return
+    linktype = struct.unpack(endian + "HHiIII", header)[5] & 0x0fffffff
+    record = struct.Struct(endian + "IIII")
+    while True:
+        hdr = _read_exact(f, 16)
+        if len(hdr) < 16:
+            return
+        sec, frac, caplen, _ = record.unpack(hdr)
+        data = _read_exact(f, caplen)
+        if len(data) < caplen:
+            return                      # truncated last record
+        yield sec * resolution + frac, resolution, linktype, data
+
+
+def _tsresol(value):
+    if value & 0x80:
+        return 1 << (value & 0x7f)
+    return 10 ** value
+
+
+def _iter_pcapng(f, magic):
+    endian = "<"
+    interfaces = []
+    while True:
+        if magic is None:
+            magic = _read_exact(f, 4)
+            if len(magic) < 4:
+                return
+        head = _read_exact(f, 4)
+        if len(head) < 4:
+            return
+        if magic == PCAPNG_SHB:
+            # the byte-order magic decides the endianness of the whole section
+            bom = _read_exact(f, 4)
+            endian = "<" if bom == b"\x4d\x3c\x2b\x1a" else ">"
+            block_len = struct.unpack(endian + "I", head)[0]
+            body = _read_exact(f, block_len - 12)
+            interfaces = []
+            magic = None
+            continue
+        block_type = struct.unpack(endian + "I", magic)[0]
+        block_len = struct.unpack(endian + "I", head)[0]
+        body = _read_exact(f, block_len - 8)
+        if len(body) < block_len - 8:
+            return
+        magic = None
+        if block_type == 1:             # Interface Description Block
+            linktype = struct.unpack_from(endian + "H", body, 0)[0]
+            resolution = 1000000
+            pos = 8
+            while pos + 4 <= len(body) - 4:
+                code, length = struct.unpack_from(endian + "HH", body, pos)
+                if code == 0:
+                    break
+                if code == 9 and length >= 1:   # if_tsresol
+                    resolution = _tsresol(body[pos + 4])
+                pos += 4 + ((length + 3) & ~3)
+            interfaces.append((linktype, resolution))
+        elif block_type == 6:           # Enhanced Packet Block
+            iface, ts_high, ts_low, caplen = struct.unpack_from(endian + "IIII", body, 0)
+            linktype, resolution = interfaces[iface] if iface < len(interfaces) else (LINKTYPE_ETHERNET, 1000000)
+            yield (ts_high << 32) | ts_low, resolution, linktype, body[20:20 + caplen]
+        elif block_type == 3:           # Simple Packet Block (no timestamp)
+            linktype, resolution = interfaces[0] if interfaces else (LINKTYPE_ETHERNET, 1000000)
+            origlen = struct.unpack_from(endian + "I", body, 0)[0]
+            yield 0, resolution, linktype, body[4:4 + min(origlen, len(body) - 8)]
+        elif block_type == 2:           # obsolete Packet Block
+            iface, _, ts_high, ts_low, caplen = struct.unpack_from(endian + "HHIII", body, 0)
+            linktype, resolution = interfaces[iface] if iface < len(interfaces) else (LINKTYPE_ETHERNET, 1000000)
+            yield (ts_high << 32) | ts_low, resolution, linktype, body[20:20 + caplen]
+
+
+def _mac(b):
+    return ":".join(f"{x:02x}" for x in b)
+
+
+def decode(ticks, resolution, linktype, data):
+    """Decodes link, IP and TCP/UDP headers of a frame into a Packet."""
+    pkt = Packet(ticks, resolution, data)
+    ethertype = None
+    off = 0
+    if linktype == LINKTYPE_ETHERNET:
+        if len(data) < 14:
+            return pkt
+        pkt.link_dst = _mac(data[0:6])
+        pkt.link_src = _mac(data[6:12])
+        ethertype = (data[12] << 8) | data[13]
+        off = 14
+        while ethertype in ETH_VLAN and len(data) >= off + 4:
+            ethertype = (data[off + 2] << 8) | data[off + 3]
+            off += 4
+    elif linktype in (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6, 12, 14):
+        if not data:
+            return pkt
+        ethertype = ETH_IPV4 if data[0] >> 4 == 4 else ETH_IPV6
+    elif linktype in (LINKTYPE_NULL, LINKTYPE_LOOP):
+        if len(data) < 5:
+            return pkt
+        off = 4
+        ethertype = ETH_IPV4 if data[4] >> 4 == 4 else ETH_IPV6
+    elif linktype == LINKTYPE_LINUX_SLL:
+        if len(data) < 16:
+            return pkt
+        pkt.link_src = data[6:6 + min(data[5], 8)]
+        ethertype = (data[14] << 8) | data[15]
+        off = 16
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        if len(data) < 20:
+            return pkt
+        pkt.link_src = data[12:12 + min(data[11], 8)]
+        ethertype = (data[0] << 8) | data[1]
+        off = 20
+    else:
+        return pkt
+
+    if ethertype == ETH_IPV4:
+        if len(data) < off + 20:
+            return pkt
+        ihl = (data[off] & 0x0f) * 4
+        total = (data[off + 2] << 8) | data[off + 3]
+        frag = ((data[off + 6] & 0x1f) << 8) | data[off + 7]
+        pkt.version = 4
+        pkt.ttl = data[off + 8]
+        pkt.proto = data[off + 9]
+        pkt.src = socket.inet_ntoa(data[off + 12:off + 16])
+        pkt.dst = socket.inet_ntoa(data[off + 16:off + 20])
+        end = min(len(data), off + total) if total else len(data)
+        if frag:
+            return pkt                  # non-first fragment, no transport header
+        off += ihl
+    elif ethertype == ETH_IPV6:
+        if len(data) < off + 40:
+            return pkt
+        plen = (data[off + 4] << 8) | data[off + 5]
+        nxt = data[off + 6]
+        pkt.version = 6
+        pkt.ttl = data[off + 7]
+        pkt.src = socket.inet_ntop(socket.AF_INET6, data[off + 8:off + 24])
+        pkt.dst = socket.inet_ntop(socket.AF_INET6, data[off + 24:off + 40])
+        end = min(len(data), off + 40 + plen)
+        off += 40
+        # skip hop-by-hop, routing and destination options headers
+        while nxt in (0, 43, 60) and off + 8 <= end:
+            nxt, hlen = data[off], (data[off + 1] + 1) * 8
+            off += hlen
+        if nxt == 44:                   # fragment header
+            if off + 8 > end or ((data[off + 2] << 8) | data[off + 3]) & 0xfff8:
+                pkt.proto = nxt
+                return pkt
+            nxt = data[off]
+            off += 8
+        pkt.proto = nxt
+    else:
+        return pkt
+
+    if pkt.proto == 6 and off + 20 <= end:
+        pkt.sport = (data[off] << 8) | data[off + 1]
+        pkt.dport = (data[off + 2] << 8) | data[off + 3]
+        pkt.seq, pkt.ack = struct.unpack_from(">II", data, off + 4)
+        doff = (data[off + 12] >> 4) * 4
+        pkt.flags = ((data[off + 12] & 0x0f) << 8) | data[off + 13]
+        pkt.window = (data[off + 14] << 8) | data[off + 15]
+        pkt.options = data[off + 20:off + doff]
+        pkt.payload = data[off + doff:end]
+    elif pkt.proto == 17 and off + 8 <= end:
+        pkt.sport = (data[off] << 8) | data[off + 1]
+        pkt.dport = (data[off + 2] << 8) | data[off + 3]
+        pkt.payload = data[off + 8:end]
+    return pkt
+
+
+def pcap_header(linktype, resolution=1000000, snaplen=262144):
+    """Global header of a classic pcap file; microsecond or nanosecond timestamps."""
+    magic = b"\xd4\xc3\xb2\xa1" if resolution == 1000000 else b"\x4d\x3c\xb2\xa1"
+    return magic + struct.pack("<HHiIII", 2, 4, 0, 0, snaplen, linktype)
+
+
+def pcap_record(ticks, resolution, data, out_resolution=None):
+    """Record of a classic pcap file written with pcap_header(linktype, out_resolution)."""
+    out_resolution = out_resolution or (1000000 if resolution == 1000000 else 1000000000)
+    if resolution != out_resolution:
+        ticks = ticks * out_resolution // resolution
+    sec, frac = divmod(ticks, out_resolution)
+    return struct.pack("<IIII", sec, frac, len(data), len(data)) + data
+
+
+def read_packets(path, limit=None):
+    """Yields decoded packets of a capture; stops after `limit` packets if given."""
+    f = open_capture(path)
+    try:
+        for count, record in enumerate(iter_records(f)):
+            if limit is not None and count >= limit:
+                break
+            yield decode(*record)
+    finally:
+        if f is not sys.stdin.buffer:
+            f.close()